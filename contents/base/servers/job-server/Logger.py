@@ -1,7 +1,24 @@
+import atexit
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from enum import Enum
 
+LOGGER_NAME = "task_queue_logger"
+
+DEFAULT_LOG_LEVEL = "debug"
+DEFAULT_LOG_QUEUE_SIZE = 10000
+
+# The queue listener is shared by every Logger instance in the process
+_listener = None
+_setup_lock = threading.Lock()
+
 
 class LogLevel(Enum):
     DEBUG = "debug"
@@ -11,37 +28,127 @@ class LogLevel(Enum):
     CRITICAL = "critical"
 
 
-class Logger:
-    def __init__(self, log_file="app.log"):
-        self.log_file = log_file
-        self.logger = self.setup_logger()
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a log record as a single line of JSON.
+    """
 
-    def setup_logger(self):
-        logger = logging.getLogger("task_queue_logger")
-        logger.setLevel(logging.DEBUG)
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records of each level, e.g. {logging.DEBUG: 0.1}
+    keeps one debug record in ten. Levels without a rate are always kept.
+    """
+
+    def __init__(self, sample_rates: dict):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread and drops them, rather than blocking the
+    caller, when the queue is full.
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
 
-        handler = RotatingFileHandler(
-            self.log_file, maxBytes=1024 * 1024, backupCount=5
-        )
-        handler.setLevel(logging.DEBUG)
 
-        formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-        handler.setFormatter(formatter)
+def parse_sample_rates(value: str) -> dict:
+    """
+    Parses LOG_SAMPLE_RATES, a comma separated list of level=rate pairs such as
+    "debug=0.1,info=0.5".
+    """
+    sample_rates = {}
+    for pair in filter(None, (part.strip() for part in value.split(","))):
+        level, rate = pair.split("=")
+        sample_rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return sample_rates
 
-        logger.addHandler(handler)
 
+def setup_logging() -> logging.Logger:
+    """
+    Configures the task queue logger once per process. Request threads only put
+    records on an in-memory queue; a background listener thread formats them as
+    JSON and writes them to stdout (and to LOG_FILE when set).
+    """
+    global _listener
+
+    logger = logging.getLogger(LOGGER_NAME)
+    if _listener is not None:
         return logger
+    with _setup_lock:
+        if _listener is not None:
+            return logger
+
+        logger.setLevel(os.getenv("LOG_LEVEL", DEFAULT_LOG_LEVEL).upper())
+        logger.propagate = False
+
+        formatter = JsonFormatter()
+        output_handlers = [logging.StreamHandler(sys.stdout)]
+        log_file = os.getenv("LOG_FILE")
+        if log_file:
+            output_handlers.append(
+                RotatingFileHandler(log_file, maxBytes=1024 * 1024, backupCount=5)
+            )
+        for output_handler in output_handlers:
+            output_handler.setFormatter(formatter)
+
+        log_queue = queue.Queue(
+            int(os.getenv("LOG_QUEUE_SIZE", DEFAULT_LOG_QUEUE_SIZE))
+        )
+        queue_handler = NonBlockingQueueHandler(log_queue)
+        queue_handler.addFilter(
+            SamplingFilter(parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "")))
+        )
+        logger.handlers = [queue_handler]
+
+        _listener = QueueListener(
+            log_queue, *output_handlers, respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(_listener.stop)
+
+    return logger
+
+
+class Logger:
+    @property
+    def logger(self) -> logging.Logger:
+        # Logging is set up on first use, not when a module creates its Logger
+        return setup_logging()
 
-    def log(self, level: LogLevel, message: str):
+    def log(self, level: LogLevel, message: str, **fields):
+        extra = {"fields": fields}
         if level == LogLevel.DEBUG:
-            self.logger.debug(message)
+            self.logger.debug(message, extra=extra)
         elif level == LogLevel.INFO:
-            self.logger.info(message)
+            self.logger.info(message, extra=extra)
         elif level == LogLevel.WARNING:
-            self.logger.warning(message)
+            self.logger.warning(message, extra=extra)
         elif level == LogLevel.ERROR:
-            self.logger.error(message)
+            self.logger.error(message, extra=extra)
         elif level == LogLevel.CRITICAL:
-            self.logger.critical(message)
+            self.logger.critical(message, extra=extra)
         else:
             raise ValueError(f"Invalid log level: {level.value}")
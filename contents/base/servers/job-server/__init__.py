@@ -1 +0,0 @@
-print("___Task queue package initialized.___")
\ No newline at end of file
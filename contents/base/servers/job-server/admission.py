@@ -0,0 +1,278 @@
+import json
+import time
+
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from starlette.datastructures import QueryParams
+
+from cache import TTLCache
+from utils import get_env_var, ErrorCode
+from Logger import Logger, LogLevel
+from database import TaskQueue, get_pool_capacity
+from responses import retry_later_response
+
+# Pool connections kept for the work done outside requests: the task event
+# listener, the archiver and the bundle builder
+DEFAULT_DB_POOL_RESERVED_CONNECTIONS = 3
+
+# Fraction of MAX_IN_FLIGHT each endpoint class may use, so that no class can
+# take all the connections
+ENDPOINT_CLASS_SHARES = {
+    "enqueue": 0.5,
+    "claim": 0.5,
+    "update": 0.5,
+    "read": 0.5,
+    "discovery": 0.25,
+    "export": 0.15,
+}
+DEFAULT_CLAIM_RATE_PER_AGENT = 0
+DEFAULT_MAX_BACKLOG_PER_TASK_TYPE = 0
+DEFAULT_BACKLOG_CHECK_TTL_SECONDS = 1
+OVERLOAD_RETRY_AFTER_SECONDS = 1
+BACKLOG_RETRY_AFTER_SECONDS = 5
+
+# Rate limit buckets kept before the idle ones are dropped
+MAX_TRACKED_AGENTS = 10000
+
+# Endpoint class of each route. Other requests, such as health checks and event
+# streams, are never limited.
+ENDPOINT_CLASSES = {
+    ("PUT", "/tasks"): "enqueue",
+    ("POST", "/tasks/claim"): "claim",
+    ("PUT", "/tasks/complete"): "update",
+    ("PUT", "/tasks/metrics"): "update",
+    ("GET", "/tasks"): "read",
+    ("GET", "/tasks/stats"): "read",
+    ("GET", "/tasks/report"): "read",
+    ("GET", "/JobStatus"): "read",
+    ("GET", "/DatasetDiscovery"): "discovery",
+    ("GET", "/tasks/export"): "export",
+}
+
+logger = Logger()
+
+
+def get_endpoint_class(method: str, path: str):
+    if method == "PUT" and path.startswith("/tasks/metrics/"):
+        path = "/tasks/metrics"
+    return ENDPOINT_CLASSES.get((method, path))
+
+
+class ConcurrencyLimit:
+    """
+    Counts the requests of an endpoint class in flight. Only used from the event
+    loop, so it needs no lock.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+
+    def try_acquire(self) -> bool:
+        if self.limit > 0 and self.in_flight >= self.limit:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+
+class RateLimit:
+    """
+    A token bucket per key: rate requests per second on average, with bursts of
+    up to burst requests. A rate of 0 (or less) disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._buckets = {}
+
+    def acquire(self, key) -> float:
+        """
+        Takes a token from the bucket of key. Returns 0 if one was available, or
+        else the number of seconds until one will be.
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[key] = (tokens - 1, now)
+        if len(self._buckets) > MAX_TRACKED_AGENTS:
+            self._drop_full_buckets(now)
+        return 0
+
+    def _drop_full_buckets(self, now: float):
+        # A full bucket is the same as no bucket
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self.rate >= self.burst:
+                del self._buckets[key]
+
+
+def admission_limits() -> tuple:
+    """
+    The limits of requests in flight in this worker process: MAX_IN_FLIGHT for all
+    of them, and MAX_IN_FLIGHT_<CLASS> for each endpoint class. Each worker has its
+    own connection pool, and an admitted request holds at most one connection of
+    each shard's pool at a time: parents missing from the shard of a task type are
+    looked for on the other shards only. MAX_IN_FLIGHT therefore defaults to the
+    pool capacity less DB_POOL_RESERVED_CONNECTIONS, which keeps admitted requests
+    from waiting for connections; the class limits default to their share of it.
+    Limits that let requests wait on the pool are logged at start-up.
+
+    Returns:
+    tuple: The total limit and a dictionary of endpoint class to limit; 0 is unlimited.
+    """
+    pool_capacity = get_pool_capacity()
+    available = max(
+        1,
+        pool_capacity
+        - int(
+            get_env_var(
+                "DB_POOL_RESERVED_CONNECTIONS", DEFAULT_DB_POOL_RESERVED_CONNECTIONS
+            )
+        ),
+    )
+    total = int(get_env_var("MAX_IN_FLIGHT", available))
+    if total <= 0 or total > available:
+        logger.log(
+            LogLevel.WARNING,
+            "MAX_IN_FLIGHT exceeds the database connections available to requests, "
+            "admitted requests can wait for connections",
+            max_in_flight=total,
+            available_connections=available,
+        )
+    class_base = total if total > 0 else available
+    class_limits = {
+        endpoint_class: int(
+            get_env_var(
+                f"MAX_IN_FLIGHT_{endpoint_class.upper()}",
+                max(1, round(class_base * share)),
+            )
+        )
+        for endpoint_class, share in ENDPOINT_CLASS_SHARES.items()
+    }
+    return total, class_limits
+
+
+class AdmissionMiddleware:
+    """
+    Turns away the requests the worker cannot serve promptly instead of queueing
+    them for database connections: a 503 when MAX_IN_FLIGHT requests, or the
+    MAX_IN_FLIGHT_<CLASS> requests of their endpoint class, are already in
+    flight, and a 429 when an agent claims faster than CLAIM_RATE_PER_AGENT per
+    second. Both carry a Retry-After header. The counts and rates are kept per
+    worker process.
+
+    A request is in flight until its response has been sent, including the whole
+    body of streamed responses.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        total, class_limits = admission_limits()
+        self.total_limit = ConcurrencyLimit(total)
+        self.limits = {
+            endpoint_class: ConcurrencyLimit(limit)
+            for endpoint_class, limit in class_limits.items()
+        }
+        claim_rate = float(
+            get_env_var("CLAIM_RATE_PER_AGENT", DEFAULT_CLAIM_RATE_PER_AGENT)
+        )
+        self.claim_rate = RateLimit(
+            claim_rate, float(get_env_var("CLAIM_BURST_PER_AGENT", claim_rate))
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        endpoint_class = get_endpoint_class(scope["method"], scope["path"])
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        if endpoint_class == "claim":
+            agent_id = QueryParams(scope["query_string"]).get("agent_id")
+            retry_after = self.claim_rate.acquire(agent_id)
+            if retry_after:
+                logger.log(LogLevel.DEBUG, "Claim rate limited", agent_id=agent_id)
+                response = retry_later_response(
+                    ErrorCode.TOO_MANY_REQUESTS,
+                    "Claim rate limit exceeded",
+                    retry_after,
+                )
+                await response(scope, receive, send)
+                return
+
+        limit = self.limits[endpoint_class]
+        if not limit.try_acquire():
+            await self.reject(endpoint_class, scope, receive, send)
+            return
+        if not self.total_limit.try_acquire():
+            limit.release()
+            await self.reject(endpoint_class, scope, receive, send)
+            return
+        try:
+            # Returns once the response is sent, streamed bodies included
+            await self.app(scope, receive, send)
+        finally:
+            self.total_limit.release()
+            limit.release()
+
+    async def reject(self, endpoint_class: str, scope, receive, send):
+        logger.log(LogLevel.DEBUG, "Request rejected", endpoint_class=endpoint_class)
+        response = retry_later_response(
+            ErrorCode.UNAVAILABLE,
+            "Server overloaded",
+            OVERLOAD_RETRY_AFTER_SECONDS,
+        )
+        await response(scope, receive, send)
+
+
+class BacklogLimit:
+    """
+    Caps the number of unclaimed tasks per task type: MAX_BACKLOG_BY_TASK_TYPE, a
+    JSON object of task type to limit, or else MAX_BACKLOG_PER_TASK_TYPE. A limit
+    of 0 is unlimited. Each worker process caches the backlog depths for
+    BACKLOG_CHECK_TTL_SECONDS, so the limit can be overshot by the tasks all the
+    workers enqueue within that time.
+    """
+
+    def __init__(self):
+        self.default_limit = int(
+            get_env_var("MAX_BACKLOG_PER_TASK_TYPE", DEFAULT_MAX_BACKLOG_PER_TASK_TYPE)
+        )
+        self.limits = json.loads(get_env_var("MAX_BACKLOG_BY_TASK_TYPE", "{}"))
+        self._depths = TTLCache(
+            float(
+                get_env_var(
+                    "BACKLOG_CHECK_TTL_SECONDS", DEFAULT_BACKLOG_CHECK_TTL_SECONDS
+                )
+            )
+        )
+
+    def limit_for(self, task_type: str) -> int:
+        return int(self.limits.get(task_type, self.default_limit))
+
+    def is_full(
+        self, db: Session, task_type: str, task_type_id: int, unclaimed_status_id: int
+    ) -> bool:
+        limit = self.limit_for(task_type)
+        if limit <= 0:
+            return False
+        depth = self._depths.get_or_compute(
+            task_type,
+            lambda: db.query(func.count(TaskQueue.id))
+            .filter(
+                TaskQueue.task_type_id == task_type_id,
+                TaskQueue.task_status_id == unclaimed_status_id,
+            )
+            .scalar(),
+        )
+        return depth >= limit
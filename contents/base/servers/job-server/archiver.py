@@ -0,0 +1,140 @@
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.sql import func
+
+from utils import get_env_var
+from Logger import Logger, LogLevel
+from database import (
+    get_shards,
+    TaskDependency,
+    TaskDetail,
+    TaskQueue,
+    TaskQueueArchive,
+    TaskStatus,
+)
+
+DEFAULT_ARCHIVE_AFTER_HOURS = 24 * 7
+DEFAULT_ARCHIVE_BATCH_SIZE = 1000
+DEFAULT_ARCHIVE_INTERVAL_SECONDS = 60
+
+TERMINAL_STATUSES = ["completed", "failed"]
+
+logger = Logger()
+
+
+class TaskArchiver:
+    """
+    Moves completed and failed tasks older than a configurable age from task_queue
+    to task_queue_archive, in batches, on a background thread. Keeping only live
+    tasks in task_queue keeps the claim and status queries fast.
+
+    Several server processes can run an archiver at the same time: each batch
+    locks the rows it moves with SKIP LOCKED.
+    """
+
+    def __init__(self):
+        self.archive_after = timedelta(
+            hours=float(get_env_var("ARCHIVE_AFTER_HOURS", DEFAULT_ARCHIVE_AFTER_HOURS))
+        )
+        self.batch_size = int(
+            get_env_var("ARCHIVE_BATCH_SIZE", DEFAULT_ARCHIVE_BATCH_SIZE)
+        )
+        self.interval = float(
+            get_env_var("ARCHIVE_INTERVAL_SECONDS", DEFAULT_ARCHIVE_INTERVAL_SECONDS)
+        )
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def archive_batch(self, db) -> int:
+        """
+        Moves one batch of expired terminal tasks to the archive in a single
+        statement, and drops the dependencies of the moved tasks, which are no
+        longer needed once a task is final. Returns the number of tasks moved.
+        """
+        terminal_status_ids = select(TaskStatus.id).where(
+            TaskStatus.name.in_(TERMINAL_STATUSES)
+        )
+        cutoff = datetime.now() - self.archive_after
+        expired_ids = (
+            select(TaskQueue.id)
+            .where(
+                TaskQueue.task_status_id.in_(terminal_status_ids),
+                func.coalesce(TaskQueue.completed_time, TaskQueue.failed_time) < cutoff,
+            )
+            .order_by(TaskQueue.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+
+        # The details are deleted along with the tasks, by cascade, once the
+        # statement has read them
+        column_names = [column.name for column in TaskQueue.__table__.columns]
+        detail_names = [
+            column.name
+            for column in TaskDetail.__table__.columns
+            if column.name != "task_id"
+        ]
+        moved = (
+            delete(TaskQueue)
+            .where(TaskQueue.id.in_(expired_ids))
+            .returning(*TaskQueue.__table__.columns)
+            .cte("moved")
+        )
+        archived_ids = db.scalars(
+            insert(TaskQueueArchive)
+            .from_select(
+                column_names + detail_names,
+                select(
+                    *[moved.c[name] for name in column_names],
+                    *[TaskDetail.__table__.c[name] for name in detail_names],
+                ).select_from(
+                    moved.outerjoin(TaskDetail, TaskDetail.task_id == moved.c.id)
+                ),
+            )
+            .returning(TaskQueueArchive.id)
+        ).all()
+        if archived_ids:
+            db.execute(
+                delete(TaskDependency).where(TaskDependency.task_id.in_(archived_ids))
+            )
+        db.commit()
+        return len(archived_ids)
+
+    def archive_expired(self) -> int:
+        """
+        Archives batches on each shard until no expired terminal task is left.
+        Returns the number of tasks moved.
+        """
+        total = 0
+        for database in get_shards().databases:
+            db = database.SessionLocal()
+            try:
+                while not self._stopped.is_set():
+                    moved = self.archive_batch(db)
+                    total += moved
+                    if moved < self.batch_size:
+                        break
+            finally:
+                db.close()
+        if total:
+            logger.log(LogLevel.INFO, "Archived terminal tasks", count=total)
+        return total
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.archive_expired()
+            except Exception as e:
+                logger.log(LogLevel.ERROR, f"Task archival failed: {str(e)}")
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="task-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,59 @@
+import json
+import math
+import os
+import platform
+import sys
+from datetime import datetime
+
+# Benchmarks import the server modules (database, main, ...) directly
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """
+    Returns the given percentile (0..1) of an already sorted list using the
+    nearest-rank method, or 0 for an empty list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize_latencies(latencies: list, elapsed: float, errors: int = 0) -> dict:
+    """
+    Summarizes a list of latencies in seconds into throughput and p50/p95/p99 in
+    milliseconds.
+    """
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "errors": errors,
+        "throughput_per_s": round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+    }
+
+
+def write_report(name: str, config: dict, results: dict, output: str = None):
+    """
+    Writes a machine-readable benchmark report as JSON to the output file, or to
+    stdout when no file is given.
+    """
+    report = {
+        "benchmark": name,
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
@@ -0,0 +1,325 @@
+"""
+Load benchmark for the task lifecycle: seeds a database with tasks, starts the job
+server (and the stub document service), then drives concurrent enqueue, claim,
+metrics, complete and read traffic against it and reports throughput, latency
+percentiles and duplicate claims as JSON.
+
+See benchmarks/README.md for how to run it.
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import requests
+
+from common import SERVER_DIR, summarize_latencies, write_report
+
+TASK_STATUSES = ["unclaimed", "claimed", "completed", "failed"]
+REQUESTER = "benchmark@example.com"
+
+
+class Recorder:
+    """
+    Collects per-operation latencies and errors from all worker threads.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.claimed_task_ids = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, operation: str, latency: float, ok: bool):
+        with self._lock:
+            if ok:
+                self.latencies[operation].append(latency)
+            else:
+                self.errors[operation] += 1
+
+    def record_claim(self, task_id: int):
+        with self._lock:
+            self.claimed_task_ids[task_id] += 1
+
+    def duplicate_claims(self) -> int:
+        return sum(count - 1 for count in self.claimed_task_ids.values() if count > 1)
+
+
+def timed(recorder: Recorder, operation: str, call):
+    """
+    Runs an HTTP call, records its latency under the operation name and returns the
+    decoded JSON body, or None when the call failed.
+    """
+    started = time.perf_counter()
+    try:
+        response = call()
+        body = response.json() if response.status_code == 200 else None
+    except requests.RequestException:
+        body = None
+    ok = body is not None and not (isinstance(body, dict) and body.get("status") is False)
+    recorder.record(operation, time.perf_counter() - started, ok)
+    return body
+
+
+def seed(task_count: int, task_types: list) -> list:
+    """
+    Creates the task statuses and types if needed and inserts task_count unclaimed
+    tasks spread over the task types. Returns the revisions of the seeded tasks.
+    """
+    from database import Database, TaskDetail, TaskQueue, TaskStatus, TaskType
+    from main import get_parameter_checksum
+    from utils import get_env_var
+
+    db = Database(
+        db_host=get_env_var("DB_HOST"),
+        db_name=get_env_var("DB_NAME"),
+        db_user=get_env_var("DB_USER"),
+        db_password=get_env_var("DB_PASSWORD"),
+    )
+    db.init_database()
+    session = db.SessionLocal()
+    try:
+        for model, names in ((TaskStatus, TASK_STATUSES), (TaskType, task_types)):
+            existing = {row.name for row in session.query(model).all()}
+            session.add_all(model(name=name) for name in names if name not in existing)
+        session.commit()
+
+        unclaimed_id = (
+            session.query(TaskStatus).filter(TaskStatus.name == "unclaimed").first().id
+        )
+        type_ids = [
+            row.id
+            for row in session.query(TaskType).filter(TaskType.name.in_(task_types))
+        ]
+        epoch_time = str(int(time.time()))
+        revisions = []
+        tasks = []
+        for index in range(task_count):
+            query = f"seed query {index}"
+            checksum = get_parameter_checksum(query)
+            revision = epoch_time + "_" + checksum
+            revisions.append(revision)
+            tasks.append(
+                dict(
+                    task_type_id=random.choice(type_ids),
+                    task_status_id=unclaimed_id,
+                    created_time=datetime.now(),
+                    parameter_checksum=checksum,
+                    revision=revision,
+                )
+            )
+        session.bulk_insert_mappings(TaskQueue, tasks, return_defaults=True)
+        session.bulk_insert_mappings(
+            TaskDetail,
+            [
+                dict(
+                    task_id=task["id"],
+                    query=f"seed query {index}",
+                    requested_by_user=REQUESTER,
+                )
+                for index, task in enumerate(tasks)
+            ],
+        )
+        session.commit()
+        return revisions
+    finally:
+        session.close()
+
+
+def start_process(command: list, env: dict, ready_url: str, timeout: float = 30):
+    process = subprocess.Popen(command, cwd=SERVER_DIR, env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(ready_url, timeout=1).status_code < 500:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{' '.join(command)} did not become ready in {timeout}s")
+
+
+def agent_worker(base_url, agent_id, task_types, recorder, deadline):
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        task_type = random.choice(task_types)
+        claimed = timed(
+            recorder,
+            "claim",
+            lambda: session.post(
+                f"{base_url}/tasks/claim",
+                params={"task_type": task_type, "agent_id": agent_id},
+            ),
+        )
+        if not claimed:
+            # Nothing to claim for this type right now
+            time.sleep(0.01)
+            continue
+
+        task_id = claimed["data"]["id"]
+        recorder.record_claim(task_id)
+        timed(
+            recorder,
+            "metrics",
+            lambda: session.put(
+                f"{base_url}/tasks/metrics/{task_id}",
+                json={"original_documents_retrieved": 1, "agent": agent_id},
+            ),
+        )
+        timed(
+            recorder,
+            "complete",
+            lambda: session.put(
+                f"{base_url}/tasks/complete",
+                params={
+                    "task_id": task_id,
+                    "success": True,
+                    "object_storage_key_for_results": f"benchmark/{task_id}",
+                },
+            ),
+        )
+
+
+def enqueue_worker(base_url, task_types, recorder, deadline):
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        timed(
+            recorder,
+            "enqueue",
+            lambda: session.put(
+                f"{base_url}/tasks",
+                params={
+                    "task_type": random.choice(task_types),
+                    "query": f"benchmark query {random.getrandbits(48)}",
+                    "requested_by_user": REQUESTER,
+                },
+            ),
+        )
+
+
+def reader_worker(base_url, revisions, discovery, recorder, deadline):
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        timed(recorder, "stats", lambda: session.get(f"{base_url}/tasks/stats"))
+        if discovery and revisions:
+            timed(
+                recorder,
+                "discovery",
+                lambda: session.get(
+                    f"{base_url}/DatasetDiscovery",
+                    params={"revision": random.choice(revisions)},
+                ),
+            )
+
+
+def run(args) -> dict:
+    task_types = args.task_types.split(",")
+    revisions = seed(args.tasks, task_types)
+
+    processes = []
+    base_url = args.base_url
+    try:
+        if not base_url:
+            env = dict(os.environ)
+            env.setdefault("PORT", str(args.port))
+            if args.discovery:
+                stub_url = f"http://127.0.0.1:{args.stub_port}"
+                processes.append(
+                    start_process(
+                        [sys.executable, "-m", "uvicorn", "stub_document_service:app",
+                         "--app-dir", "benchmarks", "--port", str(args.stub_port),
+                         "--log-level", "warning"],
+                        env,
+                        f"{stub_url}/text-document/task/0/docs/",
+                    )
+                )
+                env["DOCUMENT_SERVICE_URL"] = stub_url
+            base_url = f"http://127.0.0.1:{args.port}"
+            processes.append(
+                start_process(
+                    [sys.executable, "-m", "uvicorn", "main:app",
+                     "--port", str(args.port), "--log-level", "warning"],
+                    env,
+                    f"{base_url}/health/readiness",
+                )
+            )
+
+        recorder = Recorder()
+        started = time.monotonic()
+        deadline = started + args.duration
+        workers = [
+            threading.Thread(
+                target=agent_worker,
+                args=(base_url, f"agent-{index}", task_types, recorder, deadline),
+            )
+            for index in range(args.agents)
+        ]
+        workers += [
+            threading.Thread(
+                target=enqueue_worker, args=(base_url, task_types, recorder, deadline)
+            )
+            for _ in range(args.enqueuers)
+        ]
+        workers += [
+            threading.Thread(
+                target=reader_worker,
+                args=(base_url, revisions, args.discovery, recorder, deadline),
+            )
+            for _ in range(args.readers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - started
+
+        operations = set(recorder.latencies) | set(recorder.errors)
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "operations": {
+                operation: summarize_latencies(
+                    recorder.latencies[operation], elapsed, recorder.errors[operation]
+                )
+                for operation in sorted(operations)
+            },
+            "tasks_claimed": len(recorder.claimed_task_ids),
+            "duplicate_claims": recorder.duplicate_claims(),
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=1000, help="tasks to seed")
+    parser.add_argument("--task-types", default="fetch,extract,index")
+    parser.add_argument("--agents", type=int, default=8, help="claiming agents")
+    parser.add_argument("--enqueuers", type=int, default=2)
+    parser.add_argument("--readers", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument(
+        "--discovery",
+        action="store_true",
+        help="also benchmark /DatasetDiscovery against the stub document service",
+    )
+    parser.add_argument(
+        "--base-url", help="benchmark an already running server instead of starting one"
+    )
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--stub-port", type=int, default=8100)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    write_report("lifecycle", vars(args), run(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Micro benchmark of the task lifecycle: enqueues tasks, then claims, updates the
+metrics of and completes every one of them, in one thread, directly on the queue
+engines rather than over HTTP. It compares the in-memory queue (the scheduling
+logic alone) with the database queue, and with --handlers also runs both through
+the request handlers, to separate handler from database overhead.
+
+Runs the in-memory queue only by default; pass --database-url to also run the
+database queue, against SQLite or Postgres.
+"""
+import argparse
+import time
+from collections import defaultdict
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from common import summarize_latencies, write_report
+
+from database import Base, TaskStatus, TaskType
+from main import (
+    claim_task,
+    put_task,
+    task_completed,
+    update_job_progress_metrics,
+)
+from queue_engine import TASK_STATUSES, InMemoryQueueEngine, PostgresQueueEngine
+
+REQUESTER = "benchmark@example.com"
+
+
+class EngineCalls:
+    """
+    The lifecycle operations, called directly on a queue engine.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def enqueue(self, task_type: str, query: str):
+        self.queue.enqueue(task_type, query, REQUESTER)
+
+    def claim(self, task_type: str) -> dict:
+        return self.queue.claim(task_type, "benchmark-agent")
+
+    def metrics(self, task: dict) -> int:
+        return self.queue.update_metrics(
+            task["id"], {"original_documents_retrieved": 1}, task["version"]
+        )
+
+    def complete(self, task: dict, version: int):
+        self.queue.complete(task["id"], True, f"benchmark/{task['id']}", "", version)
+
+
+class HandlerCalls(EngineCalls):
+    """
+    The lifecycle operations, called through the request handlers with the queue
+    engine as their dependency.
+    """
+
+    def enqueue(self, task_type: str, query: str):
+        put_task(task_type, query, REQUESTER, None, None, queue=self.queue)
+
+    def claim(self, task_type: str) -> dict:
+        return claim_task(task_type, "benchmark-agent", queue=self.queue)["data"]
+
+    def metrics(self, task: dict) -> int:
+        return update_job_progress_metrics(
+            task["id"],
+            {"original_documents_retrieved": 1},
+            task["version"],
+            queue=self.queue,
+        )["version"]
+
+    def complete(self, task: dict, version: int):
+        task_completed(
+            task["id"], True, f"benchmark/{task['id']}", "", version, queue=self.queue
+        )
+
+
+def run_lifecycle(calls: EngineCalls, task_count: int, task_types: list) -> dict:
+    """
+    Enqueues task_count tasks spread over the task types, then claims, updates
+    and completes them all, timing every call.
+    """
+    latencies = defaultdict(list)
+    started = time.perf_counter()
+    for index in range(task_count):
+        call_started = time.perf_counter()
+        calls.enqueue(task_types[index % len(task_types)], f"benchmark query {index}")
+        latencies["enqueue"].append(time.perf_counter() - call_started)
+    for index in range(task_count):
+        call_started = time.perf_counter()
+        task = calls.claim(task_types[index % len(task_types)])
+        latencies["claim"].append(time.perf_counter() - call_started)
+
+        call_started = time.perf_counter()
+        version = calls.metrics(task)
+        latencies["metrics"].append(time.perf_counter() - call_started)
+
+        call_started = time.perf_counter()
+        calls.complete(task, version)
+        latencies["complete"].append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    results = {
+        operation: summarize_latencies(operation_latencies, sum(operation_latencies))
+        for operation, operation_latencies in latencies.items()
+    }
+    results["elapsed_s"] = round(elapsed, 3)
+    return results
+
+
+def create_lookups(Session, task_types: list):
+    with Session() as session:
+        for model, names in ((TaskStatus, TASK_STATUSES), (TaskType, task_types)):
+            existing = {row.name for row in session.query(model).all()}
+            session.add_all(model(name=name) for name in names if name not in existing)
+        session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=10000)
+    parser.add_argument("--task-types", default="fetch,extract,index")
+    parser.add_argument(
+        "--handlers",
+        action="store_true",
+        help="also run each queue through the request handlers",
+    )
+    parser.add_argument(
+        "--database-url", help="SQLAlchemy URL of a database to also benchmark"
+    )
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+    task_types = args.task_types.split(",")
+
+    queues = [("memory", lambda: InMemoryQueueEngine(task_types))]
+    if args.database_url:
+        engine = create_engine(args.database_url)
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine, autoflush=False)
+        create_lookups(Session, task_types)
+        queues.append(("database", lambda: PostgresQueueEngine(Session())))
+
+    results = {}
+    for name, create_queue in queues:
+        results[name] = run_lifecycle(
+            EngineCalls(create_queue()), args.tasks, task_types
+        )
+        if args.handlers:
+            results[f"{name}_handlers"] = run_lifecycle(
+                HandlerCalls(create_queue()), args.tasks, task_types
+            )
+
+    config = {key: value for key, value in vars(args).items() if key != "database_url"}
+    config["database"] = engine.dialect.name if args.database_url else None
+    write_report("scheduling", config, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Micro benchmark of the task listing serialization: compares loading full ORM
+objects and encoding them with jsonable_encoder and the json module (the previous
+/tasks implementation) with selecting only the listed columns as plain rows and
+encoding them with orjson (query_task_rows and FastJSONResponse).
+
+Runs offline against an in-memory SQLite database by default; pass
+--database-url to run it against Postgres.
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine
+from sqlalchemy.orm import joinedload, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from common import summarize_latencies, write_report
+
+from database import Base, TaskDetail, TaskQueue, TaskStatus, TaskType
+from main import TASK_LIST_FIELDS, query_task_rows
+from responses import FastJSONResponse
+
+
+def seed(session, row_count: int):
+    session.add_all(
+        [TaskStatus(id=1, name="unclaimed"), TaskStatus(id=2, name="completed")]
+    )
+    session.add(TaskType(id=1, name="fetch"))
+    session.commit()
+    now = datetime.now()
+    session.bulk_insert_mappings(
+        TaskQueue,
+        [
+            dict(
+                id=index + 1,
+                task_type_id=1,
+                task_status_id=1 + index % 2,
+                claimed_time=now,
+                claimed_by_agent="agent-1",
+                completed_time=now,
+                parameter_checksum="0" * 32,
+                revision=f"0_{index}",
+            )
+            for index in range(row_count)
+        ],
+    )
+    session.bulk_insert_mappings(
+        TaskDetail,
+        [
+            dict(
+                task_id=index + 1,
+                query=f"benchmark query {index}",
+                requested_by_user="benchmark@example.com",
+                message="m" * 1024,
+                notes="n" * 1024,
+                job_progress_metrics={"original_documents_retrieved": index},
+                object_storage_key_for_results=f"results/{index}",
+            )
+            for index in range(row_count)
+        ],
+    )
+    session.commit()
+
+
+def orm_listing(session) -> bytes:
+    task_types = {row.id: row.name for row in session.query(TaskType)}
+    task_statuses = {row.id: row.name for row in session.query(TaskStatus)}
+    result = [
+        {
+            "id": task.id,
+            "query": task.detail.query,
+            "task_type": task_types.get(task.task_type_id, ""),
+            "task_status": task_statuses.get(task.task_status_id, ""),
+            "requested_by_user": task.detail.requested_by_user,
+            "claimed_time": task.claimed_time,
+            "claimed_by_agent": task.claimed_by_agent,
+            "completed_time": task.completed_time,
+            "failed_time": task.failed_time,
+            "job_progress_metrics": task.detail.job_progress_metrics,
+            "object_storage_key_for_results": task.detail.object_storage_key_for_results,
+            "notes": task.detail.notes,
+        }
+        for task in session.query(TaskQueue).options(joinedload(TaskQueue.detail))
+    ]
+    return json.dumps(jsonable_encoder(result)).encode()
+
+
+def projected_listing(session) -> bytes:
+    rows = query_task_rows(session, TASK_LIST_FIELDS, {}, include_archive=False)
+    return FastJSONResponse(rows).body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--database-url", help="SQLAlchemy URL of an empty database (default SQLite)"
+    )
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.database_url:
+        engine = create_engine(args.database_url)
+    else:
+        engine = create_engine(
+            "sqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    with Session() as session:
+        seed(session, args.rows)
+
+    results = {}
+    listings = (
+        ("orm_jsonable_encoder", orm_listing),
+        ("projected_orjson", projected_listing),
+    )
+    for name, listing in listings:
+        latencies = []
+        for _ in range(args.repeat):
+            # A fresh session per run so the ORM identity map starts empty
+            with Session() as session:
+                started = time.perf_counter()
+                body = listing(session)
+                latencies.append(time.perf_counter() - started)
+        results[name] = summarize_latencies(latencies, sum(latencies))
+        results[name]["response_bytes"] = len(body)
+
+    results["speedup_p50"] = round(
+        results["orm_jsonable_encoder"]["p50_ms"]
+        / results["projected_orjson"]["p50_ms"],
+        2,
+    )
+    config = {key: value for key, value in vars(args).items() if key != "database_url"}
+    config["database"] = engine.dialect.name
+    write_report("serialization", config, results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+A stand-in for the document service used by /DatasetDiscovery, so discovery can be
+benchmarked offline. Every task has STUB_DOCUMENTS_PER_TASK text and original
+documents, each with STUB_DOCUMENT_SIZE bytes of content.
+
+Run with: python -m uvicorn stub_document_service:app --app-dir benchmarks --port 8100
+"""
+import os
+
+from fastapi import FastAPI
+
+DOCUMENTS_PER_TASK = int(os.getenv("STUB_DOCUMENTS_PER_TASK", 5))
+DOCUMENT_SIZE = int(os.getenv("STUB_DOCUMENT_SIZE", 2048))
+
+app = FastAPI(title="Stub document service")
+
+
+def document_ids(task_id: int) -> list:
+    return [task_id * 1000 + index for index in range(DOCUMENTS_PER_TASK)]
+
+
+@app.get("/{document_kind}/task/{task_id}/docs/")
+def task_documents(document_kind: str, task_id: int):
+    return {"data": document_ids(task_id)}
+
+
+@app.get("/{document_kind}/metadata/{doc_id}")
+def document_metadata(document_kind: str, doc_id: int):
+    return {
+        "data": {
+            "file_metadata": {
+                "document_id": doc_id,
+                "kind": document_kind,
+                "size": DOCUMENT_SIZE,
+            }
+        }
+    }
+
+
+@app.get("/{document_kind}/content/{doc_id}")
+def document_content(document_kind: str, doc_id: int):
+    return {"status": "true", "content": "x" * DOCUMENT_SIZE}
@@ -0,0 +1,314 @@
+import gzip
+import hashlib
+import json
+import os
+import queue
+import threading
+from typing import Optional
+
+import orjson
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from Logger import Logger, LogLevel
+from profiling import profiled_get
+
+DEFAULT_BUNDLE_DIR = "bundles"
+BUNDLE_COMPRESS_LEVEL = 6
+BUNDLE_READ_CHUNK_BYTES = 64 * 1024
+
+logger = Logger()
+
+
+def fetch_task_documents(document_service_url: str, task: dict) -> dict:
+    """
+    Fetches the text and original documents of a task, with their metadata and
+    content, from the document service.
+
+    Returns:
+    dict: The task with its original and text documents.
+    """
+    task_id = task["id"]
+
+    task_original_content = []
+    task_text_content = []
+
+    text_document_url = (
+        f"{document_service_url}/text-document/task/{task_id}/docs/"
+    )
+    # Include start_date and end_date parameters when calling the API
+    doc_response = profiled_get(
+        text_document_url,
+        # params={"start_date": start_date, "end_date": end_date},
+        params={"start_date": "", "end_date": ""},
+    )
+
+    if doc_response.status_code == 200:
+        doc_ids = doc_response.json().get("data", [])
+
+        # Step 3: Get content for each document and add it to the task object
+        task_text_content = []
+        for doc_id in doc_ids:
+            text_metadata_url = (
+                f"{document_service_url}/text-document/metadata/{doc_id}"
+            )
+            metadata_response = profiled_get(text_metadata_url)
+
+            if metadata_response.status_code == 200:
+                text_metadata = (
+                    metadata_response.json()
+                    .get("data", {})
+                    .get("file_metadata", {})
+                )
+            else:
+                text_metadata = {}
+
+            content_url = (
+                f"{document_service_url}/text-document/content/{doc_id}"
+            )
+
+            # Include start_date and end_date parameters when calling the API
+            content_response = profiled_get(
+                content_url,
+                # params={"start_date": start_date, "end_date": end_date},
+                params={"start_date": "", "end_date": ""},
+            )
+
+            if content_response.status_code == 200:
+                try:
+                    # Try to parse the content as JSON
+                    content_data = json.loads(content_response.text)
+                    if (
+                        "status" in content_data
+                        and content_data["status"] != "false"
+                    ):
+                        content = content_data.get("content", "")
+                    else:
+                        content = "Status is false in JSON content"
+                except json.JSONDecodeError:
+                    # If parsing as JSON fails, assume it's plain text
+                    content = content_response.text
+            else:
+                content = f"Failed to fetch content for Document ID {doc_id}"
+
+            task_text_content.append(
+                {
+                    "document_id": doc_id,
+                    "metadata": text_metadata,
+                    "content": content,
+                }
+            )
+    original_document_url = (
+        f"{document_service_url}/original-document/task/{task_id}/docs/"
+    )
+    # Include start_date and end_date parameters when calling the API
+    doc_response = profiled_get(
+        original_document_url,
+        # params={"start_date": start_date, "end_date": end_date},
+        params={"start_date": "", "end_date": ""},
+    )
+
+    if doc_response.status_code == 200:
+        doc_ids = doc_response.json().get("data", [])
+
+        # Step 3: Get content for each document and add it to the task object
+        task_original_content = []
+        for doc_id in doc_ids:
+            original_metadata_url = (
+                f"{document_service_url}/original-document/metadata/{doc_id}"
+            )
+            metadata_response = profiled_get(original_metadata_url)
+
+            if metadata_response.status_code == 200:
+                original_metadata = (
+                    metadata_response.json()
+                    .get("data", {})
+                    .get("file_metadata", {})
+                )
+            else:
+                original_metadata = {}
+
+            content_url = (
+                f"{document_service_url}/original-document/content/{doc_id}"
+            )
+
+            # # Include start_date and end_date parameters when calling the API
+            # content_response = profiled_get(
+            #     content_url,
+            #     params={"start_date": start_date, "end_date": end_date},
+            # )
+            # Include start_date and end_date parameters when calling the API
+            content_response = profiled_get(
+                content_url,
+                params={"start_date": "", "end_date": ""},
+            )
+
+            if content_response.status_code == 200:
+                try:
+                    # Try to parse the content as JSON
+                    content_data = json.loads(content_response.text)
+                    if (
+                        "status" in content_data
+                        and content_data["status"] != "false"
+                    ):
+                        content = content_data.get("content", "")
+                    else:
+                        content = "Status is false in JSON content"
+                except json.JSONDecodeError:
+                    # If parsing as JSON fails, assume it's plain text
+                    content = content_response.text
+            else:
+                content = f"Failed to fetch content for Document ID {doc_id}"
+
+            task_original_content.append(
+                {
+                    "document_id": doc_id,
+                    "metadata": original_metadata,
+                    "content": content,
+                }
+            )
+
+    return {
+        "task": task,
+        "original_content": task_original_content,
+        "text_content": task_text_content,
+    }
+
+
+def assemble_documents(document_service_url: str, tasks: list) -> list:
+    """
+    Fetches the documents of each task (see fetch_task_documents): the dataset of
+    a revision, as returned by /DatasetDiscovery.
+    """
+    return [fetch_task_documents(document_service_url, task) for task in tasks]
+
+
+class BundleStore:
+    """
+    Dataset bundles: the gzip-compressed /DatasetDiscovery response of a revision
+    whose tasks have all finished, stored under a directory by revision, and by
+    whether archived tasks are included and the ETag of the revision's tasks. A
+    bundle is never served once one of the tasks changed or was archived, since
+    that changes the ETag; the older bundles of the revision and variant are
+    removed when a new one is stored.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def variant(self, include_archive: bool) -> str:
+        return "archive" if include_archive else "live"
+
+    def path(self, revision: str, etag: str, include_archive: bool = False) -> str:
+        return os.path.join(
+            self.directory,
+            hashlib.sha256(revision.encode()).hexdigest(),
+            "{}-{}.json.gz".format(
+                self.variant(include_archive),
+                hashlib.sha256(etag.encode()).hexdigest()[:32],
+            ),
+        )
+
+    def get(
+        self, revision: str, etag: str, include_archive: bool = False
+    ) -> Optional[str]:
+        path = self.path(revision, etag, include_archive)
+        return path if os.path.exists(path) else None
+
+    def put(
+        self, revision: str, etag: str, content: list, include_archive: bool = False
+    ) -> str:
+        path = self.path(revision, etag, include_archive)
+        revision_dir, bundle_name = os.path.split(path)
+        variant_prefix = self.variant(include_archive) + "-"
+        os.makedirs(revision_dir, exist_ok=True)
+
+        # Written aside and renamed, so that readers never see a partial bundle
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(temp_path, "wb", compresslevel=BUNDLE_COMPRESS_LEVEL) as bundle:
+            bundle.write(orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS))
+        os.replace(temp_path, path)
+
+        for name in os.listdir(revision_dir):
+            if (
+                name != bundle_name
+                and name.startswith(variant_prefix)
+                and name.endswith(".json.gz")
+            ):
+                try:
+                    os.remove(os.path.join(revision_dir, name))
+                except FileNotFoundError:
+                    pass
+        return path
+
+
+def read_bundle(path: str):
+    with gzip.open(path, "rb") as bundle:
+        while True:
+            chunk = bundle.read(BUNDLE_READ_CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
+
+
+def bundle_response(request: Request, path: str) -> Response:
+    """
+    Serves a bundle as it is stored, gzip-encoded, to the clients that accept it,
+    and decompresses it on the fly for the others.
+    """
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return FileResponse(path, media_type="application/json", headers=headers)
+    return StreamingResponse(
+        read_bundle(path), media_type="application/json", headers=headers
+    )
+
+
+class BundleBuilder:
+    """
+    Builds the bundles of revisions on a background thread, one at a time, as
+    their tasks finish. A revision submitted again before its build started is
+    built once.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self._revisions = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def submit(self, revision: str):
+        with self._lock:
+            if revision in self._pending:
+                return
+            self._pending.add(revision)
+        self._revisions.put(revision)
+
+    def run(self):
+        while True:
+            revision = self._revisions.get()
+            if revision is None or self._stopped.is_set():
+                return
+            with self._lock:
+                self._pending.discard(revision)
+            try:
+                self.build(revision)
+            except Exception as e:
+                logger.log(
+                    LogLevel.ERROR,
+                    f"Bundle build failed: {str(e)}",
+                    revision=revision,
+                )
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="bundle-builder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._revisions.put(None)
+        if self._thread is not None:
+            self._thread.join()
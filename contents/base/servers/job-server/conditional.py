@@ -0,0 +1,81 @@
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from starlette.requests import Request
+from starlette.responses import Response
+
+from database import TaskQueue, TaskQueueArchive, task_filter_clauses
+
+
+def get_task_version(db: Session, task_filter: dict, include_archive: bool):
+    """
+    Computes the number of tasks matching a filter, the sum of their versions and
+    their latest updated_at, with one aggregate query per table instead of loading
+    the tasks.
+
+    updated_at is the start time of the updating transaction, so an update can
+    commit with an updated_at older than one already seen; every update increments
+    the task's version, so the version sum still changes.
+
+    Returns:
+    tuple: The task count, the version sum and the last modification time (None if
+    no task matches).
+    """
+    models = [TaskQueue, TaskQueueArchive] if include_archive else [TaskQueue]
+    count = 0
+    version_sum = 0
+    last_modified = None
+    for model in models:
+        model_count, model_version_sum, model_last_modified = (
+            db.query(
+                func.count(), func.sum(model.version), func.max(model.updated_at)
+            )
+            .filter(*task_filter_clauses(model, task_filter))
+            .one()
+        )
+        count += model_count
+        version_sum += model_version_sum or 0
+        if model_last_modified and (
+            last_modified is None or model_last_modified > last_modified
+        ):
+            last_modified = model_last_modified
+    return count, version_sum, last_modified
+
+
+def get_task_validator(versions: list) -> str:
+    """
+    Computes the ETag of a task listing from the versions (see get_task_version)
+    of the shards it was read from.
+
+    The ETag is the only validator: updated_at has the start time of the
+    updating transaction, so a Last-Modified date, compared to the second, would
+    answer 304 for tasks changed in the same second as the previous response or
+    committed late.
+    """
+    count = sum(version_count for version_count, _, _ in versions)
+    version_sum = sum(shard_version_sum for _, shard_version_sum, _ in versions)
+    last_modified = max(
+        (version_time for _, _, version_time in versions if version_time), default=None
+    )
+    version = last_modified.timestamp() if last_modified else 0
+    return f'"{count}-{version_sum}-{version}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """
+    Checks the request's If-None-Match header against the ETag of the current
+    representation. If-Modified-Since is ignored, as no Last-Modified is sent.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def add_validators(response: Response, etag: str) -> Response:
+    response.headers["ETag"] = etag
+    return response
+
+
+def not_modified_response(etag: str) -> Response:
+    return add_validators(Response(status_code=304), etag)
@@ -3,17 +3,26 @@ from sqlalchemy import (
     create_engine,
     Column,
     Integer,
+    SmallInteger,
     String,
     ForeignKey,
     DateTime,
     JSON,
+    or_,
+    select,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.sql import func
+from sqlalchemy.orm import sessionmaker, Session, declared_attr, relationship
+from sqlalchemy.sql import func, text
 from datetime import datetime
 from typing import Optional, List
+import contextlib
+import contextvars
 import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import requests
 import json
@@ -23,30 +32,246 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from utils import get_env_var
+from Logger import Logger, LogLevel
+from tracing import traced_span
 
 
 Base = declarative_base()
 
+DEFAULT_DB_POOL_SIZE = 5
+DEFAULT_DB_MAX_OVERFLOW = 10
+DEFAULT_DB_POOL_TIMEOUT_SECONDS = 30
+DEFAULT_DB_REPLICA_MAX_LAG_SECONDS = 5
+DEFAULT_DB_REPLICA_CHECK_INTERVAL_SECONDS = 5
+DB_REPLICA_CONNECT_TIMEOUT_SECONDS = 2
+
+# Seconds the replica is behind the primary; 0 once it has replayed all it received
+REPLICA_LAG_QUERY = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+def get_pool_capacity() -> int:
+    """
+    The most connections a database pool of this process opens at once, to each
+    shard and replica: DB_POOL_SIZE plus DB_MAX_OVERFLOW.
+    """
+    return int(get_env_var("DB_POOL_SIZE", DEFAULT_DB_POOL_SIZE)) + int(
+        get_env_var("DB_MAX_OVERFLOW", DEFAULT_DB_MAX_OVERFLOW)
+    )
+
+
+# Threads per shard that run the queries of scatter-gather requests
+GATHER_THREADS_PER_SHARD = 8
+
+_initialized_databases = set()
+
+# The shards shared by all requests of this process, see get_shards()
+_shards = None
+_shards_lock = threading.Lock()
+
+logger = Logger()
+
 
 class Database:
-    def __init__(self, db_host, db_name, db_user, db_password):
+    def __init__(
+        self,
+        db_host,
+        db_name,
+        db_user,
+        db_password,
+        shard_index=0,
+        shard_count=1,
+        replica_host=None,
+        replica_name=None,
+    ):
         self.db_host = db_host
         self.db_name = db_name
         self.db_user = db_user
         self.db_password = db_password
+        self.shard_index = shard_index
+        self.shard_count = shard_count
         self.engine = self.create_engine()
         self.SessionLocal = sessionmaker(
             autocommit=False, autoflush=False, bind=self.engine
         )
 
-    def create_engine(self):
+        # Optional read replica, used by read_session() while it keeps up
+        self.replica_engine = None
+        if replica_host:
+            self.replica_engine = self.create_engine(
+                replica_host,
+                replica_name or db_name,
+                connect_args={"connect_timeout": DB_REPLICA_CONNECT_TIMEOUT_SECONDS},
+            )
+            self.ReplicaSessionLocal = sessionmaker(
+                autocommit=False, autoflush=False, bind=self.replica_engine
+            )
+        self.replica_max_lag = float(
+            get_env_var("DB_REPLICA_MAX_LAG_SECONDS", DEFAULT_DB_REPLICA_MAX_LAG_SECONDS)
+        )
+        self.replica_check_interval = float(
+            get_env_var(
+                "DB_REPLICA_CHECK_INTERVAL_SECONDS",
+                DEFAULT_DB_REPLICA_CHECK_INTERVAL_SECONDS,
+            )
+        )
+        # None until the first check, so that its outcome is always logged
+        self._replica_usable = None
+        self._replica_checked_at = None
+        self._replica_check_lock = threading.Lock()
+
+    def create_engine(self, db_host=None, db_name=None, **kwargs):
         return create_engine(
-            f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}/{self.db_name}",
-            echo=True,
+            f"postgresql://{self.db_user}:{self.db_password}"
+            f"@{db_host or self.db_host}/{db_name or self.db_name}",
+            echo=get_env_var("DB_ECHO", "false").lower() == "true",
+            pool_size=int(get_env_var("DB_POOL_SIZE", DEFAULT_DB_POOL_SIZE)),
+            max_overflow=int(get_env_var("DB_MAX_OVERFLOW", DEFAULT_DB_MAX_OVERFLOW)),
+            pool_timeout=float(
+                get_env_var("DB_POOL_TIMEOUT_SECONDS", DEFAULT_DB_POOL_TIMEOUT_SECONDS)
+            ),
+            pool_pre_ping=True,
+            **kwargs,
         )
 
+    def warm_pool(self):
+        # Open the pooled connections up front so that the first requests after a
+        # start do not pay for connection setup.
+        connections = [self.engine.connect() for _ in range(self.engine.pool.size())]
+        for connection in connections:
+            connection.close()
+        # An unavailable replica must not keep the server from starting
+        self.replica_usable()
+
+    def replica_usable(self) -> bool:
+        """
+        Whether reads can go to the replica: it answers and is no more than
+        DB_REPLICA_MAX_LAG_SECONDS behind the primary. Checked at most every
+        DB_REPLICA_CHECK_INTERVAL_SECONDS; requests arriving meanwhile use the
+        last result instead of waiting for the check.
+        """
+        if self.replica_engine is None:
+            return False
+        checked_at = self._replica_checked_at
+        if checked_at is not None and (
+            time.monotonic() - checked_at < self.replica_check_interval
+        ):
+            return self._replica_usable
+        if not self._replica_check_lock.acquire(blocking=False):
+            return self._replica_usable
+        try:
+            try:
+                with self.replica_engine.connect() as connection:
+                    lag = connection.execute(text(REPLICA_LAG_QUERY)).scalar()
+                usable = lag <= self.replica_max_lag
+                reason = f"replica is {lag:.1f}s behind"
+            except Exception as e:
+                usable = False
+                reason = str(e)
+            if usable != self._replica_usable:
+                logger.log(
+                    LogLevel.INFO if usable else LogLevel.WARNING,
+                    "Reading from replica" if usable else "Reading from primary",
+                    reason=reason,
+                    shard_index=self.shard_index,
+                )
+            self._replica_usable = usable
+            self._replica_checked_at = time.monotonic()
+            return usable
+        finally:
+            self._replica_check_lock.release()
+
+    def read_session(self) -> Session:
+        """
+        A session for read-only work: on the replica when it is usable, else on
+        the primary.
+        """
+        if self.replica_usable():
+            return self.ReplicaSessionLocal()
+        return self.SessionLocal()
+
     def init_database(self):
+        # Schema setup only needs to happen once per process and database.
+        if self.engine.url in _initialized_databases:
+            return
         Base.metadata.create_all(bind=self.engine)
+        with self.engine.begin() as connection:
+            for statement in SCHEMA_UPGRADES:
+                connection.execute(text(statement))
+        try:
+            with self.engine.begin() as connection:
+                for statement in SEARCH_INDEXES:
+                    connection.execute(text(statement))
+        except Exception as e:
+            logger.log(
+                LogLevel.WARNING,
+                f"Task search indexes not created, searches scan the tasks: {str(e)}",
+            )
+        _initialized_databases.add(self.engine.url)
+
+    def get_last_task_id(self, connection) -> int:
+        return connection.execute(
+            text(
+                "SELECT GREATEST("
+                "(SELECT COALESCE(MAX(id), 0) FROM task_queue), "
+                "(SELECT COALESCE(MAX(id), 0) FROM task_queue_archive))"
+            )
+        ).scalar()
+
+    def interleave_task_ids(self, connection, last_id: int):
+        """
+        Makes the task ids of this shard step by the number of shards, starting
+        from its index, so that ids are unique across shards and (id - 1) modulo
+        the number of shards is the shard holding a task. Numbering continues
+        after last_id, the highest id on any shard. Runs on a connection holding
+        the task id lock of every shard (see interleave_task_ids).
+        """
+        sequence = connection.execute(
+            text("SELECT pg_get_serial_sequence('task_queue', 'id')")
+        ).scalar()
+        increment = connection.execute(
+            text(
+                "SELECT increment_by FROM pg_sequences "
+                "WHERE format('%I.%I', schemaname, sequencename) = :sequence"
+            ),
+            {"sequence": sequence},
+        ).scalar()
+        if increment == self.shard_count:
+            return
+        next_id = last_id + 1 + (self.shard_index - last_id) % self.shard_count
+        connection.execute(
+            text(
+                f"ALTER SEQUENCE {sequence} "
+                f"INCREMENT BY {self.shard_count} RESTART WITH {next_id}"
+            )
+        )
+
+
+def interleave_task_ids(databases: list):
+    """
+    Interleaves the task ids of the shards (see Database.interleave_task_ids).
+
+    Servers and their workers starting together do this concurrently, so every
+    shard's task_queue is first locked, in shard order, against inserts and other
+    servers doing the same. The sequences and the highest id are only read under
+    these locks, so no id handed out meanwhile is missed and a sequence restarted
+    by another server is left alone.
+    """
+    with contextlib.ExitStack() as stack:
+        connections = []
+        for database in databases:
+            connection = stack.enter_context(database.engine.connect())
+            stack.enter_context(connection.begin())
+            connection.execute(text("LOCK TABLE task_queue IN SHARE ROW EXCLUSIVE MODE"))
+            connections.append(connection)
+        last_id = max(
+            database.get_last_task_id(connection)
+            for database, connection in zip(databases, connections)
+        )
+        for database, connection in zip(databases, connections):
+            database.interleave_task_ids(connection, last_id)
 
 
 # SQLAlchemy models
@@ -64,34 +289,446 @@ class TaskType(Base):
     name = Column(String(256), nullable=False)
 
 
-class TaskQueue(Base):
-    __tablename__ = "task_queue"
+class TaskColumns:
+    """
+    Scheduling columns of a task: the ones claims, status updates and lookups
+    read and write. Shared by the live task queue and its archive.
+    """
+
+    # Column type of the task type and status ids
+    code_type = Integer
 
-    id = Column(Integer, primary_key=True, index=True)
-    query = Column(String(256), nullable=True)
-    task_type_id = Column(Integer, ForeignKey("task_type.id"), nullable=False)
     claimed_time = Column(DateTime, nullable=True)
     claimed_by_agent = Column(String(256), nullable=True)
-    task_status_id = Column(Integer, ForeignKey("task_status.id"), nullable=False)
-    message = Column(String(2048), nullable=True)
     completed_time = Column(DateTime, nullable=True)
     failed_time = Column(DateTime, nullable=True)
+    parameter_checksum = Column(String(256), nullable=True)
+    revision = Column(String(256), nullable=True)
+    # Parents of the task that have not completed yet; it is claimable at 0
+    pending_parent_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Incremented by every update, so that writers can update a task on the
+    # condition that nobody else did since they read it
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    created_time = Column(DateTime, nullable=True, server_default=func.now())
+    # Maintained on every update so that pollers can be answered with 304s
+    updated_at = Column(
+        DateTime, nullable=True, server_default=func.now(), onupdate=func.now()
+    )
+
+    @declared_attr
+    def task_type_id(cls):
+        return Column(cls.code_type, ForeignKey("task_type.id"), nullable=False)
+
+    @declared_attr
+    def task_status_id(cls):
+        return Column(cls.code_type, ForeignKey("task_status.id"), nullable=False)
+
+
+class TaskDetailColumns:
+    """
+    Descriptive and progress columns of a task, which only some responses read.
+    """
+
+    query = Column(String(256), nullable=True)
+    message = Column(String(2048), nullable=True)
     original_documents_retrieved = Column(Integer, nullable=True, default=0)
     text_documents_retrieved = Column(Integer, nullable=True, default=0)
     requested_by_user = Column(String(256), nullable=True)
     notes = Column(String(2048), nullable=True)
     job_progress_metrics = Column(JSON, nullable=True, default={})
     object_storage_key_for_results = Column(String(256), nullable=True)
-    parameter_checksum = Column(String(256), nullable=True)
-    revision = Column(String(256), nullable=True)
 
 
-def get_db():
+class TaskQueue(TaskColumns, Base):
+    """
+    The live tasks, with only their scheduling columns so that the rows claims
+    and status updates rewrite stay narrow. The other columns are in the task's
+    TaskDetail.
+    """
+
+    __tablename__ = "task_queue"
+
+    code_type = SmallInteger
+
+    id = Column(Integer, primary_key=True, index=True)
+    detail = relationship(
+        "TaskDetail",
+        uselist=False,
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+
+class TaskDetail(TaskDetailColumns, Base):
+    """
+    The descriptive and progress columns of a live task, one row per task.
+    """
+
+    __tablename__ = "task_detail"
+
+    task_id = Column(
+        Integer, ForeignKey("task_queue.id", ondelete="CASCADE"), primary_key=True
+    )
+
+
+# Names of the columns of a live task that are in task_detail
+TASK_DETAIL_FIELDS = frozenset(
+    column.name for column in TaskDetail.__table__.columns if column.name != "task_id"
+)
+
+
+class TaskQueueArchive(TaskColumns, TaskDetailColumns, Base):
+    """
+    Completed and failed tasks moved out of task_queue by the archiver, with
+    their details. Tasks keep their id when archived.
+    """
+
+    __tablename__ = "task_queue_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    archived_time = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class TaskDependency(Base):
+    """
+    An edge of the task graph: task_id can only be claimed once parent_task_id
+    has completed.
+    """
+
+    __tablename__ = "task_dependency"
+
+    task_id = Column(Integer, primary_key=True)
+    parent_task_id = Column(Integer, primary_key=True, index=True)
+
+
+# Idempotent DDL applied on start-up so that tables created by an older
+# version of the server pick up columns and indexes added since.
+SCHEMA_UPGRADES = [
+    "ALTER TABLE task_queue ADD COLUMN IF NOT EXISTS created_time TIMESTAMP DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_status_type "
+    "ON task_queue (task_status_id, task_type_id)",
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_terminal_time "
+    "ON task_queue (COALESCE(completed_time, failed_time))",
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_archive_revision "
+    "ON task_queue_archive (revision)",
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_archive_type_checksum "
+    "ON task_queue_archive (task_type_id, parameter_checksum)",
+    "ALTER TABLE task_queue ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT now()",
+    "ALTER TABLE task_queue_archive "
+    "ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT now()",
+    "ALTER TABLE task_queue "
+    "ADD COLUMN IF NOT EXISTS pending_parent_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE task_queue_archive "
+    "ADD COLUMN IF NOT EXISTS pending_parent_count INTEGER NOT NULL DEFAULT 0",
+    # Claims only look at tasks whose parents have all completed
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_ready "
+    "ON task_queue (task_type_id, task_status_id, id) WHERE pending_parent_count = 0",
+    # Tasks reach the archive roughly in finishing order, so a BRIN index of a few
+    # pages serves the time range scans of /tasks/report
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_archive_terminal_time "
+    "ON task_queue_archive USING brin ((COALESCE(completed_time, failed_time)))",
+    "ALTER TABLE task_queue ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    "ALTER TABLE task_queue_archive "
+    "ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    # Covers the ETag query of /JobStatus (count, sum of versions and latest
+    # updated_at per task type and checksum), so that 304s are answered from the
+    # index alone. It replaces ix_task_queue_type_checksum, which lacked version;
+    # the new name makes existing databases build it.
+    "DROP INDEX IF EXISTS ix_task_queue_type_checksum",
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_type_checksum_version "
+    "ON task_queue (task_type_id, parameter_checksum) INCLUDE (updated_at, version)",
+    # Move the detail columns of the live tasks to task_detail. Locked first, so
+    # that several servers starting together migrate the table once.
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'task_queue' AND column_name = 'notes'
+        ) THEN
+            LOCK TABLE task_queue IN ACCESS EXCLUSIVE MODE;
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                  AND table_name = 'task_queue' AND column_name = 'notes'
+            ) THEN
+                INSERT INTO task_detail (
+                    task_id, query, message, original_documents_retrieved,
+                    text_documents_retrieved, requested_by_user, notes,
+                    job_progress_metrics, object_storage_key_for_results
+                )
+                SELECT id, query, message, original_documents_retrieved,
+                       text_documents_retrieved, requested_by_user, notes,
+                       job_progress_metrics, object_storage_key_for_results
+                FROM task_queue
+                ON CONFLICT (task_id) DO NOTHING;
+                ALTER TABLE task_queue
+                    DROP COLUMN query,
+                    DROP COLUMN message,
+                    DROP COLUMN original_documents_retrieved,
+                    DROP COLUMN text_documents_retrieved,
+                    DROP COLUMN requested_by_user,
+                    DROP COLUMN notes,
+                    DROP COLUMN job_progress_metrics,
+                    DROP COLUMN object_storage_key_for_results;
+            END IF;
+        END IF;
+    END $$
+    """,
+    # Task type and status ids fit in two bytes
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'task_queue' AND column_name = 'task_status_id'
+              AND data_type = 'integer'
+        ) THEN
+            ALTER TABLE task_queue
+                ALTER COLUMN task_type_id TYPE SMALLINT,
+                ALTER COLUMN task_status_id TYPE SMALLINT;
+        END IF;
+    END $$
+    """,
+]
+
+
+class ShardRouter:
+    """
+    Routes tasks to the database shards holding them. Tasks are placed by task
+    type: with the shard set for the type in DB_SHARD_BY_TASK_TYPE, or else a
+    stable hash of the type name. Task ids are interleaved across shards (see
+    Database.interleave_task_ids), so the shard of a task follows from its id.
+    """
+
+    def __init__(self, databases: list, task_type_shards: dict):
+        self.databases = databases
+        self.task_type_shards = task_type_shards
+        self._executor = ThreadPoolExecutor(
+            max_workers=GATHER_THREADS_PER_SHARD * len(databases),
+            thread_name_prefix="shard",
+        )
+
+    def shard_for_task_type(self, task_type: str) -> int:
+        if task_type in self.task_type_shards:
+            return int(self.task_type_shards[task_type])
+        return zlib.crc32(task_type.encode()) % len(self.databases)
+
+    def shard_for_task_id(self, task_id: int) -> int:
+        return (task_id - 1) % len(self.databases)
+
+    def for_task_type(self, task_type: Optional[str]) -> Database:
+        if task_type is None:
+            return self.databases[0]
+        return self.databases[self.shard_for_task_type(task_type)]
+
+    def find_task(
+        self, task_id: int, skip: Optional[Database] = None
+    ) -> Optional[Database]:
+        """
+        Returns the shard holding a task, live or archived, or None if there is no
+        such task. The shard the id maps to is looked at first; the others only
+        hold ids assigned before the task queue was sharded. The shard given as
+        skip, already searched by the caller, is left out.
+        """
+        home = self.shard_for_task_id(task_id)
+        candidates = [self.databases[home]] + [
+            database for index, database in enumerate(self.databases) if index != home
+        ]
+        for database in candidates:
+            if database is skip:
+                continue
+            with database.engine.connect() as connection:
+                if connection.execute(
+                    text(
+                        "SELECT 1 FROM task_queue WHERE id = :id "
+                        "UNION ALL SELECT 1 FROM task_queue_archive WHERE id = :id"
+                    ),
+                    {"id": task_id},
+                ).first():
+                    return database
+        return None
+
+    def locate_task(self, task_id: int) -> Database:
+        """
+        Returns the shard holding a task, or the one its id maps to if it does not
+        exist. Does not query the database when there is a single shard.
+        """
+        if len(self.databases) == 1:
+            return self.databases[0]
+        return self.find_task(task_id) or self.databases[self.shard_for_task_id(task_id)]
+
+    def gather(self, fn, databases: list = None, read_only: bool = False) -> list:
+        """
+        Calls fn with a session of each given shard (all shards by default),
+        concurrently, and returns the results in shard order. Read-only calls
+        use the shards' replicas when they are usable.
+        """
+        databases = self.databases if databases is None else databases
+
+        def call(database):
+            db = database.read_session() if read_only else database.SessionLocal()
+            try:
+                with traced_span("shard", shard_index=database.shard_index):
+                    return fn(db)
+            finally:
+                db.close()
+
+        if len(databases) == 1:
+            return [call(databases[0])]
+        # Each call runs in a copy of the caller's context, so that its statements
+        # are profiled and traced as part of the caller's request
+        contexts = [contextvars.copy_context() for _ in databases]
+        return list(
+            self._executor.map(
+                lambda context, database: context.run(call, database),
+                contexts,
+                databases,
+            )
+        )
+
+
+# Trigram indexes backing substring search on query and notes. The pg_trgm
+# extension may need privileges the server lacks, so these are optional.
+SEARCH_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_task_detail_query_trgm "
+    "ON task_detail USING gin (query gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_task_detail_notes_trgm "
+    "ON task_detail USING gin (notes gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_archive_query_trgm "
+    "ON task_queue_archive USING gin (query gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_task_queue_archive_notes_trgm "
+    "ON task_queue_archive USING gin (notes gin_trgm_ops)",
+]
+
+
+def task_filter_clauses(model, task_filter: dict) -> list:
+    """
+    The conditions selecting the tasks of model (TaskQueue or TaskQueueArchive)
+    that match task_filter: each key is a column that must equal its value,
+    except "search", a substring to find in the query or the notes.
+    """
+    clauses = []
+    for key, value in task_filter.items():
+        if key == "search":
+            pattern = "%" + re.sub(r"([\\%_])", r"\\\1", value) + "%"
+            detail = TaskDetail if model is TaskQueue else model
+            matches = or_(
+                detail.query.ilike(pattern, escape="\\"),
+                detail.notes.ilike(pattern, escape="\\"),
+            )
+            if model is TaskQueue:
+                matches = model.id.in_(select(TaskDetail.task_id).where(matches))
+            clauses.append(matches)
+        else:
+            clauses.append(getattr(model, key) == value)
+    return clauses
+
+
+def create_database() -> Database:
     db = Database(
         db_host=get_env_var("DB_HOST"),
         db_name=get_env_var("DB_NAME"),
         db_user=get_env_var("DB_USER"),
         db_password=get_env_var("DB_PASSWORD"),
+        replica_host=get_env_var("DB_REPLICA_HOST", ""),
+        replica_name=get_env_var("DB_REPLICA_NAME", ""),
     )
     db.init_database()
-    return db.SessionLocal()
+    return db
+
+
+def create_shards() -> ShardRouter:
+    """
+    Creates the shards listed in DB_SHARDS, a JSON list of objects with the
+    host, name and optionally user and password (DB_USER and DB_PASSWORD by
+    default) of each shard's database, and the replica_host and replica_name of
+    its read replica. Without DB_SHARDS, the database set by DB_HOST and DB_NAME
+    is the only shard.
+    """
+    shard_configs = json.loads(get_env_var("DB_SHARDS", "[]"))
+    if not shard_configs:
+        return ShardRouter([create_database()], {})
+
+    databases = []
+    for shard_index, shard_config in enumerate(shard_configs):
+        db = Database(
+            db_host=shard_config["host"],
+            db_name=shard_config["name"],
+            db_user=shard_config.get("user") or get_env_var("DB_USER"),
+            db_password=shard_config.get("password") or get_env_var("DB_PASSWORD"),
+            shard_index=shard_index,
+            shard_count=len(shard_configs),
+            replica_host=shard_config.get("replica_host"),
+            replica_name=shard_config.get("replica_name"),
+        )
+        db.init_database()
+        databases.append(db)
+
+    interleave_task_ids(databases)
+    return ShardRouter(databases, json.loads(get_env_var("DB_SHARD_BY_TASK_TYPE", "{}")))
+
+
+def get_shards() -> ShardRouter:
+    """
+    Returns the shards shared by this process, creating them on first use, so
+    that all requests draw their connections from one pool per shard.
+    """
+    global _shards
+    with _shards_lock:
+        if _shards is None:
+            _shards = create_shards()
+        return _shards
+
+
+def get_database() -> Database:
+    """
+    Returns the first shard, which is the only database when the task queue is
+    not sharded.
+    """
+    return get_shards().databases[0]
+
+
+def open_session(database: Database):
+    db = database.SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_db():
+    yield from open_session(get_database())
+
+
+def get_task_type_db(task_type: Optional[str] = None):
+    """
+    Session of the shard holding the tasks of the requested task_type.
+    """
+    yield from open_session(get_shards().for_task_type(task_type))
+
+
+def open_read_session(database: Database):
+    db = database.read_session()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_task_type_read_db(task_type: Optional[str] = None):
+    """
+    Read-only session of the shard holding the tasks of the requested task_type,
+    on its replica when usable.
+    """
+    yield from open_read_session(get_shards().for_task_type(task_type))
+
+
+def get_task_db(task_id: int):
+    """
+    Session of the shard holding the requested task_id.
+    """
+    yield from open_session(get_shards().locate_task(task_id))
@@ -0,0 +1,135 @@
+from datetime import datetime
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from database import TaskDependency, TaskDetail, TaskQueue, TaskQueueArchive
+from events import notify_task_event
+from lookups import get_task_status_id
+
+
+def count_pending_parents(db: Session, parent_task_ids: list) -> int:
+    """
+    Returns how many of the given parent tasks have not completed yet.
+
+    The live parents are locked FOR SHARE until the session commits, so that a
+    parent cannot complete between this count and the insert of the dependent
+    task without also releasing it. Raises ValueError when a parent does not
+    exist or has failed.
+    """
+    completed_status_id = get_task_status_id(db, "completed")
+    failed_status_id = get_task_status_id(db, "failed")
+
+    parent_ids = set(parent_task_ids)
+    statuses = dict(
+        db.query(TaskQueue.id, TaskQueue.task_status_id)
+        .filter(TaskQueue.id.in_(parent_ids))
+        .order_by(TaskQueue.id)
+        .with_for_update(read=True)
+        .all()
+    )
+    missing = parent_ids - statuses.keys()
+    if missing:
+        # Archived tasks are final, they need no lock
+        statuses.update(
+            db.query(TaskQueueArchive.id, TaskQueueArchive.task_status_id)
+            .filter(TaskQueueArchive.id.in_(missing))
+            .all()
+        )
+        missing = parent_ids - statuses.keys()
+    if missing:
+        raise ValueError(f"Invalid parent task id: {min(missing)}")
+
+    for parent_id, task_status_id in sorted(statuses.items()):
+        if task_status_id == failed_status_id:
+            raise ValueError(f"Parent task {parent_id} has failed")
+    return sum(
+        1 for task_status_id in statuses.values() if task_status_id != completed_status_id
+    )
+
+
+def add_dependencies(db: Session, task_id: int, parent_task_ids: list):
+    db.add_all(
+        TaskDependency(task_id=task_id, parent_task_id=parent_task_id)
+        for parent_task_id in set(parent_task_ids)
+    )
+
+
+def release_dependents(db: Session, task_id: int) -> list:
+    """
+    Counts a newly completed task off the pending parents of its unclaimed
+    dependents and sends a "ready" event for each one that has no pending parent
+    left. Dependents already failed by another parent are left alone.
+
+    Returns:
+    List[int]: The IDs of the dependents that became claimable.
+    """
+    dependents = db.scalars(
+        update(TaskQueue)
+        .where(
+            TaskQueue.id.in_(
+                select(TaskDependency.task_id).where(
+                    TaskDependency.parent_task_id == task_id
+                )
+            ),
+            TaskQueue.task_status_id == get_task_status_id(db, "unclaimed"),
+        )
+        .values(
+            pending_parent_count=TaskQueue.pending_parent_count - 1,
+            version=TaskQueue.version + 1,
+        )
+        .returning(TaskQueue),
+        execution_options={"synchronize_session": False},
+    ).all()
+
+    ready = [dependent for dependent in dependents if dependent.pending_parent_count == 0]
+    for dependent in ready:
+        notify_task_event(db, dependent, "ready", "unclaimed")
+    return [dependent.id for dependent in ready]
+
+
+def fail_dependents(db: Session, task_id: int) -> list:
+    """
+    Fails the unclaimed tasks that depend, directly or transitively, on a newly
+    failed task, since they can never become claimable.
+
+    Returns:
+    List[int]: The IDs of the dependents that were failed.
+    """
+    unclaimed_status_id = get_task_status_id(db, "unclaimed")
+    failed_status_id = get_task_status_id(db, "failed")
+
+    failed_ids = []
+    frontier = [task_id]
+    while frontier:
+        dependents = (
+            db.query(TaskQueue)
+            .filter(
+                TaskQueue.id.in_(
+                    select(TaskDependency.task_id).where(
+                        TaskDependency.parent_task_id.in_(frontier)
+                    )
+                ),
+                TaskQueue.task_status_id == unclaimed_status_id,
+            )
+            .order_by(TaskQueue.id)
+            .with_for_update()
+            .all()
+        )
+        for dependent in dependents:
+            dependent.task_status_id = failed_status_id
+            dependent.failed_time = datetime.now()
+            dependent.version += 1
+            notify_task_event(db, dependent, "failed", "failed")
+        # Flush so that a task reached again by a longer path is not failed twice
+        db.flush()
+        frontier = [dependent.id for dependent in dependents]
+        if frontier:
+            db.execute(
+                update(TaskDetail)
+                .where(TaskDetail.task_id.in_(frontier))
+                .values(message=f"Upstream task {task_id} failed"),
+                execution_options={"synchronize_session": False},
+            )
+        failed_ids += frontier
+    return failed_ids
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import select
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+import orjson
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from utils import get_env_var
+from Logger import Logger, LogLevel
+
+TASK_EVENTS_CHANNEL = "task_events"
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+MAX_NOTIFY_PAYLOAD_BYTES = 7900
+
+DEFAULT_SUBSCRIBER_QUEUE_SIZE = 100
+
+task_events_enabled = get_env_var("TASK_EVENTS_ENABLED", "true").lower() == "true"
+
+logger = Logger()
+
+
+def task_event_keys(task_event: dict) -> list:
+    """
+    The subscription keys an event is delivered to: its task id, its revision and
+    its (task type, parameter checksum) pair.
+    """
+    return [
+        ("task_id", task_event["task_id"]),
+        ("revision", task_event["revision"]),
+        ("checksum", task_event["task_type_id"], task_event["parameter_checksum"]),
+    ]
+
+
+class Subscription:
+    def __init__(self, keys: list, queue_size: int):
+        self.keys = keys
+        self.queue = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+
+class TaskEventBroker:
+    """
+    Fans task change events out to the subscribers connected to this process.
+
+    Subscriptions are indexed by key, so publishing an event only touches the
+    subscribers interested in it. Events can be published from any thread; they
+    are delivered on the event loop the subscribers live on.
+    """
+
+    def __init__(self, queue_size: int = DEFAULT_SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscriptions = defaultdict(set)
+        self._loop = None
+
+    def subscribe(self, keys: list) -> Subscription:
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(keys, self.queue_size)
+        for key in keys:
+            self._subscriptions[key].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        for key in subscription.keys:
+            subscribers = self._subscriptions.get(key)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[key]
+
+    def publish(self, task_event: dict):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._dispatch, task_event)
+
+    def _dispatch(self, task_event: dict):
+        subscriptions = set()
+        for key in task_event_keys(task_event):
+            subscriptions.update(self._subscriptions.get(key, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(task_event)
+            except asyncio.QueueFull:
+                # A subscriber that cannot keep up is disconnected rather than
+                # letting its backlog grow; it can resubscribe and resync.
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+
+
+broker = TaskEventBroker()
+
+
+def format_server_sent_event(event_name: str, data) -> str:
+    return f"event: {event_name}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+def task_event_payload(
+    task, event_name: str, task_status: str = None, job_progress_metrics=None
+) -> dict:
+    """
+    The change event of a task, as sent to subscribers.
+    """
+    return {
+        "event": event_name,
+        "task_id": task.id,
+        "task_status": task_status,
+        "version": task.version,
+        "task_type_id": task.task_type_id,
+        "parameter_checksum": task.parameter_checksum,
+        "revision": task.revision,
+        "job_progress_metrics": job_progress_metrics,
+        "time": datetime.now().isoformat(),
+    }
+
+
+def notify_task_event(
+    db: Session,
+    task,
+    event_name: str,
+    task_status: str = None,
+    job_progress_metrics=None,
+):
+    """
+    Queues a change notification for a task, to be sent when the session commits.
+    Does nothing when TASK_EVENTS_ENABLED is false.
+
+    On Postgres the event is sent with pg_notify inside the transaction, so every
+    server process listening on the channel receives it once the change is
+    committed. NOTIFY serializes the commits of the transactions that send one,
+    which is why it can be turned off. On other databases the event is published
+    to this process's subscribers.
+
+    The task's detail is not read: job_progress_metrics are only sent by the
+    events that change them.
+    """
+    if not task_events_enabled:
+        return
+    task_event = task_event_payload(task, event_name, task_status, job_progress_metrics)
+    payload = json.dumps(task_event, default=str)
+    if len(payload.encode()) > MAX_NOTIFY_PAYLOAD_BYTES:
+        task_event["job_progress_metrics"] = None
+        task_event["job_progress_metrics_truncated"] = True
+        payload = json.dumps(task_event, default=str)
+
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": TASK_EVENTS_CHANNEL, "payload": payload},
+        )
+    else:
+        db.info.setdefault("pending_task_events", []).append(task_event)
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending_task_events(session):
+    for task_event in session.info.pop("pending_task_events", []):
+        broker.publish(task_event)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_pending_task_events(session):
+    session.info.pop("pending_task_events", None)
+
+
+class PostgresEventListener:
+    """
+    Listens on the task events channel with a dedicated connection and publishes
+    the notifications to the broker. Reconnects after connection failures.
+    """
+
+    def __init__(self, get_database, reconnect_interval: float = 5):
+        self.get_database = get_database
+        self.engine = None
+        self.reconnect_interval = reconnect_interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def listen(self):
+        if self.engine is None:
+            self.engine = self.get_database().engine
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {TASK_EVENTS_CHANNEL}")
+            while not self._stopped.is_set():
+                if select.select([dbapi_connection], [], [], 1)[0]:
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        broker.publish(json.loads(notify.payload))
+        finally:
+            connection.invalidate()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.listen()
+            except Exception as e:
+                logger.log(LogLevel.ERROR, f"Task event listener failed: {str(e)}")
+                self._stopped.wait(self.reconnect_interval)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name="task-event-listener", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
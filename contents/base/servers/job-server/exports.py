@@ -0,0 +1,280 @@
+import queue
+import threading
+from datetime import datetime
+from typing import Optional
+
+from utils import get_env_var
+from Logger import Logger, LogLevel
+
+DEFAULT_EXPORT_BATCH_ROWS = 50000
+DEFAULT_EXPORT_WATERMARK_LAG_SECONDS = 60
+
+# Chunks buffered between the database and a slow client. COPY writes a row at
+# a time, so writes are gathered into chunks of EXPORT_CHUNK_BYTES.
+EXPORT_QUEUE_CHUNKS = 64
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+EXPORT_FORMATS = ("csv", "parquet")
+
+# Columns of the export, in order, with the task type and status names joined in.
+# The detail columns are read from the table aliased as {detail}.
+EXPORT_COLUMNS = """
+    t.id, {detail}.query, task_type.name AS task_type, task_status.name AS task_status,
+    t.claimed_time, t.claimed_by_agent, {detail}.message, t.completed_time,
+    t.failed_time, {detail}.original_documents_retrieved,
+    {detail}.text_documents_retrieved, {detail}.requested_by_user, {detail}.notes,
+    {detail}.job_progress_metrics::text AS job_progress_metrics,
+    {detail}.object_storage_key_for_results, t.parameter_checksum, t.revision,
+    t.created_time, t.updated_at
+"""
+
+# Parquet column types of the export columns
+PARQUET_COLUMNS = [
+    ("id", "int64"),
+    ("query", "string"),
+    ("task_type", "string"),
+    ("task_status", "string"),
+    ("claimed_time", "timestamp"),
+    ("claimed_by_agent", "string"),
+    ("message", "string"),
+    ("completed_time", "timestamp"),
+    ("failed_time", "timestamp"),
+    ("original_documents_retrieved", "int64"),
+    ("text_documents_retrieved", "int64"),
+    ("requested_by_user", "string"),
+    ("notes", "string"),
+    ("job_progress_metrics", "string"),
+    ("object_storage_key_for_results", "string"),
+    ("parameter_checksum", "string"),
+    ("revision", "string"),
+    ("created_time", "timestamp"),
+    ("updated_at", "timestamp"),
+]
+
+logger = Logger()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ChunkPipe:
+    """
+    A file-like object whose written chunks are read, in order, by another
+    thread. Writers block while the reader is EXPORT_QUEUE_CHUNKS behind, so
+    memory stays bounded, and fail once the reader has gone away.
+    """
+
+    def __init__(self):
+        self._chunks = queue.Queue(EXPORT_QUEUE_CHUNKS)
+        self._cancelled = threading.Event()
+        self._buffer = bytearray()
+        self.error = None
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        self._buffer += data
+        if len(self._buffer) >= EXPORT_CHUNK_BYTES:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        while True:
+            if self._cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self._chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    # Needed by writers, such as pyarrow's, that check for an open output stream
+    closed = False
+
+    def writable(self) -> bool:
+        return True
+
+    def close_writer(self):
+        try:
+            if self.error is None:
+                self.flush()
+        except ExportCancelled:
+            return
+        while not self._cancelled.is_set():
+            try:
+                self._chunks.put(None, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+
+def stream_export(produce):
+    """
+    Runs produce(pipe) on a background thread and yields the chunks it writes to
+    the pipe. An export that fails midway ends the response early, so that the
+    client sees a truncated transfer rather than a complete-looking file.
+    """
+    pipe = ChunkPipe()
+
+    def run():
+        try:
+            produce(pipe)
+        except ExportCancelled:
+            pass
+        except Exception as e:
+            logger.log(LogLevel.ERROR, f"Task export failed: {str(e)}")
+            pipe.error = e
+        finally:
+            pipe.close_writer()
+
+    threading.Thread(target=run, name="task-export", daemon=True).start()
+    try:
+        yield from pipe
+        if pipe.error is not None:
+            raise pipe.error
+    finally:
+        pipe.cancel()
+
+
+class TaskExporter:
+    """
+    Exports the tasks changed between two points in time, from every shard, as
+    CSV written by Postgres COPY or as Parquet built in row groups of
+    EXPORT_BATCH_ROWS rows.
+    """
+
+    def __init__(self, databases: list):
+        self.databases = databases
+        self.batch_rows = int(
+            get_env_var("EXPORT_BATCH_ROWS", DEFAULT_EXPORT_BATCH_ROWS)
+        )
+        self.watermark_lag = float(
+            get_env_var(
+                "EXPORT_WATERMARK_LAG_SECONDS", DEFAULT_EXPORT_WATERMARK_LAG_SECONDS
+            )
+        )
+
+    def get_watermark(self) -> datetime:
+        """
+        The upper bound of updated_at for this export, and the since of the next
+        one. It trails the databases' clocks by EXPORT_WATERMARK_LAG_SECONDS so
+        that rows of transactions still in flight are exported next time.
+        """
+        watermarks = []
+        for database in self.databases:
+            with database.engine.connect() as connection:
+                watermarks.append(
+                    connection.exec_driver_sql(
+                        "SELECT LOCALTIMESTAMP - make_interval(secs => %(lag)s)",
+                        {"lag": self.watermark_lag},
+                    ).scalar()
+                )
+        return min(watermarks)
+
+    def select_query(
+        self, cursor, table: str, since: Optional[datetime], until: datetime
+    ) -> str:
+        conditions = "t.updated_at <= %(until)s"
+        if since is not None:
+            conditions += " AND t.updated_at > %(since)s"
+        # Archived tasks keep their details in the same row
+        if table == "task_queue":
+            columns = EXPORT_COLUMNS.format(detail="d")
+            source = "task_queue AS t LEFT JOIN task_detail AS d ON d.task_id = t.id"
+        else:
+            columns = EXPORT_COLUMNS.format(detail="t")
+            source = f"{table} AS t"
+        return cursor.mogrify(
+            f"SELECT {columns} FROM {source} "
+            "JOIN task_type ON task_type.id = t.task_type_id "
+            "JOIN task_status ON task_status.id = t.task_status_id "
+            f"WHERE {conditions} ORDER BY t.id",
+            {"since": since, "until": until},
+        ).decode()
+
+    def tables(self, include_archive: bool) -> list:
+        return ["task_queue", "task_queue_archive"] if include_archive else ["task_queue"]
+
+    def connect(self, database):
+        # Exports read from the replica when it keeps up
+        if database.replica_usable():
+            return database.replica_engine.raw_connection()
+        return database.engine.raw_connection()
+
+    def write_csv(
+        self, out, since: Optional[datetime], until: datetime, include_archive: bool
+    ):
+        header = True
+        for database in self.databases:
+            connection = self.connect(database)
+            try:
+                with connection.cursor() as cursor:
+                    for table in self.tables(include_archive):
+                        query = self.select_query(cursor, table, since, until)
+                        cursor.copy_expert(
+                            f"COPY ({query}) TO STDOUT "
+                            f"WITH (FORMAT csv, HEADER {str(header).lower()})",
+                            out,
+                        )
+                        header = False
+                connection.rollback()
+            finally:
+                connection.close()
+
+    def write_parquet(
+        self, out, since: Optional[datetime], until: datetime, include_archive: bool
+    ):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {"int64": pa.int64(), "string": pa.string(), "timestamp": pa.timestamp("us")}
+        schema = pa.schema(
+            [(name, types[type_name]) for name, type_name in PARQUET_COLUMNS]
+        )
+        writer = pq.ParquetWriter(out, schema)
+        for database in self.databases:
+            connection = self.connect(database)
+            try:
+                for table in self.tables(include_archive):
+                    # A server-side cursor keeps only one batch of rows in memory
+                    with connection.cursor(name="task_export") as cursor:
+                        cursor.itersize = self.batch_rows
+                        cursor.execute(self.select_query(cursor, table, since, until))
+                        while True:
+                            rows = cursor.fetchmany(self.batch_rows)
+                            if not rows:
+                                break
+                            writer.write_table(
+                                pa.Table.from_pydict(
+                                    dict(zip(schema.names, map(list, zip(*rows)))),
+                                    schema=schema,
+                                )
+                            )
+                connection.rollback()
+            finally:
+                connection.close()
+        writer.close()
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+
+        return True
+    except ImportError:
+        return False
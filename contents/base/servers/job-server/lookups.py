@@ -0,0 +1,53 @@
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from cache import TTLCache
+from utils import get_env_var
+from database import TaskStatus, TaskType
+
+DEFAULT_LOOKUP_CACHE_TTL_SECONDS = 300
+
+
+class LookupCache:
+    """
+    Caches the name to id map of a small lookup table (task_type, task_status) so
+    that request handlers do not query it on every call. The map is reloaded
+    after LOOKUP_CACHE_TTL_SECONDS, or straight away when a name is missing. Each
+    database shard has its own map.
+    """
+
+    def __init__(self, model, ttl_seconds: float):
+        self.model = model
+        self._cache = TTLCache(ttl_seconds)
+
+    def load(self, db: Session) -> dict:
+        ids = {row.name: row.id for row in db.query(self.model.name, self.model.id)}
+        self._cache.set(str(db.get_bind().url), ids)
+        return ids
+
+    def get_id(self, db: Session, name: str) -> Optional[int]:
+        ids = self._cache.get(str(db.get_bind().url))
+        if ids is None or name not in ids:
+            ids = self.load(db)
+        return ids.get(name)
+
+
+lookup_cache_ttl = float(
+    get_env_var("LOOKUP_CACHE_TTL_SECONDS", DEFAULT_LOOKUP_CACHE_TTL_SECONDS)
+)
+task_types = LookupCache(TaskType, lookup_cache_ttl)
+task_statuses = LookupCache(TaskStatus, lookup_cache_ttl)
+
+
+def get_task_type_id(db: Session, name: str) -> Optional[int]:
+    return task_types.get_id(db, name)
+
+
+def get_task_status_id(db: Session, name: str) -> Optional[int]:
+    return task_statuses.get_id(db, name)
+
+
+def warm_lookup_caches(db: Session):
+    task_types.load(db)
+    task_statuses.load(db)
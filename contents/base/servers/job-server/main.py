@@ -1,22 +1,89 @@
+import asyncio
 import re
+from collections import defaultdict
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, Query, Form
+from fastapi import FastAPI, HTTPException, Depends, Query, Form, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
 
 from utils import get_env_var, ErrorCode
 from Logger import Logger, LogLevel
-from database import get_db, TaskStatus, TaskType, TaskQueue
-import requests
+from database import (
+    get_shards,
+    get_task_db,
+    get_task_type_db,
+    get_task_type_read_db,
+    task_filter_clauses,
+    TASK_DETAIL_FIELDS,
+    TaskDetail,
+    TaskStatus,
+    TaskType,
+    TaskQueue,
+    TaskQueueArchive,
+)
 
 import hashlib
 import time
 import json
 
-from md5 import MD5Generator
+from cache import TTLCache
+from lookups import get_task_status_id, get_task_type_id, warm_lookup_caches
+from serving import (
+    DEFAULT_SHUTDOWN_DRAIN_SECONDS,
+    DEFAULT_SHUTDOWN_READINESS_DELAY_SECONDS,
+    DrainingMiddleware,
+    ServerState,
+)
+from admission import (
+    BACKLOG_RETRY_AFTER_SECONDS,
+    AdmissionMiddleware,
+    BacklogLimit,
+)
+from archiver import TERMINAL_STATUSES, TaskArchiver
+from bundles import (
+    DEFAULT_BUNDLE_DIR,
+    BundleBuilder,
+    BundleStore,
+    assemble_documents,
+    bundle_response,
+)
+from events import (
+    PostgresEventListener,
+    broker,
+    format_server_sent_event,
+    task_events_enabled,
+)
+from profiling import ProfilingMiddleware, profiled_get
+from tracing import TracingMiddleware, setup_tracing, shutdown_tracing
+from reports import (
+    MAX_REPORT_BUCKETS,
+    MAX_REPORT_HOURS,
+    REPORT_BUCKET_SECONDS,
+    task_report,
+)
+from queue_engine import (
+    BacklogFull,
+    PostgresQueueEngine,
+    QueueEngine,
+    QueueError,
+    get_parameter_checksum,
+)
+from exports import EXPORT_FORMATS, TaskExporter, parquet_available, stream_export
+from responses import FastJSONResponse, retry_later_response
+from conditional import (
+    add_validators,
+    get_task_validator,
+    get_task_version,
+    is_not_modified,
+    not_modified_response,
+)
 
 # TODO : import logging
 
@@ -24,24 +91,142 @@ from md5 import MD5Generator
 
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = 8000
+DEFAULT_TASK_STATS_CACHE_TTL_SECONDS = 5
+DEFAULT_DOCUMENT_SERVICE_URL = "http://34.220.33.50:8000"
+DEFAULT_SSE_HEARTBEAT_SECONDS = 15
+MAX_TASK_PAGE_SIZE = 1000
+DEFAULT_SEARCH_PAGE_SIZE = 100
+
+# Fields returned for each task by the task listing endpoints
+TASK_LIST_FIELDS = [
+    "id",
+    "query",
+    "task_type",
+    "task_status",
+    "requested_by_user",
+    "claimed_time",
+    "claimed_by_agent",
+    "completed_time",
+    "failed_time",
+    "job_progress_metrics",
+    "object_storage_key_for_results",
+    "notes",
+]
+TASK_REVISION_LIST_FIELDS = TASK_LIST_FIELDS[:2] + ["revision"] + TASK_LIST_FIELDS[2:]
 
 EMAIL_PATTERN = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,4}$"
 
 
 host = get_env_var("HOST", DEFAULT_HOST)
 port = int(get_env_var("PORT", DEFAULT_PORT))
+document_service_url = get_env_var(
+    "DOCUMENT_SERVICE_URL", DEFAULT_DOCUMENT_SERVICE_URL
+).rstrip("/")
+task_stats_cache_ttl = float(
+    get_env_var("TASK_STATS_CACHE_TTL_SECONDS", DEFAULT_TASK_STATS_CACHE_TTL_SECONDS)
+)
+
+archive_enabled = get_env_var("ARCHIVE_ENABLED", "false").lower() == "true"
+bundles_enabled = get_env_var("BUNDLES_ENABLED", "false").lower() == "true"
+bundle_store = BundleStore(get_env_var("BUNDLE_DIR", DEFAULT_BUNDLE_DIR))
+bundle_builder = BundleBuilder(lambda revision: build_revision_bundle(revision))
+shutdown_drain_seconds = float(
+    get_env_var("SHUTDOWN_DRAIN_SECONDS", DEFAULT_SHUTDOWN_DRAIN_SECONDS)
+)
+shutdown_readiness_delay_seconds = float(
+    get_env_var(
+        "SHUTDOWN_READINESS_DELAY_SECONDS", DEFAULT_SHUTDOWN_READINESS_DELAY_SECONDS
+    )
+)
+sse_heartbeat_seconds = float(
+    get_env_var("SSE_HEARTBEAT_SECONDS", DEFAULT_SSE_HEARTBEAT_SECONDS)
+)
+search_page_size = min(
+    int(get_env_var("SEARCH_PAGE_SIZE", DEFAULT_SEARCH_PAGE_SIZE)), MAX_TASK_PAGE_SIZE
+)
+shard_count = max(1, len(json.loads(get_env_var("DB_SHARDS", "[]"))))
 
 #  Global scope variables initialization end
 
+
+server_state = ServerState()
+
+
+def warm_up():
+    """
+    Opens the database pools and loads the lookup caches of every shard so that
+    the first requests after a start are as fast as the following ones.
+    """
+    shards = get_shards()
+    for database in shards.databases:
+        database.warm_pool()
+    shards.gather(warm_lookup_caches)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_tracing()
+    server_state.drain_on_sigterm(shutdown_readiness_delay_seconds)
+    server_state.start_warm_up(warm_up)
+    archiver = TaskArchiver()
+    if archive_enabled:
+        archiver.start()
+    if bundles_enabled:
+        bundle_builder.start()
+    # One listener per shard, each created lazily so that start-up does not wait
+    # for the databases
+    event_listeners = [
+        PostgresEventListener(
+            lambda shard_index=shard_index: get_shards().databases[shard_index]
+        )
+        for shard_index in range(shard_count)
+    ]
+    if task_events_enabled:
+        for event_listener in event_listeners:
+            event_listener.start()
+    yield
+    await run_in_threadpool(server_state.drain, shutdown_drain_seconds)
+    for event_listener in event_listeners:
+        event_listener.stop()
+    archiver.stop()
+    bundle_builder.stop()
+    shutdown_tracing()
+
+
 app = FastAPI(
     title="Task Queue API",
     version="1.0.0",
     description="APIs to manage a task queue",
+    lifespan=lifespan,
 )
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(DrainingMiddleware, state=server_state)
+app.add_middleware(TracingMiddleware)
 
 # Create an instance of the Logger class
 logger = Logger()
 
+# Dashboards poll /tasks/stats; serve them from a short-lived cache
+task_stats_cache = TTLCache(task_stats_cache_ttl)
+
+backlog_limit = BacklogLimit()
+
+
+def get_task_type_queue(db: Session = Depends(get_task_type_db)) -> QueueEngine:
+    """
+    Task queue of the shard holding the tasks of the requested task_type.
+    """
+    return PostgresQueueEngine(db, backlog_limit, get_shards())
+
+
+def get_task_queue(db: Session = Depends(get_task_db)) -> QueueEngine:
+    """
+    Task queue of the shard holding the requested task_id.
+    """
+    return PostgresQueueEngine(db, backlog_limit, get_shards())
+
+
 @app.get("/echo")
 async def echo(message: str = Query(None, alias="message")):
     return {"message": message}
@@ -49,29 +234,42 @@ async def echo(message: str = Query(None, alias="message")):
 
 @app.get("/health/readiness")
 def health_check():
+    if not server_state.serving:
+        return JSONResponse(
+            {"status": "starting" if not server_state.draining else "draining"},
+            status_code=ErrorCode.UNAVAILABLE.value["code"],
+        )
     return {"status": "healthy"}
 
 
 @app.put("/tasks")
+@server_state.tracked
 def put_task(
     task_type: str,
     query: str,
     requested_by_user: str,
     notes: str = None,
-    db: Session = Depends(get_db),
+    parent_task_ids: Optional[List[int]] = Query(None),
+    queue: QueueEngine = Depends(get_task_type_queue),
 ):
     """
     Enqueues a new task in the task queue.
 
+    A task with parent tasks is only handed out by /tasks/claim once all of its
+    parents have completed, and is failed if one of them fails. When the task
+    type already has its maximum number of unclaimed tasks, the request gets a
+    503 with a Retry-After header.
+
     Args:
     - task_type (str): The type of the task.
     - query (str): The task query.
     - requested_by_user (str): The email of the user requesting the task.
     - notes (str, optional): Additional notes for the task.
-    - db (Session): The SQLAlchemy database session.
+    - parent_task_ids (List[int], optional): The IDs of the tasks this task depends on.
+    - queue (QueueEngine): The task queue of the task type.
 
     Returns:
-    dict: A dictionary containing the status and message.
+    dict: A dictionary containing the status, message and the new task's ID.
     """
 
     try:
@@ -83,69 +281,14 @@ def put_task(
                 "error_message": "Invalid requester email format",
             }
 
-        # Query the task_type_id
-        task_type_db = db.query(TaskType).filter(TaskType.name == task_type).first()
-        if not task_type_db:
-            return {
-                "status": False,
-                "error_code": ErrorCode.GENERAL.value["code"],
-                "error_message": "Invalid task type",
-            }
-
-        # Query the "unclaimed" task status
-        unclaimed_status = (
-            db.query(TaskStatus).filter(TaskStatus.name == "unclaimed").first()
-        )
-        if not unclaimed_status:
-            # TODO : add tp error log at every failure
-            return {
-                "status": False,
-                "error_code": ErrorCode.NOT_FOUND.value["code"],
-                "error_message": "Task status not found",
-            }
-
-        # encrypted_param = md5_hash(query)
-
-        input_json = {query}  # Your JSON data
-        keys_to_exclude = []  # List of keys to exclude
-        delimiter = ","  # Your delimiter
-        print("MD5")
-        md5_gen = MD5Generator(input_json, keys_to_exclude, delimiter)
-
-        (
-            sorted_json,
-            concatenated_str,
-            trimmed_str,
-            lowercase_str,
-            encrypted_param,
-        ) = md5_gen.process_json()
-        print("MD5 code ", encrypted_param)
-        epoch_time = str(int(time.time()))
-        revision = epoch_time + "_" + encrypted_param
-
-        # Create a new task in the queue
-        new_task = TaskQueue(
-            query=query,
-            task_type_id=task_type_db.id,
-            claimed_time=None,
-            claimed_by_agent=None,
-            task_status_id=unclaimed_status.id,
-            message=None,
-            completed_time=None,
-            failed_time=None,
-            requested_by_user=requested_by_user,
-            notes=notes,
-            object_storage_key_for_results=None,
-            job_progress_metrics=None,
-            parameter_checksum=encrypted_param,
-            revision=revision,
+        task_id = queue.enqueue(
+            task_type, query, requested_by_user, notes, parent_task_ids
         )
-        db.add(new_task)
-        db.commit()
-        db.refresh(new_task)
-        print("sss ", new_task)
+        logger.log(LogLevel.DEBUG, "Task enqueued", task_id=task_id)
 
-        return {"status": True, "message": "Task enqueued"}
+        return {"status": True, "message": "Task enqueued", "task_id": task_id}
+    except QueueError as e:
+        return queue_error_response(e)
     except Exception as e:
         logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
         return {
@@ -156,75 +299,157 @@ def put_task(
 
 
 @app.post("/tasks/claim")
-def claim_task(task_type: str, agent_id: str, db: Session = Depends(get_db)):
+@server_state.tracked
+def claim_task(
+    task_type: str, agent_id: str, queue: QueueEngine = Depends(get_task_type_queue)
+):
     """
-    Claims an unclaimed task of a specific type for a given agent.
+    Claims an unclaimed task of a specific type for a given agent. Tasks with
+    parents that have not completed yet are skipped. The returned version can
+    be passed to the complete and metrics endpoints so that they only apply to
+    this claim.
 
     Args:
     - task_type (str): The type of the task to claim.
     - agent_id (str): The ID of the agent claiming the task.
-    - db (Session): The SQLAlchemy database session.
+    - queue (QueueEngine): The task queue of the task type.
 
     Returns:
     dict: A dictionary containing the status and data of the claimed task.
     """
 
     try:
-        task_type_db = db.query(TaskType).filter(TaskType.name == task_type).first()
-        if not task_type_db:
+        return {"status": True, "data": queue.claim(task_type, agent_id)}
+    except QueueError as e:
+        return queue_error_response(e)
+    except Exception as e:
+        logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
+        return {
+            "status": False,
+            "error_code": ErrorCode.GENERAL.value["code"],
+            "error_message": str(e),
+        }
+
+
+@app.get("/tasks")
+def get_tasks(
+    request: Request,
+    task_type: Optional[str] = None,
+    task_status: Optional[str] = None,
+    task_id: Optional[int] = None,
+    include_archive: bool = False,
+    search: Optional[str] = Query(None, min_length=1),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_TASK_PAGE_SIZE),
+    after_id: Optional[int] = None,
+):
+    """
+    Retrieves tasks based on optional filters.
+
+    Responses carry an ETag header; a request whose If-None-Match header still
+    matches gets a 304. Without a task type or task ID, the tasks of all shards
+    are returned.
+
+    Tasks are ordered by ID. To page through them, pass a limit and then the ID
+    of the last task received as after_id. Searches without a limit return a page
+    of SEARCH_PAGE_SIZE tasks.
+
+    Args:
+    - task_type (str, optional): The type of tasks to retrieve.
+    - task_status (str, optional): The status of tasks to retrieve.
+    - task_id (int, optional): The ID of the specific task to retrieve.
+    - include_archive (bool, optional): Whether to include archived tasks.
+    - search (str, optional): Text to find in the task query or notes, ignoring case.
+    - limit (int, optional): The maximum number of tasks to return; with a search,
+      SEARCH_PAGE_SIZE by default.
+    - after_id (int, optional): Only return tasks with a greater ID.
+
+    Returns:
+    List[dict]: A list of dictionaries containing task information.
+    """
+    if search is not None and limit is None:
+        limit = search_page_size
+    try:
+        databases = route_databases(task_type, task_id)
+
+        def get_filter(db: Session) -> dict:
+            task_filter = {}
+
+            if task_type is not None:
+                task_type_id = get_task_type_id(db, task_type)
+                if task_type_id is None:
+                    raise ValueError("Invalid task type")
+                task_filter["task_type_id"] = task_type_id
+
+            if task_status is not None:
+                task_status_id = get_task_status_id(db, task_status)
+                if task_status_id is None:
+                    raise ValueError("Invalid task status")
+                task_filter["task_status_id"] = task_status_id
+
+            if task_id is not None:
+                task_filter["id"] = task_id
+
+            if search is not None:
+                task_filter["search"] = search
+            return task_filter
+
+        try:
+            etag = gather_task_validator(
+                databases, get_filter, include_archive, read_only=True
+            )
+        except ValueError as e:
             return {
                 "status": False,
                 "error_code": ErrorCode.GENERAL.value["code"],
-                "error_message": "Invalid task type",
+                "error_message": str(e),
             }
-
-        unclaimed_status = (
-            db.query(TaskStatus).filter(TaskStatus.name == "unclaimed").first()
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+        # Filter tasks based on provided criteria, or retrieve all tasks if none
+        result = gather_task_rows(
+            databases,
+            TASK_LIST_FIELDS,
+            get_filter,
+            include_archive,
+            read_only=True,
+            limit=limit,
+            after_id=after_id,
         )
-        if not unclaimed_status:
-            return {
-                "status": False,
-                "error_code": ErrorCode.NOT_FOUND.value["code"],
-                "error_message": "Task status not found",
-            }
 
-        task_to_claim = (
-            db.query(TaskQueue)
-            .filter(
-                TaskQueue.task_type_id == task_type_db.id,
-                TaskQueue.task_status_id == unclaimed_status.id,
-            )
-            .order_by(TaskQueue.id)
-            .first()
-        )
+        return add_validators(FastJSONResponse(result), etag)
+    except Exception as e:
+        logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
+        return {
+            "status": False,
+            "error_code": ErrorCode.GENERAL.value["code"],
+            "error_message": str(e),
+        }
 
-        if not task_to_claim:
-            return {
-                "status": False,
-                "error_code": ErrorCode.NOT_FOUND.value["code"],
-                "error_message": "No unclaimed task found",
-            }
 
-        task_to_claim.task_status_id = (
-            db.query(TaskStatus).filter(TaskStatus.name == "claimed").first().id
-        )
-        task_to_claim.claimed_by_agent = agent_id
-        task_to_claim.claimed_time = datetime.now()
-        db.commit()
+@app.get("/tasks/stats")
+def get_task_stats():
+    """
+    Retrieves a summary of the task queue computed with aggregate queries on
+    every shard.
+
+    Results are cached for TASK_STATS_CACHE_TTL_SECONDS so that frequently
+    polling dashboards do not load the database.
 
+    Returns:
+    dict: A dictionary containing the status and the queue summary: task counts
+    per task type and status, the age in seconds of the oldest unclaimed task
+    per task type, and the number of active claims per agent.
+    """
+    try:
         return {
             "status": True,
-            "data": {
-                "id": task_to_claim.id,
-                "query": task_to_claim.query,
-                "task_type_id": task_to_claim.task_type_id,
-                "claimed_time": task_to_claim.claimed_time,
-                "claimed_by_agent": task_to_claim.claimed_by_agent,
-                "task_status_id": task_to_claim.task_status_id,
-                "message": task_to_claim.message,
-                "completed_time": task_to_claim.completed_time,
-                "failed_time": task_to_claim.failed_time,
-            },
+            "data": task_stats_cache.get_or_compute(
+                "task_stats",
+                lambda: merge_task_stats(
+                    get_shards().gather(compute_task_stats, read_only=True)
+                ),
+            ),
         }
     except Exception as e:
         logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
@@ -235,93 +460,204 @@ def claim_task(task_type: str, agent_id: str, db: Session = Depends(get_db)):
         }
 
 
-@app.get("/tasks")
-def get_tasks(
+def compute_task_stats(db: Session) -> dict:
+    now = datetime.now()
+
+    counts = (
+        db.query(TaskType.name, TaskStatus.name, func.count(TaskQueue.id))
+        .join(TaskType, TaskQueue.task_type_id == TaskType.id)
+        .join(TaskStatus, TaskQueue.task_status_id == TaskStatus.id)
+        .group_by(TaskType.name, TaskStatus.name)
+        .all()
+    )
+
+    oldest_unclaimed = (
+        db.query(TaskType.name, func.min(TaskQueue.created_time))
+        .join(TaskType, TaskQueue.task_type_id == TaskType.id)
+        .join(TaskStatus, TaskQueue.task_status_id == TaskStatus.id)
+        .filter(TaskStatus.name == "unclaimed")
+        .group_by(TaskType.name)
+        .all()
+    )
+
+    active_claims = (
+        db.query(TaskQueue.claimed_by_agent, func.count(TaskQueue.id))
+        .join(TaskStatus, TaskQueue.task_status_id == TaskStatus.id)
+        .filter(TaskStatus.name == "claimed")
+        .group_by(TaskQueue.claimed_by_agent)
+        .all()
+    )
+
+    return {
+        "counts": [
+            {"task_type": task_type, "task_status": task_status, "count": count}
+            for task_type, task_status, count in counts
+        ],
+        "oldest_unclaimed_age_seconds": {
+            task_type: (now - created_time).total_seconds() if created_time else None
+            for task_type, created_time in oldest_unclaimed
+        },
+        "active_claims_by_agent": {
+            agent: count for agent, count in active_claims
+        },
+        "generated_at": now,
+    }
+
+
+def merge_task_stats(shard_stats: list) -> dict:
+    """
+    Combines the task stats computed on each shard.
+    """
+    if len(shard_stats) == 1:
+        return shard_stats[0]
+
+    counts = defaultdict(int)
+    oldest_unclaimed = {}
+    active_claims = defaultdict(int)
+    for stats in shard_stats:
+        for entry in stats["counts"]:
+            counts[(entry["task_type"], entry["task_status"])] += entry["count"]
+        for task_type, age in stats["oldest_unclaimed_age_seconds"].items():
+            current = oldest_unclaimed.get(task_type)
+            if current is None or (age is not None and age > current):
+                oldest_unclaimed[task_type] = age
+        for agent, count in stats["active_claims_by_agent"].items():
+            active_claims[agent] += count
+
+    return {
+        "counts": [
+            {"task_type": task_type, "task_status": task_status, "count": count}
+            for (task_type, task_status), count in counts.items()
+        ],
+        "oldest_unclaimed_age_seconds": oldest_unclaimed,
+        "active_claims_by_agent": dict(active_claims),
+        "generated_at": min(stats["generated_at"] for stats in shard_stats),
+    }
+
+
+@app.get("/tasks/report")
+def get_task_report(
     task_type: Optional[str] = None,
-    task_status: Optional[str] = None,
-    task_id: Optional[int] = None,
-    db: Session = Depends(get_db),
+    hours: float = Query(24, gt=0, le=MAX_REPORT_HOURS),
+    bucket_seconds: int = 60,
 ):
     """
-    Retrieves tasks based on optional filters.
+    Retrieves a time series of the tasks finished per task type: the number of
+    tasks completed and failed, the failure rate and the 50th, 95th and 99th
+    percentiles of the claim to completion time, per time bucket.
+
+    The series is computed by the database; buckets that have closed are cached,
+    so repeated reports only recompute the current one.
 
     Args:
-    - task_type (str, optional): The type of tasks to retrieve.
-    - task_status (str, optional): The status of tasks to retrieve.
-    - task_id (int, optional): The ID of the specific task to retrieve.
-    - db (Session): The SQLAlchemy database session.
+    - task_type (str, optional): The type of tasks to report on (default all).
+    - hours (float, optional): How far back the report goes (default 24).
+    - bucket_seconds (int, optional): The length of a time bucket, one of 60, 300,
+      900, 3600, 21600 and 86400 seconds (default 60).
 
     Returns:
-    List[dict]: A list of dictionaries containing task information.
+    dict: A dictionary containing the status and the report rows, ordered by
+    bucket and task type.
     """
     try:
-        task_type_id = -1
-        task_filter = []
-
-        if task_type is not None:
-            task_type_db = db.query(TaskType).filter(TaskType.name == task_type).first()
-            if not task_type_db:
-                return {
-                    "status": False,
-                    "error_code": ErrorCode.GENERAL.value["code"],
-                    "error_message": "Invalid task type",
-                }
-            else:
-                task_type_id = task_type_db.id
-                task_filter.append(TaskQueue.task_type_id == task_type_id)
+        if bucket_seconds not in REPORT_BUCKET_SECONDS:
+            return {
+                "status": False,
+                "error_code": ErrorCode.GENERAL.value["code"],
+                "error_message": "bucket_seconds must be one of "
+                + ", ".join(str(seconds) for seconds in REPORT_BUCKET_SECONDS),
+            }
+        if hours * 3600 / bucket_seconds > MAX_REPORT_BUCKETS:
+            return {
+                "status": False,
+                "error_code": ErrorCode.GENERAL.value["code"],
+                "error_message": f"Reports are limited to {MAX_REPORT_BUCKETS} buckets",
+            }
 
-        if task_status is not None:
-            task_status_db = (
-                db.query(TaskStatus).filter(TaskStatus.name == task_status).first()
+        def report_shard(db: Session) -> list:
+            task_type_id = None
+            if task_type is not None:
+                task_type_id = get_task_type_id(db, task_type)
+                if task_type_id is None:
+                    raise ValueError("Invalid task type")
+            return task_report.get_series(db, task_type_id, bucket_seconds, hours)
+
+        try:
+            shard_series = get_shards().gather(
+                report_shard, route_databases(task_type), read_only=True
             )
-            if not task_status_db:
-                return {
-                    "status": False,
-                    "error_code": ErrorCode.GENERAL.value["code"],
-                    "error_message": "Invalid task status",
-                }
-            else:
-                task_status_id = task_status_db.id
-                task_filter.append(TaskQueue.task_status_id == task_status_id)
+        except ValueError as e:
+            return {
+                "status": False,
+                "error_code": ErrorCode.GENERAL.value["code"],
+                "error_message": str(e),
+            }
 
-        if task_id is not None:
-            task_filter.append(TaskQueue.id == task_id)
+        # Task types do not span shards, so the shards' rows are simply merged
+        series = [row for rows in shard_series for row in rows]
+        series.sort(key=lambda row: (row["bucket_start"], row["task_type"]))
+        return FastJSONResponse({"status": True, "data": series})
+    except Exception as e:
+        logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
+        return {
+            "status": False,
+            "error_code": ErrorCode.GENERAL.value["code"],
+            "error_message": str(e),
+        }
 
-        if not task_filter:
-            # If no specific task type or task ID provided, retrieve all tasks
-            tasks = db.query(TaskQueue).all()
-        else:
-            # Filter tasks based on provided criteria
-            tasks = db.query(TaskQueue).filter(*task_filter).all()
 
-        task_type_list = db.query(TaskType).all()
+@app.get("/tasks/export")
+def export_tasks(
+    format: str = "csv",
+    since: Optional[datetime] = None,
+    include_archive: bool = False,
+):
+    """
+    Exports the tasks of every shard, with their task type and status names, as
+    a CSV or Parquet file streamed straight from the database. The CSV is written
+    by Postgres COPY; Parquet requires pyarrow and is built in row groups of
+    EXPORT_BATCH_ROWS rows, so neither is held in memory.
 
-        task_status_list = db.query(TaskStatus).all()
+    Only the tasks updated up to the watermark returned in the X-Export-Watermark
+    header are exported; passing it as since to the next export returns only the
+    tasks updated after it.
 
-        # Create a list of dictionaries with selected fields
-        result = [
-            {
-                "id": task.id,
-                "query": task.query,
-                "task_type": get_task_type_name_by_id(
-                    task_type_list, task.task_type_id
-                ),
-                "task_status": get_task_status_name_by_id(
-                    task_status_list, task.task_status_id
-                ),
-                "requested_by_user": task.requested_by_user,
-                "claimed_time": task.claimed_time,
-                "claimed_by_agent": task.claimed_by_agent,
-                "completed_time": task.completed_time,
-                "failed_time": task.failed_time,
-                "job_progress_metrics": task.job_progress_metrics,
-                "object_storage_key_for_results": task.object_storage_key_for_results,
-                "notes": task.notes,
+    Args:
+    - format (str, optional): "csv" or "parquet" (default "csv").
+    - since (datetime, optional): Only export the tasks updated after this time.
+    - include_archive (bool, optional): Also export archived tasks (default False).
+
+    Returns:
+    StreamingResponse: The exported file.
+    """
+    try:
+        if format not in EXPORT_FORMATS:
+            return {
+                "status": False,
+                "error_code": ErrorCode.GENERAL.value["code"],
+                "error_message": "Invalid export format",
+            }
+        if format == "parquet" and not parquet_available():
+            return {
+                "status": False,
+                "error_code": ErrorCode.GENERAL.value["code"],
+                "error_message": "Parquet exports require pyarrow",
             }
-            for task in tasks
-        ]
 
-        return result
+        exporter = TaskExporter(get_shards().databases)
+        watermark = exporter.get_watermark()
+        if format == "csv":
+            write, media_type = exporter.write_csv, "text/csv"
+        else:
+            write, media_type = exporter.write_parquet, "application/vnd.apache.parquet"
+        return StreamingResponse(
+            stream_export(lambda out: write(out, since, watermark, include_archive)),
+            media_type=media_type,
+            headers={
+                "Content-Disposition": f'attachment; filename="tasks.{format}"',
+                "X-Export-Watermark": watermark.isoformat(),
+            },
+        )
     except Exception as e:
         logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
         return {
@@ -333,16 +669,22 @@ def get_tasks(
 
 @app.get("/JobStatus")
 def get_task_by_query(
+    request: Request,
     task_type: str = None,
     query: str = None,
-    db: Session = Depends(get_db),
+    include_archive: bool = False,
+    db: Session = Depends(get_task_type_read_db),
 ):
     """
     Retrieves tasks based on optional filters.
 
+    Responses carry an ETag header; a request whose If-None-Match header still
+    matches gets a 304.
+
     Args:
     - task_type (str): The type of tasks to retrieve.
     - query (str): Query param of task to retrieve.
+    - include_archive (bool, optional): Whether to include archived tasks.
     - db (Session): The SQLAlchemy database session.
 
     Returns:
@@ -350,22 +692,7 @@ def get_task_by_query(
     """
     try:
         task_type_id = -1
-        task_filter = []
-
-        # param_hash = md5_hash(query)
-
-        input_json = {query}  # Your JSON data
-        keys_to_exclude = []  # List of keys to exclude
-        delimiter = ","  # Your delimiter
-
-        md5_gen = MD5Generator(input_json, keys_to_exclude, delimiter)
-        (
-            sorted_json,
-            concatenated_str,
-            trimmed_str,
-            lowercase_str,
-            param_hash,
-        ) = md5_gen.process_json()
+        task_filter = {}
 
         if task_type is None:
             return {
@@ -374,17 +701,15 @@ def get_task_by_query(
                 "error_message": "Invalid task type",
             }
         else:
-            print("task type no None")
-            task_type_db = db.query(TaskType).filter(TaskType.name == task_type).first()
-            if not task_type_db:
+            task_type_id = get_task_type_id(db, task_type)
+            if task_type_id is None:
                 return {
                     "status": False,
                     "error_code": ErrorCode.GENERAL.value["code"],
                     "error_message": "Invalid task type",
                 }
             else:
-                task_type_id = task_type_db.id
-                task_filter.append(TaskQueue.task_type_id == task_type_id)
+                task_filter["task_type_id"] = task_type_id
 
         if query is None:
             return {
@@ -393,44 +718,19 @@ def get_task_by_query(
                 "error_message": "Invalid query",
             }
 
-        task_filter.append(TaskQueue.parameter_checksum == param_hash)
-
-        if not task_filter:
-            # If no specific task type or task ID provided, retrieve all tasks
-            tasks = db.query(TaskQueue).all()
-        else:
-            # Filter tasks based on provided criteria
-            tasks = db.query(TaskQueue).filter(*task_filter).all()
+        param_hash = get_parameter_checksum(query)
+        task_filter["parameter_checksum"] = param_hash
 
-        task_type_list = db.query(TaskType).all()
+        etag = get_task_validator([get_task_version(db, task_filter, include_archive)])
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
 
-        task_status_list = db.query(TaskStatus).all()
-
-        # Create a list of dictionaries with selected fields
-        result = [
-            {
-                "id": task.id,
-                "query": task.query,
-                "revision": task.revision,
-                "task_type": get_task_type_name_by_id(
-                    task_type_list, task.task_type_id
-                ),
-                "task_status": get_task_status_name_by_id(
-                    task_status_list, task.task_status_id
-                ),
-                "requested_by_user": task.requested_by_user,
-                "claimed_time": task.claimed_time,
-                "claimed_by_agent": task.claimed_by_agent,
-                "completed_time": task.completed_time,
-                "failed_time": task.failed_time,
-                "job_progress_metrics": task.job_progress_metrics,
-                "object_storage_key_for_results": task.object_storage_key_for_results,
-                "notes": task.notes,
-            }
-            for task in tasks
-        ]
+        # Filter tasks based on provided criteria, or retrieve all tasks if none
+        result = query_task_rows(
+            db, TASK_REVISION_LIST_FIELDS, task_filter, include_archive
+        )
 
-        return result
+        return add_validators(FastJSONResponse(result), etag)
     except Exception as e:
         logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
         return {
@@ -442,20 +742,27 @@ def get_task_by_query(
 
 @app.get("/DatasetDiscovery")
 def get_task_by_revision(
+    request: Request,
     revision: str = None,
-    db: Session = Depends(get_db),
+    include_archive: bool = False,
 ):
     """
-    Retrieves tasks based on optional filters.
+    Retrieves tasks based on optional filters, from all shards.
+
+    With BUNDLES_ENABLED, the response for a revision whose tasks have all
+    finished is served from the revision's bundle, which is built when it is
+    missing or out of date.
 
     Args:
+    - request (Request): The request, for its Accept-Encoding header.
     - revision (str): revision param of task to retrieve.
+    - include_archive (bool, optional): Whether to include archived tasks.
 
     Returns:
     List[dict]: A list of dictionaries containing task information.
     """
     try:
-        task_filter = []
+        task_filter = {}
 
         if revision is None:
             return {
@@ -464,219 +771,28 @@ def get_task_by_revision(
                 "error_message": "Invalid revision id",
             }
 
-        task_filter.append(TaskQueue.revision == revision)
-
-        if not task_filter:
-            # If no specific task type or task ID provided, retrieve all tasks
-            tasks = db.query(TaskQueue).all()
-        else:
-            # Filter tasks based on provided criteria
-            tasks = db.query(TaskQueue).filter(*task_filter).all()
-
-        task_type_list = db.query(TaskType).all()
-
-        task_status_list = db.query(TaskStatus).all()
-
-        # # Create a list of dictionaries with selected fields
-        # result = [
-        #     {
-        #         "id": task.id,
-        #         "query": task.query,
-        #         "revision": task.revision,
-        #         "task_type": get_task_type_name_by_id(
-        #             task_type_list, task.task_type_id
-        #         ),
-        #         "task_status": get_task_status_name_by_id(
-        #             task_status_list, task.task_status_id
-        #         ),
-        #         "requested_by_user": task.requested_by_user,
-        #         "claimed_time": task.claimed_time,
-        #         "claimed_by_agent": task.claimed_by_agent,
-        #         "completed_time": task.completed_time,
-        #         "failed_time": task.failed_time,
-        #         "job_progress_metrics": task.job_progress_metrics,
-        #         "object_storage_key_for_results": task.object_storage_key_for_results,
-        #         "notes": task.notes,
-        #     }
-        #     for task in tasks
-        # ]
-
-        # Create a list to store tasks with associated document content
-        tasks_with_content = []
-
-        task_type_list = db.query(TaskType).all()
-
-        task_status_list = db.query(TaskStatus).all()
-
-        # Step 2: Get document IDs for each completed task
-        for task in tasks:
-            task_id = task.id
-
-            task_original_content = []
-            task_text_content = []
-
-            text_document_url = (
-                f"http://34.220.33.50:8000/text-document/task/{task_id}/docs/"
-            )
-            # Include start_date and end_date parameters when calling the API
-            doc_response = requests.get(
-                text_document_url,
-                # params={"start_date": start_date, "end_date": end_date},
-                params={"start_date": "", "end_date": ""},
-            )
-
-            if doc_response.status_code == 200:
-                doc_ids = doc_response.json().get("data", [])
-
-                # Step 3: Get content for each document and add it to the task object
-                task_text_content = []
-                for doc_id in doc_ids:
-                    text_metadata_url = (
-                        f"http://34.220.33.50:8000/text-document/metadata/{doc_id}"
-                    )
-                    metadata_response = requests.get(text_metadata_url)
-
-                    if metadata_response.status_code == 200:
-                        text_metadata = (
-                            metadata_response.json()
-                            .get("data", {})
-                            .get("file_metadata", {})
-                        )
-                    else:
-                        text_metadata = {}
-
-                    content_url = (
-                        f"http://34.220.33.50:8000/text-document/content/{doc_id}"
-                    )
-
-                    # Include start_date and end_date parameters when calling the API
-                    content_response = requests.get(
-                        content_url,
-                        # params={"start_date": start_date, "end_date": end_date},
-                        params={"start_date": "", "end_date": ""},
-                    )
-
-                    if content_response.status_code == 200:
-                        try:
-                            # Try to parse the content as JSON
-                            content_data = json.loads(content_response.text)
-                            if (
-                                "status" in content_data
-                                and content_data["status"] != "false"
-                            ):
-                                content = content_data.get("content", "")
-                            else:
-                                content = "Status is false in JSON content"
-                        except json.JSONDecodeError:
-                            # If parsing as JSON fails, assume it's plain text
-                            content = content_response.text
-                    else:
-                        content = f"Failed to fetch content for Document ID {doc_id}"
-
-                    task_text_content.append(
-                        {
-                            "document_id": doc_id,
-                            "metadata": text_metadata,
-                            "content": content,
-                        }
-                    )
-            original_document_url = (
-                f"http://34.220.33.50:8000/original-document/task/{task_id}/docs/"
-            )
-            # Include start_date and end_date parameters when calling the API
-            doc_response = requests.get(
-                original_document_url,
-                # params={"start_date": start_date, "end_date": end_date},
-                params={"start_date": "", "end_date": ""},
-            )
-
-            if doc_response.status_code == 200:
-                doc_ids = doc_response.json().get("data", [])
+        task_filter["revision"] = revision
 
-                # Step 3: Get content for each document and add it to the task object
-                task_original_content = []
-                for doc_id in doc_ids:
-                    original_metadata_url = (
-                        f"http://34.220.33.50:8000/original-document/metadata/{doc_id}"
-                    )
-                    metadata_response = requests.get(original_metadata_url)
-
-                    if metadata_response.status_code == 200:
-                        original_metadata = (
-                            metadata_response.json()
-                            .get("data", {})
-                            .get("file_metadata", {})
-                        )
-                    else:
-                        original_metadata = {}
-
-                    content_url = (
-                        f"http://34.220.33.50:8000/original-document/content/{doc_id}"
-                    )
-
-                    # # Include start_date and end_date parameters when calling the API
-                    # content_response = requests.get(
-                    #     content_url,
-                    #     params={"start_date": start_date, "end_date": end_date},
-                    # )
-                    # Include start_date and end_date parameters when calling the API
-                    content_response = requests.get(
-                        content_url,
-                        params={"start_date": "", "end_date": ""},
-                    )
-
-                    if content_response.status_code == 200:
-                        try:
-                            # Try to parse the content as JSON
-                            content_data = json.loads(content_response.text)
-                            if (
-                                "status" in content_data
-                                and content_data["status"] != "false"
-                            ):
-                                content = content_data.get("content", "")
-                            else:
-                                content = "Status is false in JSON content"
-                        except json.JSONDecodeError:
-                            # If parsing as JSON fails, assume it's plain text
-                            content = content_response.text
-                    else:
-                        content = f"Failed to fetch content for Document ID {doc_id}"
-
-                    task_original_content.append(
-                        {
-                            "document_id": doc_id,
-                            "metadata": original_metadata,
-                            "content": content,
-                        }
-                    )
-
-            # Add the task with its associated document content to the list
-            tasks_with_content.append(
-                {
-                    "task": {
-                        "id": task.id,
-                        "query": task.query,
-                        "revision": task.revision,
-                        "task_type": get_task_type_name_by_id(
-                            task_type_list, task.task_type_id
-                        ),
-                        "task_status": get_task_status_name_by_id(
-                            task_status_list, task.task_status_id
-                        ),
-                        "requested_by_user": task.requested_by_user,
-                        "claimed_time": task.claimed_time,
-                        "claimed_by_agent": task.claimed_by_agent,
-                        "completed_time": task.completed_time,
-                        "failed_time": task.failed_time,
-                        "job_progress_metrics": task.job_progress_metrics,
-                        "object_storage_key_for_results": task.object_storage_key_for_results,
-                        "notes": task.notes,
-                    },
-                    "original_content": task_original_content,
-                    "text_content": task_text_content,
-                }
+        if bundles_enabled:
+            etag = gather_task_validator(
+                route_databases(), lambda db: task_filter, include_archive, read_only=True
             )
-        return tasks_with_content
+            bundle_path = bundle_store.get(revision, etag, include_archive)
+            if bundle_path is not None:
+                return bundle_response(request, bundle_path)
+
+        # Filter tasks based on provided criteria, or retrieve all tasks if none
+        tasks = gather_task_rows(
+            route_databases(),
+            TASK_REVISION_LIST_FIELDS,
+            lambda db: task_filter,
+            include_archive,
+            read_only=True,
+        )
+        tasks_with_content = assemble_documents(document_service_url, tasks)
+        if bundles_enabled and is_finished(tasks):
+            bundle_store.put(revision, etag, tasks_with_content, include_archive)
+        return FastJSONResponse(tasks_with_content)
     except Exception as e:
         logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
         return {
@@ -687,25 +803,33 @@ def get_task_by_revision(
 
 
 @app.put("/tasks/complete")
+@server_state.tracked
 def task_completed(
     task_id: int,
     success: bool,
     object_storage_key_for_results: Optional[str] = "",
     message: Optional[str] = "",
-    db: Session = Depends(get_db),
+    version: Optional[int] = None,
+    queue: QueueEngine = Depends(get_task_queue),
 ):
     """
-    Updates the status of a task to either completed or failed.
+    Updates the status of a task to either completed or failed. Completing a
+    task releases the tasks that depend on it; failing it fails them.
+
+    Only claimed tasks can be completed, and only unclaimed or claimed tasks can
+    be failed. With a version, the task must also still be at that version, so
+    that an agent whose claim was superseded cannot finish the task.
 
     Args:
     - task_id (int): The ID of the task to update.
     - success (bool): Whether the task was successful or not.
     - object_storage_key_for_results (str, optional): The key for storing results.
     - message (str, optional): Additional message regarding the task.
-    - db (Session): The SQLAlchemy database session.
+    - version (int, optional): The version of the task, as returned by the claim.
+    - queue (QueueEngine): The task queue holding the task.
 
     Returns:
-    dict: A dictionary containing the status and message.
+    dict: A dictionary containing the status, message and new version of the task.
     """
     try:
         if success and not object_storage_key_for_results:
@@ -715,32 +839,20 @@ def task_completed(
                 "error_message": "object_storage_key_for_results cannot be empty",
             }
 
-        task_to_update = db.query(TaskQueue).filter(TaskQueue.id == task_id).first()
-        if not task_to_update:
-            return {
-                "status": False,
-                "error_code": ErrorCode.NOT_FOUND.value["code"],
-                "error_message": "Task not found",
-            }
-
-        if success:
-            task_to_update.task_status_id = (
-                db.query(TaskStatus).filter(TaskStatus.name == "completed").first().id
-            )
-            task_to_update.object_storage_key_for_results = (
-                object_storage_key_for_results
-            )
-            task_to_update.completed_time = datetime.now()
-        else:
-            task_to_update.task_status_id = (
-                db.query(TaskStatus).filter(TaskStatus.name == "failed").first().id
-            )
-            task_to_update.failed_time = datetime.now()
+        completed = queue.complete(
+            task_id, success, object_storage_key_for_results, message, version
+        )
 
-        task_to_update.message = message
-        db.commit()
+        if bundles_enabled and completed["revision"]:
+            bundle_builder.submit(completed["revision"])
 
-        return {"status": True, "message": "Task status updated"}
+        return {
+            "status": True,
+            "message": "Task status updated",
+            "version": completed["version"],
+        }
+    except QueueError as e:
+        return queue_error_response(e)
     except Exception as e:
         logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
         return {
@@ -751,35 +863,122 @@ def task_completed(
 
 
 @app.put("/tasks/metrics/{task_id}")
+@server_state.tracked
 def update_job_progress_metrics(
-    task_id: int, job_progress_metrics: dict, db: Session = Depends(get_db)
+    task_id: int,
+    job_progress_metrics: dict,
+    version: Optional[int] = None,
+    queue: QueueEngine = Depends(get_task_queue),
 ):
     """
-    Updates the job progress metrics for a specific task.
+    Updates the job progress metrics of a claimed task. With a version, the task
+    must also still be at that version.
 
     Args:
     - task_id (int): The ID of the task to update.
     - job_progress_metrics (dict): The updated job progress metrics.
-    - db (Session): The SQLAlchemy database session.
+    - version (int, optional): The version of the task, as last returned.
+    - queue (QueueEngine): The task queue holding the task.
 
     Returns:
-    dict: A dictionary containing the status and message.
+    dict: A dictionary containing the status, message and new version of the task.
     """
     try:
-        # Retrieve the task by ID
-        task = db.query(TaskQueue).filter(TaskQueue.id == task_id).first()
+        new_version = queue.update_metrics(task_id, job_progress_metrics, version)
+
+        return {
+            "status": True,
+            "message": "Job progress metrics updated successfully",
+            "version": new_version,
+        }
+    except QueueError as e:
+        return queue_error_response(e)
+    except Exception as e:
+        logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
+        return {
+            "status": False,
+            "error_code": ErrorCode.GENERAL.value["code"],
+            "error_message": str(e),
+        }
+
 
-        if not task:
-            raise HTTPException(status_code=404, detail="Task not found")
+@app.get("/tasks/subscribe")
+async def subscribe_task_events(
+    request: Request,
+    task_id: Optional[int] = None,
+    revision: Optional[str] = None,
+    task_type: Optional[str] = None,
+    query: Optional[str] = None,
+    db: Session = Depends(get_task_type_db),
+):
+    """
+    Streams task status and metrics changes as Server-Sent Events.
+
+    Clients subscribe by task ID, by revision, or by task type and query. The
+    current state of the matching tasks is sent first as "snapshot" events, then
+    every change as a "claimed", "ready", "completed", "failed" or "metrics" event.
+    A client that falls too far behind receives a "resync" event and the stream
+    ends.
 
-        # Update the job_progress_metrics field with the provided data
-        task.job_progress_metrics = job_progress_metrics
+    Args:
+    - task_id (int, optional): The ID of the task to follow.
+    - revision (str, optional): The revision of the tasks to follow.
+    - task_type (str, optional): The type of the tasks to follow, with query.
+    - query (str, optional): Query param of the tasks to follow, with task_type.
+    - db (Session): The SQLAlchemy database session.
 
-        # Commit the changes to the database
-        db.commit()
-        db.refresh(task)
+    Returns:
+    StreamingResponse: A text/event-stream of task events.
+    """
+    if not task_events_enabled:
+        return {
+            "status": False,
+            "error_code": ErrorCode.UNAVAILABLE.value["code"],
+            "error_message": "Task events are disabled",
+        }
+    try:
+        keys = []
+        task_filter = {}
+        if task_id is not None:
+            keys.append(("task_id", task_id))
+            task_filter["id"] = task_id
+        if revision is not None:
+            keys.append(("revision", revision))
+            task_filter["revision"] = revision
+        if task_type is not None and query is not None:
+            task_type_id = await run_in_threadpool(get_task_type_id, db, task_type)
+            if task_type_id is None:
+                return {
+                    "status": False,
+                    "error_code": ErrorCode.GENERAL.value["code"],
+                    "error_message": "Invalid task type",
+                }
+            param_hash = get_parameter_checksum(query)
+            keys.append(("checksum", task_type_id, param_hash))
+            task_filter["task_type_id"] = task_type_id
+            task_filter["parameter_checksum"] = param_hash
+        if not keys:
+            return {
+                "status": False,
+                "error_code": ErrorCode.GENERAL.value["code"],
+                "error_message": "task_id, revision or task_type and query required",
+            }
 
-        return {"status": True, "message": "Job progress metrics updated successfully"}
+        # Subscribe before reading the snapshot so that no change is missed
+        subscription = broker.subscribe(keys)
+        try:
+            snapshot = await run_in_threadpool(
+                gather_task_rows,
+                route_databases(task_type, task_id),
+                TASK_REVISION_LIST_FIELDS,
+                lambda shard_db: task_filter,
+                False,
+            )
+        except Exception:
+            broker.unsubscribe(subscription)
+            raise
+        finally:
+            db.close()
     except Exception as e:
         logger.log(LogLevel.ERROR, f"An error occurred: {str(e)}")
         return {
@@ -788,6 +987,29 @@ def update_job_progress_metrics(
             "error_message": str(e),
         }
 
+    async def stream():
+        try:
+            for task in snapshot:
+                yield format_server_sent_event("snapshot", task)
+            while True:
+                if subscription.overflowed and subscription.queue.empty():
+                    yield format_server_sent_event("resync", {})
+                    break
+                try:
+                    task_event = await asyncio.wait_for(
+                        subscription.queue.get(), sse_heartbeat_seconds
+                    )
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_server_sent_event(task_event["event"], task_event)
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
 
 # TODO : use python black formatter
 
@@ -799,7 +1021,7 @@ def status(
     task_id: Optional[int] = None,
     query: Optional[str] = Query(None, description="Query filter"),
     db: Session = Depends(
-        get_db
+        get_task_type_read_db
     ),  # Assuming you have a function to get the database session
 ):
     """
@@ -826,8 +1048,8 @@ def status(
                 }
 
             # Query the task_type_id
-            task_type_db = db.query(TaskType).filter(TaskType.name == task_type).first()
-            if not task_type_db:
+            task_type_id = get_task_type_id(db, task_type)
+            if task_type_id is None:
                 return {
                     "status": False,
                     "error_code": ErrorCode.GENERAL.value["code"],
@@ -843,10 +1065,8 @@ def status(
                     "error_message": "task_status must be a string",
                 }
             # Query the "unclaimed" task status
-            task_status_db = (
-                db.query(TaskStatus).filter(TaskStatus.name == task_status).first()
-            )
-            if not task_status_db:
+            task_status_id = get_task_status_id(db, task_status)
+            if task_status_id is None:
                 return {
                     "status": False,
                     "error_code": ErrorCode.GENERAL.value["code"],
@@ -861,9 +1081,8 @@ def status(
                     "error_code": ErrorCode.GENERAL.value["code"],
                     "error_message": "task_id must be an integer",
                 }
-            # Check if task_id exists in TaskQueue table
-            task_in_db = db.query(TaskQueue).filter(TaskQueue.id == task_id).first()
-            if not task_in_db:
+            # Check if task_id exists on any shard
+            if get_shards().find_task(task_id) is None:
                 return {
                     "status": False,
                     "error_code": ErrorCode.GENERAL.value["code"],
@@ -895,7 +1114,7 @@ def status(
 
         # Step 1: Get completed tasks IDs by type (talkwalker)
         completed_tasks_url = f"http://127.0.0.1:8000/tasks{task_type_filter}"
-        response = requests.get(completed_tasks_url)
+        response = profiled_get(completed_tasks_url)
         if response.status_code == 200:
             completed_tasks = response.json()
 
@@ -924,18 +1143,158 @@ def status(
         }
 
 
-def get_task_type_name_by_id(task_type_list: list, task_type_id: int) -> str:
-    for task_type in task_type_list:
-        if task_type.id == task_type_id:
-            return task_type.name
-    return ""  # Return an empty string if the task type ID is not found
+# Fields of the task listings that are joined in from the lookup tables
+TASK_LOOKUP_COLUMNS = {
+    "task_type": TaskType.name,
+    "task_status": TaskStatus.name,
+}
+
+
+def build_revision_bundle(revision: str):
+    """
+    Builds the bundle of a revision, as served to /DatasetDiscovery without
+    include_archive, if its tasks have all finished and it has no current one.
+    """
+    task_filter = {"revision": revision}
+    etag = gather_task_validator(route_databases(), lambda db: task_filter, False)
+    if bundle_store.get(revision, etag) is not None:
+        return
+    tasks = gather_task_rows(
+        route_databases(), TASK_REVISION_LIST_FIELDS, lambda db: task_filter, False
+    )
+    if is_finished(tasks):
+        bundle_store.put(
+            revision, etag, assemble_documents(document_service_url, tasks)
+        )
+
+
+def is_finished(tasks: list) -> bool:
+    return bool(tasks) and all(task["task_status"] in TERMINAL_STATUSES for task in tasks)
+
+
+def queue_error_response(error: QueueError):
+    """
+    The response to a queue operation that did not apply. A full backlog gets a
+    503 with a Retry-After header.
+    """
+    if isinstance(error, BacklogFull):
+        return retry_later_response(
+            error.error_code, str(error), BACKLOG_RETRY_AFTER_SECONDS
+        )
+    return {
+        "status": False,
+        "error_code": error.error_code.value["code"],
+        "error_message": str(error),
+    }
+
+
+def route_databases(task_type: Optional[str] = None, task_id: Optional[int] = None):
+    """
+    The shards a task listing has to read: the one holding the task type or the
+    task when given, or else all of them.
+    """
+    shards = get_shards()
+    if task_type is not None:
+        return [shards.for_task_type(task_type)]
+    if task_id is not None:
+        return [shards.locate_task(task_id)]
+    return shards.databases
 
 
-def get_task_status_name_by_id(task_status_list: list, task_status_id: int) -> str:
-    for task_status in task_status_list:
-        if task_status.id == task_status_id:
-            return task_status.name
-    return ""  # Return an empty string if the task type ID is not found
+def gather_task_validator(
+    databases: list, get_filter, include_archive: bool, read_only: bool = False
+) -> str:
+    """
+    Computes the ETag of a task listing read from several shards.
+    get_filter returns the task filter to use on a given shard's session.
+    """
+    return get_task_validator(
+        get_shards().gather(
+            lambda db: get_task_version(db, get_filter(db), include_archive),
+            databases,
+            read_only,
+        )
+    )
+
+
+def gather_task_rows(
+    databases: list,
+    fields: list,
+    get_filter,
+    include_archive: bool,
+    read_only: bool = False,
+    limit: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> list:
+    """
+    Retrieves the given fields of the matching tasks of several shards,
+    queried concurrently, ordered by task ID. get_filter returns the task filter
+    to use on a given shard's session. Read-only listings are served by the
+    shards' replicas when they keep up. With a limit, only the first limit tasks
+    by ID after after_id are returned.
+    """
+    rows = []
+    for shard_rows in get_shards().gather(
+        lambda db: query_task_rows(
+            db, fields, get_filter(db), include_archive, limit, after_id
+        ),
+        databases,
+        read_only,
+    ):
+        rows += shard_rows
+    if len(databases) > 1:
+        rows.sort(key=lambda row: row["id"])
+    return rows[:limit]
+
+
+def query_task_rows(
+    db: Session,
+    fields: list,
+    task_filter: dict,
+    include_archive: bool,
+    limit: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> list:
+    """
+    Retrieves the given fields of the tasks matching task_filter (see
+    task_filter_clauses), from the live task queue and, if include_archive is set,
+    from the archive as well. Only the needed columns are selected, as plain rows,
+    and the task type and status names are joined in by the database.
+
+    With a limit, only the first limit tasks by ID after after_id are returned.
+
+    Returns:
+    List[dict]: A list of dictionaries with the fields in the given order.
+    """
+    models = [TaskQueue, TaskQueueArchive] if include_archive else [TaskQueue]
+    rows = []
+    for model in models:
+        # The details of live tasks are only joined in when a field needs them
+        detail = TaskDetail if model is TaskQueue else model
+        columns = [
+            TASK_LOOKUP_COLUMNS[field].label(field)
+            if field in TASK_LOOKUP_COLUMNS
+            else getattr(detail if field in TASK_DETAIL_FIELDS else model, field)
+            for field in fields
+        ]
+        model_query = (
+            db.query(*columns)
+            .join(TaskType, model.task_type_id == TaskType.id)
+            .join(TaskStatus, model.task_status_id == TaskStatus.id)
+            .filter(*task_filter_clauses(model, task_filter))
+        )
+        if detail is not model and TASK_DETAIL_FIELDS.intersection(fields):
+            model_query = model_query.outerjoin(
+                TaskDetail, TaskDetail.task_id == model.id
+            )
+        if after_id is not None:
+            model_query = model_query.filter(model.id > after_id)
+        if limit is not None:
+            model_query = model_query.order_by(model.id).limit(limit)
+        rows += model_query.all()
+    if include_archive:
+        rows.sort(key=lambda row: row.id)
+    return [dict(row._mapping) for row in rows[:limit]]
 
 
 # def md5_hash(input_string):
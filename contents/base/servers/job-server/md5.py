@@ -33,5 +33,4 @@ class MD5Generator:
         concatenated_str = self.concatenate_keys_and_values(sorted_json, self.delimiter)
         trimmed_str = concatenated_str.replace(" ", "")
         lowercase_str = trimmed_str.lower()
-        self.query_id = hashlib.md5(lowercase_str.encode()).hexdigest()
-        print("Query ID:", self.query_id)
\ No newline at end of file
+        self.query_id = hashlib.md5(lowercase_str.encode()).hexdigest()
\ No newline at end of file
@@ -0,0 +1,228 @@
+import contextvars
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import requests
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from utils import get_env_var
+from Logger import Logger, LogLevel
+from tracing import traced_get
+
+PROFILE_HEADER = "X-Profile"
+
+DEFAULT_PROFILE_SAMPLE_RATE = 0.0
+DEFAULT_PROFILE_SAMPLE_INTERVAL_MS = 5
+
+logger = Logger()
+
+# Profile of the request being handled, if it is being profiled
+_current_profile = contextvars.ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """
+    Time accounting for a single profiled request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.http_count = 0
+        self.http_time = 0.0
+        self._thread_ids = set()
+        self._lock = threading.Lock()
+
+    def add_thread(self):
+        """
+        Marks the calling thread as working on the request, so that the sampling
+        profiler samples it.
+        """
+        thread_id = threading.get_ident()
+        if thread_id not in self._thread_ids:
+            with self._lock:
+                self._thread_ids.add(thread_id)
+
+    def thread_ids(self) -> set:
+        with self._lock:
+            return set(self._thread_ids)
+
+    def record_sql(self, duration: float):
+        with self._lock:
+            self.sql_count += 1
+            self.sql_time += duration
+
+    def record_http(self, duration: float):
+        with self._lock:
+            self.http_count += 1
+            self.http_time += duration
+
+    def server_timing(self) -> str:
+        total = time.perf_counter() - self.started
+        return ", ".join(
+            [
+                f'sql;dur={self.sql_time * 1000:.2f};desc="{self.sql_count} statements"',
+                f'http;dur={self.http_time * 1000:.2f};desc="{self.http_count} requests"',
+                f"total;dur={total * 1000:.2f}",
+            ]
+        )
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the stacks of the threads working on a profiled request
+    and aggregates them in the collapsed format understood by flamegraph.pl and
+    speedscope. Threads handling other requests concurrently are left out.
+    """
+
+    def __init__(self, interval: float, profile: RequestProfile):
+        self.interval = interval
+        self.profile = profile
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in self.profile.thread_ids():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path: str):
+        with open(path, "w") as dump_file:
+            for stack, count in self.stacks.items():
+                dump_file.write(f"{stack} {count}\n")
+
+
+def current_profile() -> RequestProfile:
+    return _current_profile.get()
+
+
+def profiled_get(url: str, **kwargs) -> requests.Response:
+    """
+    Performs requests.get, accounting its time to the current request's profile
+    and tracing it when tracing is on.
+    """
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add_thread()
+    started = time.perf_counter()
+    try:
+        return traced_get(url, **kwargs)
+    finally:
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.record_http(time.perf_counter() - started)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add_thread()
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is not None and conn.info.get("profile_query_start"):
+        profile.record_sql(time.perf_counter() - conn.info["profile_query_start"].pop())
+
+
+class ProfilingMiddleware(BaseHTTPMiddleware):
+    """
+    Profiles a request when its X-Profile header matches PROFILE_SECRET or it is
+    picked by PROFILE_SAMPLE_RATE. The header is ignored while no secret is set, so
+    clients cannot make the server profile at will. Profiled responses get a Server-Timing header with the SQL
+    statement count and time and the outbound HTTP time. When PROFILE_DUMP_DIR is
+    set, a sampled stack dump of the request is also written to that directory;
+    the threads sampled are the ones running the request's SQL statements and
+    outbound HTTP calls.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.sample_rate = float(
+            get_env_var("PROFILE_SAMPLE_RATE", DEFAULT_PROFILE_SAMPLE_RATE)
+        )
+        self.sample_interval = (
+            float(
+                get_env_var(
+                    "PROFILE_SAMPLE_INTERVAL_MS", DEFAULT_PROFILE_SAMPLE_INTERVAL_MS
+                )
+            )
+            / 1000
+        )
+        self.dump_dir = get_env_var("PROFILE_DUMP_DIR", "")
+        self.secret = get_env_var("PROFILE_SECRET", "")
+
+    def should_profile(self, request) -> bool:
+        header = request.headers.get(PROFILE_HEADER)
+        if self.secret and header is not None:
+            if hmac.compare_digest(header.encode(), self.secret.encode()):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def dispatch(self, request, call_next):
+        if not self.should_profile(request):
+            return await call_next(request)
+
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        sampler = None
+        if self.dump_dir:
+            sampler = SamplingProfiler(self.sample_interval, profile)
+            sampler.start()
+        try:
+            response = await call_next(request)
+        finally:
+            _current_profile.reset(token)
+            if sampler is not None:
+                sampler.stop()
+
+        server_timing = profile.server_timing()
+        response.headers["Server-Timing"] = server_timing
+        logger.log(
+            LogLevel.INFO,
+            "Request profile",
+            method=request.method,
+            path=request.url.path,
+            sql_count=profile.sql_count,
+            server_timing=server_timing,
+        )
+
+        if sampler is not None:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            dump_name = "{}_{}_{}.folded".format(
+                datetime.now().strftime("%Y%m%dT%H%M%S%f"),
+                request.method,
+                request.url.path.strip("/").replace("/", "_") or "root",
+            )
+            sampler.dump(os.path.join(self.dump_dir, dump_name))
+
+        return response
@@ -0,0 +1,597 @@
+import heapq
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from admission import BacklogLimit
+from database import ShardRouter, TaskDetail, TaskQueue
+from dependencies import (
+    add_dependencies,
+    count_pending_parents,
+    fail_dependents,
+    release_dependents,
+)
+from events import (
+    broker,
+    notify_task_event,
+    task_event_payload,
+    task_events_enabled,
+)
+from lookups import get_task_status_id, get_task_type_id
+from md5 import MD5Generator
+from transitions import TASK_TRANSITIONS, describe_conflict, transition_task, update_task
+from utils import ErrorCode
+
+# Task statuses in the order of their ids in the in-memory queue
+TASK_STATUSES = ("unclaimed", "claimed", "completed", "failed")
+
+
+class QueueError(Exception):
+    """
+    A queue operation that does not apply, with the ErrorCode to answer it with.
+    """
+
+    def __init__(self, error_code: ErrorCode, message: str):
+        super().__init__(message)
+        self.error_code = error_code
+
+
+class BacklogFull(QueueError):
+    def __init__(self, task_type: str):
+        super().__init__(
+            ErrorCode.UNAVAILABLE, f"Backlog of task type {task_type} is full"
+        )
+
+
+def get_parameter_checksum(query: str) -> str:
+    """
+    Computes the checksum identifying a task's parameters. A query holding a JSON
+    object is hashed field by field, any other query as a single value.
+    """
+    try:
+        input_json = json.loads(query)
+    except json.JSONDecodeError:
+        input_json = None
+    if not isinstance(input_json, dict):
+        input_json = {"query": query}
+    return MD5Generator(input_json, ",").query_id
+
+
+def new_revision(parameter_checksum: str) -> str:
+    return str(int(time.time())) + "_" + parameter_checksum
+
+
+class QueueEngine:
+    """
+    The lifecycle of tasks: enqueue, claim, metrics updates and completion, with
+    task dependencies and versions. Operations that do not apply raise
+    QueueError.
+
+    PostgresQueueEngine runs it on a database session; InMemoryQueueEngine keeps
+    the queue in the process, for local development, tests and benchmarks of the
+    scheduling logic without a database.
+    """
+
+    def enqueue(
+        self,
+        task_type: str,
+        query: str,
+        requested_by_user: str,
+        notes: Optional[str] = None,
+        parent_task_ids: Optional[List[int]] = None,
+    ) -> int:
+        """
+        Adds an unclaimed task. A task with parent tasks is only claimable once
+        all of its parents have completed, and is failed if one of them fails.
+
+        Returns:
+        int: The ID of the new task.
+        """
+        raise NotImplementedError
+
+    def claim(self, task_type: str, agent_id: str) -> dict:
+        """
+        Claims the oldest claimable task of a task type for an agent.
+
+        Returns:
+        dict: The claimed task, with the version of the claim.
+        """
+        raise NotImplementedError
+
+    def complete(
+        self,
+        task_id: int,
+        success: bool,
+        object_storage_key_for_results: Optional[str] = None,
+        message: Optional[str] = None,
+        version: Optional[int] = None,
+    ) -> dict:
+        """
+        Completes or fails a task, releasing or failing its dependents. Only
+        claimed tasks can be completed and only unclaimed or claimed tasks can
+        be failed; with a version, the task must also still be at that version.
+
+        Returns:
+        dict: The new version and the revision of the task.
+        """
+        raise NotImplementedError
+
+    def update_metrics(
+        self, task_id: int, job_progress_metrics: dict, version: Optional[int] = None
+    ) -> int:
+        """
+        Updates the job progress metrics of a claimed task, at version if given.
+
+        Returns:
+        int: The new version of the task.
+        """
+        raise NotImplementedError
+
+
+class PostgresQueueEngine(QueueEngine):
+    """
+    Runs the task lifecycle on a database session, one transaction per
+    operation. Claims and transitions are conditional updates, so any number of
+    server processes can share the queue.
+
+    Args:
+    - db (Session): The session of the shard holding the tasks operated on.
+    - backlog_limit (BacklogLimit, optional): The unclaimed task limits.
+    - shards (ShardRouter, optional): The shards, to check that parent tasks are
+      on the shard of their dependents.
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        backlog_limit: Optional[BacklogLimit] = None,
+        shards: Optional[ShardRouter] = None,
+    ):
+        self.db = db
+        self.backlog_limit = backlog_limit
+        self.shards = shards
+
+    def check_parent_shards(self, task_type: str, parent_task_ids: list):
+        """
+        Rejects parents on another shard than the task type, once some parents
+        were not found on it: dependencies are counted and released within one
+        shard. Only the other shards are searched, so that the request never
+        holds a second connection to its own shard.
+        """
+        if self.shards is None or len(self.shards.databases) == 1:
+            return
+        shard = self.shards.for_task_type(task_type)
+        for parent_id in sorted(set(parent_task_ids)):
+            parent_shard = self.shards.find_task(parent_id, skip=shard)
+            if parent_shard is not None:
+                raise QueueError(
+                    ErrorCode.GENERAL,
+                    f"Parent task {parent_id} is on shard {parent_shard.shard_index} "
+                    f"and task type {task_type} on shard {shard.shard_index}; map "
+                    "the task types of a pipeline to one shard with "
+                    "DB_SHARD_BY_TASK_TYPE",
+                )
+
+    def get_task_type_id(self, task_type: str) -> int:
+        task_type_id = get_task_type_id(self.db, task_type)
+        if task_type_id is None:
+            raise QueueError(ErrorCode.GENERAL, "Invalid task type")
+        return task_type_id
+
+    def get_unclaimed_status_id(self) -> int:
+        unclaimed_status_id = get_task_status_id(self.db, "unclaimed")
+        if unclaimed_status_id is None:
+            raise QueueError(ErrorCode.NOT_FOUND, "Task status not found")
+        return unclaimed_status_id
+
+    def update_error(self, task_id: int) -> QueueError:
+        """
+        The error of a conditional task update that did not apply: not found, or
+        a conflict with the task's current status and version.
+        """
+        conflict = describe_conflict(self.db, task_id)
+        if conflict is None:
+            return QueueError(ErrorCode.NOT_FOUND, "Task not found")
+        return QueueError(ErrorCode.CONFLICT, conflict)
+
+    def enqueue(
+        self,
+        task_type: str,
+        query: str,
+        requested_by_user: str,
+        notes: Optional[str] = None,
+        parent_task_ids: Optional[List[int]] = None,
+    ) -> int:
+        task_type_id = self.get_task_type_id(task_type)
+        unclaimed_status_id = self.get_unclaimed_status_id()
+
+        if self.backlog_limit is not None and self.backlog_limit.is_full(
+            self.db, task_type, task_type_id, unclaimed_status_id
+        ):
+            raise BacklogFull(task_type)
+
+        pending_parent_count = 0
+        if parent_task_ids:
+            try:
+                pending_parent_count = count_pending_parents(self.db, parent_task_ids)
+            except ValueError as e:
+                self.check_parent_shards(task_type, parent_task_ids)
+                raise QueueError(ErrorCode.GENERAL, str(e))
+
+        parameter_checksum = get_parameter_checksum(query)
+        new_task = TaskQueue(
+            task_type_id=task_type_id,
+            claimed_time=None,
+            claimed_by_agent=None,
+            task_status_id=unclaimed_status_id,
+            completed_time=None,
+            failed_time=None,
+            created_time=datetime.now(),
+            parameter_checksum=parameter_checksum,
+            revision=new_revision(parameter_checksum),
+            pending_parent_count=pending_parent_count,
+            detail=TaskDetail(
+                query=query,
+                message=None,
+                requested_by_user=requested_by_user,
+                notes=notes,
+                object_storage_key_for_results=None,
+                job_progress_metrics=None,
+            ),
+        )
+        self.db.add(new_task)
+        if parent_task_ids:
+            self.db.flush()
+            add_dependencies(self.db, new_task.id, parent_task_ids)
+        self.db.commit()
+        return new_task.id
+
+    def claim(self, task_type: str, agent_id: str) -> dict:
+        task_type_id = self.get_task_type_id(task_type)
+        unclaimed_status_id = self.get_unclaimed_status_id()
+
+        # The oldest ready task that no concurrent claim has locked, picked by
+        # the claiming UPDATE itself, so that concurrent claimers get different
+        # tasks instead of queueing on the same row
+        next_ready_task_id = (
+            select(TaskQueue.id)
+            .where(
+                TaskQueue.task_type_id == task_type_id,
+                TaskQueue.task_status_id == unclaimed_status_id,
+                TaskQueue.pending_parent_count == 0,
+            )
+            .order_by(TaskQueue.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        task_to_claim = transition_task(
+            self.db,
+            next_ready_task_id,
+            "claimed",
+            claimed_by_agent=agent_id,
+            claimed_time=datetime.now(),
+        )
+        if task_to_claim is None:
+            raise QueueError(ErrorCode.NOT_FOUND, "No unclaimed task found")
+
+        notify_task_event(self.db, task_to_claim, "claimed", "claimed")
+        claimed_task = {
+            "id": task_to_claim.id,
+            "query": task_to_claim.detail.query,
+            "task_type_id": task_to_claim.task_type_id,
+            "claimed_time": task_to_claim.claimed_time,
+            "claimed_by_agent": task_to_claim.claimed_by_agent,
+            "task_status_id": task_to_claim.task_status_id,
+            "message": task_to_claim.detail.message,
+            "completed_time": task_to_claim.completed_time,
+            "failed_time": task_to_claim.failed_time,
+            "version": task_to_claim.version,
+        }
+        self.db.commit()
+        return claimed_task
+
+    def complete(
+        self,
+        task_id: int,
+        success: bool,
+        object_storage_key_for_results: Optional[str] = None,
+        message: Optional[str] = None,
+        version: Optional[int] = None,
+    ) -> dict:
+        if success:
+            task_status = "completed"
+            values = {
+                "object_storage_key_for_results": object_storage_key_for_results,
+                "completed_time": datetime.now(),
+            }
+        else:
+            task_status = "failed"
+            values = {"failed_time": datetime.now()}
+
+        task = transition_task(
+            self.db, task_id, task_status, version, message=message, **values
+        )
+        if not task:
+            raise self.update_error(task_id)
+
+        notify_task_event(self.db, task, task_status, task_status)
+        if success:
+            release_dependents(self.db, task_id)
+        else:
+            fail_dependents(self.db, task_id)
+        completed = {"version": task.version, "revision": task.revision}
+        self.db.commit()
+        return completed
+
+    def update_metrics(
+        self, task_id: int, job_progress_metrics: dict, version: Optional[int] = None
+    ) -> int:
+        task = update_task(
+            self.db,
+            task_id,
+            ("claimed",),
+            version,
+            job_progress_metrics=job_progress_metrics,
+        )
+        if not task:
+            raise self.update_error(task_id)
+
+        notify_task_event(
+            self.db, task, "metrics", job_progress_metrics=job_progress_metrics
+        )
+        new_version = task.version
+        self.db.commit()
+        return new_version
+
+
+class MemoryTask:
+    __slots__ = (
+        "id",
+        "task_type_id",
+        "task_status",
+        "query",
+        "message",
+        "claimed_time",
+        "claimed_by_agent",
+        "completed_time",
+        "failed_time",
+        "requested_by_user",
+        "notes",
+        "job_progress_metrics",
+        "object_storage_key_for_results",
+        "parameter_checksum",
+        "revision",
+        "pending_parent_count",
+        "version",
+        "created_time",
+        "dependents",
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+
+class InMemoryQueueEngine(QueueEngine):
+    """
+    Keeps the task queue in this process. Each task type has a heap of the IDs of
+    its claimable tasks, so a claim takes the oldest one in O(log n); tasks that
+    stop being claimable while in a heap, by failing, are skipped when they reach
+    its top. Nothing is persisted and task events are only published to this
+    process's subscribers.
+
+    Args:
+    - task_types (list): The names of the task types, given IDs 1..n in order.
+    - backlog_limit (BacklogLimit, optional): The unclaimed task limits.
+    """
+
+    def __init__(
+        self, task_types: list, backlog_limit: Optional[BacklogLimit] = None
+    ):
+        self.task_type_ids = {name: index for index, name in enumerate(task_types, 1)}
+        self.task_status_ids = {
+            name: index for index, name in enumerate(TASK_STATUSES, 1)
+        }
+        self.backlog_limit = backlog_limit
+        self.tasks = {}
+        self._ready = defaultdict(list)
+        self._unclaimed_counts = Counter()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def get_task_type_id(self, task_type: str) -> int:
+        task_type_id = self.task_type_ids.get(task_type)
+        if task_type_id is None:
+            raise QueueError(ErrorCode.GENERAL, "Invalid task type")
+        return task_type_id
+
+    def get_task(
+        self, task_id: int, from_statuses: tuple, version: Optional[int]
+    ) -> MemoryTask:
+        task = self.tasks.get(task_id)
+        if task is None:
+            raise QueueError(ErrorCode.NOT_FOUND, "Task not found")
+        if task.task_status not in from_statuses or (
+            version is not None and task.version != version
+        ):
+            raise QueueError(
+                ErrorCode.CONFLICT,
+                f"Task is {task.task_status} at version {task.version}",
+            )
+        return task
+
+    def publish(
+        self,
+        task: MemoryTask,
+        event_name: str,
+        task_status: str = None,
+        job_progress_metrics=None,
+    ):
+        if task_events_enabled:
+            broker.publish(
+                task_event_payload(task, event_name, task_status, job_progress_metrics)
+            )
+
+    def count_pending_parents(self, parent_task_ids: list) -> int:
+        parent_ids = set(parent_task_ids)
+        missing = parent_ids - self.tasks.keys()
+        if missing:
+            raise QueueError(
+                ErrorCode.GENERAL, f"Invalid parent task id: {min(missing)}"
+            )
+        for parent_id in sorted(parent_ids):
+            if self.tasks[parent_id].task_status == "failed":
+                raise QueueError(
+                    ErrorCode.GENERAL, f"Parent task {parent_id} has failed"
+                )
+        return sum(
+            1
+            for parent_id in parent_ids
+            if self.tasks[parent_id].task_status != "completed"
+        )
+
+    def enqueue(
+        self,
+        task_type: str,
+        query: str,
+        requested_by_user: str,
+        notes: Optional[str] = None,
+        parent_task_ids: Optional[List[int]] = None,
+    ) -> int:
+        task_type_id = self.get_task_type_id(task_type)
+        parameter_checksum = get_parameter_checksum(query)
+        with self._lock:
+            if self.backlog_limit is not None:
+                limit = self.backlog_limit.limit_for(task_type)
+                if 0 < limit <= self._unclaimed_counts[task_type_id]:
+                    raise BacklogFull(task_type)
+
+            pending_parent_count = (
+                self.count_pending_parents(parent_task_ids) if parent_task_ids else 0
+            )
+            task = MemoryTask(
+                id=self._next_id,
+                task_type_id=task_type_id,
+                task_status="unclaimed",
+                query=query,
+                requested_by_user=requested_by_user,
+                notes=notes,
+                parameter_checksum=parameter_checksum,
+                revision=new_revision(parameter_checksum),
+                pending_parent_count=pending_parent_count,
+                version=1,
+                created_time=datetime.now(),
+                dependents=[],
+            )
+            self._next_id += 1
+            self.tasks[task.id] = task
+            self._unclaimed_counts[task_type_id] += 1
+            for parent_id in set(parent_task_ids or ()):
+                self.tasks[parent_id].dependents.append(task)
+            if pending_parent_count == 0:
+                heapq.heappush(self._ready[task_type_id], task.id)
+            return task.id
+
+    def claim(self, task_type: str, agent_id: str) -> dict:
+        task_type_id = self.get_task_type_id(task_type)
+        with self._lock:
+            ready = self._ready[task_type_id]
+            while ready:
+                task = self.tasks[heapq.heappop(ready)]
+                if task.task_status == "unclaimed":
+                    break
+            else:
+                raise QueueError(ErrorCode.NOT_FOUND, "No unclaimed task found")
+
+            task.task_status = "claimed"
+            task.claimed_by_agent = agent_id
+            task.claimed_time = datetime.now()
+            task.version += 1
+            self._unclaimed_counts[task_type_id] -= 1
+            self.publish(task, "claimed", "claimed")
+            return {
+                "id": task.id,
+                "query": task.query,
+                "task_type_id": task.task_type_id,
+                "claimed_time": task.claimed_time,
+                "claimed_by_agent": task.claimed_by_agent,
+                "task_status_id": self.task_status_ids[task.task_status],
+                "message": task.message,
+                "completed_time": task.completed_time,
+                "failed_time": task.failed_time,
+                "version": task.version,
+            }
+
+    def complete(
+        self,
+        task_id: int,
+        success: bool,
+        object_storage_key_for_results: Optional[str] = None,
+        message: Optional[str] = None,
+        version: Optional[int] = None,
+    ) -> dict:
+        task_status = "completed" if success else "failed"
+        with self._lock:
+            task = self.get_task(task_id, TASK_TRANSITIONS[task_status], version)
+            if task.task_status == "unclaimed":
+                self._unclaimed_counts[task.task_type_id] -= 1
+            task.task_status = task_status
+            task.message = message
+            if success:
+                task.object_storage_key_for_results = object_storage_key_for_results
+                task.completed_time = datetime.now()
+            else:
+                task.failed_time = datetime.now()
+            task.version += 1
+            self.publish(task, task_status, task_status)
+            if success:
+                self.release_dependents(task)
+            else:
+                self.fail_dependents(task)
+            return {"version": task.version, "revision": task.revision}
+
+    def release_dependents(self, task: MemoryTask):
+        for dependent in task.dependents:
+            # Dependents failed by another parent stay failed
+            if dependent.task_status != "unclaimed":
+                continue
+            dependent.pending_parent_count -= 1
+            dependent.version += 1
+            if dependent.pending_parent_count == 0:
+                self.publish(dependent, "ready", "unclaimed")
+                heapq.heappush(self._ready[dependent.task_type_id], dependent.id)
+
+    def fail_dependents(self, task: MemoryTask):
+        message = f"Upstream task {task.id} failed"
+        frontier = [task]
+        while frontier:
+            failed = []
+            for parent in frontier:
+                for dependent in parent.dependents:
+                    if dependent.task_status != "unclaimed":
+                        continue
+                    dependent.task_status = "failed"
+                    dependent.failed_time = datetime.now()
+                    dependent.message = message
+                    dependent.version += 1
+                    self._unclaimed_counts[dependent.task_type_id] -= 1
+                    self.publish(dependent, "failed", "failed")
+                    failed.append(dependent)
+            frontier = failed
+
+    def update_metrics(
+        self, task_id: int, job_progress_metrics: dict, version: Optional[int] = None
+    ) -> int:
+        with self._lock:
+            task = self.get_task(task_id, ("claimed",), version)
+            task.job_progress_metrics = job_progress_metrics
+            task.version += 1
+            self.publish(task, "metrics", job_progress_metrics=job_progress_metrics)
+            return task.version
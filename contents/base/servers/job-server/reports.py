@@ -0,0 +1,187 @@
+import math
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+MAX_REPORT_HOURS = 24 * 31
+MAX_REPORT_BUCKETS = 50000
+
+# The bucket sizes a report can use: a minute, 5 and 15 minutes, an hour, 6 hours
+# and a day. Closed buckets are cached per bucket size, so sizes are not free-form.
+REPORT_BUCKET_SECONDS = (60, 300, 900, 3600, 21600, 86400)
+
+# Series of closed buckets kept, one per database, task type filter and bucket
+# size; the least recently used one is dropped beyond this.
+MAX_CACHED_SERIES = 256
+
+# A bucket is only cached once every task finishing in it has been committed;
+# this leaves time for the transactions still in flight when it ended.
+CLOSED_BUCKET_GRACE_SECONDS = 60
+
+DURATION_PERCENTILES = [0.5, 0.95, 0.99]
+
+# Tasks finished per task type and time bucket, over the live queue and the
+# archive. The ranges on COALESCE(completed_time, failed_time) use the
+# expression indexes on both tables.
+REPORT_QUERY = """
+SELECT task_type.name AS task_type,
+       floor(extract(epoch FROM finished.finished_time) / :bucket_seconds)
+           * :bucket_seconds AS bucket,
+       count(finished.completed_time) AS completed,
+       count(*) - count(finished.completed_time) AS failed,
+       percentile_cont(CAST(:percentiles AS double precision[])) WITHIN GROUP (
+           ORDER BY extract(epoch FROM finished.completed_time - finished.claimed_time)
+       ) AS durations
+FROM (
+    SELECT task_type_id, claimed_time, completed_time,
+           COALESCE(completed_time, failed_time) AS finished_time
+    FROM task_queue
+    WHERE COALESCE(completed_time, failed_time) >= :since
+      AND COALESCE(completed_time, failed_time) < :until {type_condition}
+    UNION ALL
+    SELECT task_type_id, claimed_time, completed_time,
+           COALESCE(completed_time, failed_time) AS finished_time
+    FROM task_queue_archive
+    WHERE COALESCE(completed_time, failed_time) >= :since
+      AND COALESCE(completed_time, failed_time) < :until {type_condition}
+) AS finished
+JOIN task_type ON task_type.id = finished.task_type_id
+GROUP BY 1, 2
+ORDER BY 2, 1
+"""
+
+
+def to_epoch(value: datetime) -> float:
+    # Task timestamps are stored without a time zone, as Postgres' epoch
+    # extraction assumes, so they are converted as if they were UTC
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+def from_epoch(value: float) -> datetime:
+    return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+
+
+class TaskReport:
+    """
+    Computes per task type and time bucket the number of tasks completed and
+    failed, the failure rate, and percentiles of the claim to completion time.
+
+    Buckets that have closed cannot change anymore, so their rows are kept per
+    database, task type filter and bucket size; a report only queries the buckets
+    after the last cached one. At most max_series of these are kept, the least
+    recently used one being dropped first.
+    """
+
+    def __init__(self, max_series: int = MAX_CACHED_SERIES):
+        self.max_series = max_series
+        self._closed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def query_buckets(
+        self,
+        db: Session,
+        task_type_id: Optional[int],
+        bucket_seconds: int,
+        since: float,
+        until: float,
+    ) -> list:
+        params = {
+            "bucket_seconds": bucket_seconds,
+            "percentiles": DURATION_PERCENTILES,
+            "since": from_epoch(since),
+            "until": from_epoch(until),
+        }
+        type_condition = ""
+        if task_type_id is not None:
+            type_condition = "AND task_type_id = :task_type_id"
+            params["task_type_id"] = task_type_id
+        rows = db.execute(
+            text(REPORT_QUERY.format(type_condition=type_condition)), params
+        )
+        return [
+            {
+                "task_type": row.task_type,
+                "bucket": float(row.bucket),
+                "completed": row.completed,
+                "failed": row.failed,
+                "durations": row.durations,
+            }
+            for row in rows
+        ]
+
+    def get_series(
+        self,
+        db: Session,
+        task_type_id: Optional[int],
+        bucket_seconds: int,
+        hours: float,
+    ) -> list:
+        """
+        Returns the report rows of the buckets covering the last hours, ordered by
+        bucket and task type. Only the buckets not cached yet are queried.
+        """
+        now = to_epoch(datetime.now())
+        since = math.floor((now - hours * 3600) / bucket_seconds) * bucket_seconds
+        closed_until = (
+            math.floor((now - CLOSED_BUCKET_GRACE_SECONDS) / bucket_seconds)
+            * bucket_seconds
+        )
+        key = (str(db.get_bind().url), task_type_id, bucket_seconds)
+
+        with self._lock:
+            entry = self._closed.get(key)
+            if entry is not None:
+                self._closed.move_to_end(key)
+            if entry is not None and entry["since"] <= since <= entry["until"]:
+                cached = [row for row in entry["rows"] if row["bucket"] >= since]
+                query_since = entry["until"]
+            else:
+                entry = None
+                cached = []
+                query_since = since
+
+        rows = self.query_buckets(db, task_type_id, bucket_seconds, query_since, now + 1)
+        newly_closed = [row for row in rows if row["bucket"] < closed_until]
+
+        with self._lock:
+            if entry is None:
+                self._closed[key] = {
+                    "since": since,
+                    "until": max(closed_until, since),
+                    "rows": newly_closed,
+                }
+                while len(self._closed) > self.max_series:
+                    self._closed.popitem(last=False)
+            elif closed_until > entry["until"]:
+                # Forget the buckets older than any report can ask for
+                oldest = closed_until - MAX_REPORT_HOURS * 3600
+                entry["rows"] = [
+                    row for row in entry["rows"] + newly_closed if row["bucket"] >= oldest
+                ]
+                entry["since"] = max(entry["since"], oldest)
+                entry["until"] = closed_until
+
+        return [format_report_row(row, bucket_seconds) for row in cached + rows]
+
+
+def format_report_row(row: dict, bucket_seconds: int) -> dict:
+    finished = row["completed"] + row["failed"]
+    durations = row["durations"] or [None] * len(DURATION_PERCENTILES)
+    report_row = {
+        "task_type": row["task_type"],
+        "bucket_start": from_epoch(row["bucket"]),
+        "bucket_end": from_epoch(row["bucket"] + bucket_seconds),
+        "completed": row["completed"],
+        "failed": row["failed"],
+        "failure_rate": row["failed"] / finished if finished else None,
+    }
+    for percentile, duration in zip(DURATION_PERCENTILES, durations):
+        report_row[f"duration_p{round(percentile * 100)}_seconds"] = duration
+    return report_row
+
+
+task_report = TaskReport()
@@ -0,0 +1,38 @@
+import math
+
+import orjson
+from starlette.responses import JSONResponse, Response
+
+from utils import ErrorCode
+
+
+class FastJSONResponse(Response):
+    """
+    JSON response encoded with orjson, which serializes datetimes natively.
+
+    Endpoints return it directly so that FastAPI skips jsonable_encoder, which
+    dominates the cost of large listings.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+def retry_later_response(
+    error_code: ErrorCode, error_message: str, retry_after: float
+) -> JSONResponse:
+    """
+    Error response for a request turned away under load or during shutdown, with
+    the HTTP status of the error code and a Retry-After header in whole seconds.
+    """
+    return JSONResponse(
+        {
+            "status": False,
+            "error_code": error_code.value["code"],
+            "error_message": error_message,
+        },
+        status_code=error_code.value["code"],
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
@@ -0,0 +1,60 @@
+"""
+Production entry point of the job server.
+
+Runs WEB_CONCURRENCY worker processes (default: one per CPU) behind one socket,
+on uvloop and httptools when they are installed. Each worker warms its database
+pool and lookup caches before /health/readiness reports it ready. On SIGTERM it
+reports "draining" for SHUTDOWN_READINESS_DELAY_SECONDS (default 5 here) while
+still serving, then stops accepting connections and gets SHUTDOWN_DRAIN_SECONDS
+to finish the requests in flight.
+
+Usage: python serve.py
+"""
+import importlib
+import os
+
+import uvicorn
+
+from utils import get_env_var, load_settings
+from serving import DEFAULT_SHUTDOWN_DRAIN_SECONDS
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+# Long enough for the load balancer to see the failing readiness probe
+DEFAULT_SHUTDOWN_READINESS_DELAY_SECONDS = 5
+
+
+def fastest_available(module_name: str) -> str:
+    """
+    Returns module_name if that implementation is installed, so that uvicorn
+    uses it, or "auto" to let uvicorn fall back to the standard one.
+    """
+    try:
+        importlib.import_module(module_name)
+        return module_name
+    except ImportError:
+        return "auto"
+
+
+def main():
+    load_settings()
+    os.environ.setdefault(
+        "SHUTDOWN_READINESS_DELAY_SECONDS", str(DEFAULT_SHUTDOWN_READINESS_DELAY_SECONDS)
+    )
+    uvicorn.run(
+        "main:app",
+        host=get_env_var("HOST", DEFAULT_HOST),
+        port=int(get_env_var("PORT", DEFAULT_PORT)),
+        workers=int(get_env_var("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop=fastest_available("uvloop"),
+        http=fastest_available("httptools"),
+        timeout_graceful_shutdown=int(
+            get_env_var("SHUTDOWN_DRAIN_SECONDS", DEFAULT_SHUTDOWN_DRAIN_SECONDS)
+        ),
+        access_log=get_env_var("ACCESS_LOG", "false").lower() == "true",
+        proxy_headers=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import signal
+import threading
+import time
+
+from utils import ErrorCode
+from responses import retry_later_response
+from Logger import Logger, LogLevel
+
+DEFAULT_SHUTDOWN_DRAIN_SECONDS = 30
+DEFAULT_SHUTDOWN_READINESS_DELAY_SECONDS = 0
+DEFAULT_WARM_UP_RETRY_SECONDS = 5
+
+# Requests that change tasks and are let finish on shutdown
+MUTATING_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+logger = Logger()
+
+
+class ServerState:
+    """
+    Readiness of this server process: it becomes ready once warmed up, stops being
+    ready when it starts draining on shutdown, and tracks the task-changing
+    requests in flight so that shutdown can wait for them.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+    @property
+    def serving(self) -> bool:
+        return self.ready and not self.draining
+
+    def enter(self):
+        with self._idle:
+            self._in_flight += 1
+
+    def leave(self):
+        with self._idle:
+            self._in_flight -= 1
+            self._idle.notify_all()
+
+    def tracked(self, handler):
+        """
+        Decorates a synchronous request handler that changes tasks so that drain
+        also waits for it in its threadpool thread: when the server cancels a
+        request at the end of the graceful shutdown, the thread keeps running.
+        """
+
+        @functools.wraps(handler)
+        def run_tracked(*args, **kwargs):
+            self.enter()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                self.leave()
+
+        return run_tracked
+
+    def drain_on_sigterm(self, delay: float):
+        """
+        Starts draining as soon as the process gets SIGTERM, so that readiness
+        reports "draining" and new task-changing requests are turned away while
+        the server still accepts connections, and only passes the signal on to the
+        server's own handler, which stops accepting them, delay seconds later.
+        A second SIGTERM is passed on at once.
+
+        Must be called from the event loop, after the server installed its signal
+        handlers; does nothing outside the main thread, where they are not
+        installed.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        server_handler = signal.getsignal(signal.SIGTERM)
+        if not callable(server_handler):
+            return
+        loop = asyncio.get_running_loop()
+
+        def handle_sigterm(signum, frame):
+            if self.draining:
+                server_handler(signum, frame)
+                return
+            self.draining = True
+            logger.log(LogLevel.INFO, "Draining before shutdown", delay=delay)
+            loop.call_soon_threadsafe(
+                loop.call_later, delay, server_handler, signum, frame
+            )
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Stops admitting task-changing requests and waits up to timeout seconds for
+        those in flight. Returns whether they all finished.
+        """
+        self.draining = True
+        with self._idle:
+            finished = self._idle.wait_for(lambda: self._in_flight == 0, timeout)
+        if not finished:
+            logger.log(
+                LogLevel.WARNING,
+                "Shutting down with requests in flight",
+                in_flight=self._in_flight,
+            )
+        return finished
+
+    def warm_up(self, warm, retry_interval: float = DEFAULT_WARM_UP_RETRY_SECONDS):
+        """
+        Runs warm until it succeeds, retrying every retry_interval seconds, then
+        marks the server ready.
+        """
+        while not self.draining:
+            try:
+                warm()
+                self.ready = True
+                logger.log(LogLevel.INFO, "Server warmed up and ready")
+                return
+            except Exception as e:
+                logger.log(LogLevel.ERROR, f"Warm-up failed: {str(e)}")
+                time.sleep(retry_interval)
+
+    def start_warm_up(self, warm):
+        threading.Thread(
+            target=self.warm_up, args=(warm,), name="warm-up", daemon=True
+        ).start()
+
+
+class DrainingMiddleware:
+    """
+    Tracks task-changing requests in flight and turns new ones away with a 503
+    once the server is draining. Their handlers are tracked as well, with
+    ServerState.tracked, until they return.
+    """
+
+    def __init__(self, app, state: ServerState):
+        self.app = app
+        self.state = state
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in MUTATING_METHODS:
+            await self.app(scope, receive, send)
+            return
+        if self.state.draining:
+            response = retry_later_response(
+                ErrorCode.UNAVAILABLE, "Server is shutting down", 1
+            )
+            await response(scope, receive, send)
+            return
+        self.state.enter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.state.leave()
@@ -0,0 +1,137 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# The server modules are imported as top-level modules, as in the server itself
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The server reads these on import; the tests never connect with them
+for key in ("DB_HOST", "DB_NAME", "DB_USER", "DB_PASSWORD"):
+    os.environ.setdefault(key, "test")
+os.environ.setdefault("LOG_LEVEL", "warning")
+os.environ["TASK_EVENTS_ENABLED"] = "false"
+
+from database import (  # noqa: E402
+    Base,
+    Database,
+    TaskDetail,
+    TaskQueue,
+    TaskStatus,
+    TaskType,
+)
+from queue_engine import (  # noqa: E402
+    TASK_STATUSES,
+    InMemoryQueueEngine,
+    PostgresQueueEngine,
+    QueueError,
+)
+from utils import ErrorCode  # noqa: E402
+
+TASK_TYPES = ["fetch", "index"]
+REQUESTER = "tests@example.com"
+
+# The tests run against in-memory SQLite, or against the Postgres database given
+# in TEST_DATABASE_URL, whose tables are dropped and recreated by every test
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL", "sqlite://")
+
+
+def create_test_engine(url: str):
+    if url.startswith("sqlite"):
+        return create_engine(
+            url, connect_args={"check_same_thread": False}, poolclass=StaticPool
+        )
+    return create_engine(url)
+
+
+def create_lookups(engine):
+    """
+    Creates the task status and type rows, with the ids InMemoryQueueEngine
+    gives them.
+    """
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        for model, names in ((TaskStatus, TASK_STATUSES), (TaskType, TASK_TYPES)):
+            session.add_all(
+                model(id=index, name=name) for index, name in enumerate(names, 1)
+            )
+        session.commit()
+
+
+class SQLiteDatabase(Database):
+    """
+    A shard on its own in-memory SQLite database.
+    """
+
+    def create_engine(self, db_host=None, db_name=None, **kwargs):
+        return create_test_engine("sqlite://")
+
+
+@pytest.fixture
+def db_engine():
+    engine = create_test_engine(TEST_DATABASE_URL)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    create_lookups(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db_session(db_engine):
+    session = sessionmaker(bind=db_engine, autoflush=False)()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def postgres_session(db_engine, db_session):
+    if db_engine.dialect.name != "postgresql":
+        pytest.skip("needs a Postgres database in TEST_DATABASE_URL")
+    return db_session
+
+
+@pytest.fixture(params=["database", "memory"])
+def queue(request):
+    """
+    Each lifecycle test runs against both queue engines, which must behave the
+    same.
+    """
+    if request.param == "database":
+        return PostgresQueueEngine(request.getfixturevalue("db_session"))
+    return InMemoryQueueEngine(TASK_TYPES)
+
+
+def task_state(queue, task_id: int) -> tuple:
+    """
+    The status, version and message of a task, read from the engine's store.
+    """
+    if isinstance(queue, InMemoryQueueEngine):
+        task = queue.tasks[task_id]
+        return task.task_status, task.version, task.message
+    return tuple(
+        queue.db.query(TaskStatus.name, TaskQueue.version, TaskDetail.message)
+        .join(TaskStatus, TaskStatus.id == TaskQueue.task_status_id)
+        .join(TaskDetail, TaskDetail.task_id == TaskQueue.id)
+        .filter(TaskQueue.id == task_id)
+        .one()
+    )
+
+
+def enqueue(queue, task_type: str, query: str, parent_task_ids=None) -> int:
+    return queue.enqueue(task_type, query, REQUESTER, parent_task_ids=parent_task_ids)
+
+
+def claim_and_complete(queue, task_type: str, success: bool = True) -> dict:
+    claimed = queue.claim(task_type, "agent")
+    queue.complete(claimed["id"], success, "results", None, claimed["version"])
+    return claimed
+
+
+def assert_queue_error(error_code: ErrorCode, message: str, call, *args):
+    with pytest.raises(QueueError, match=message) as error:
+        call(*args)
+    assert error.value.error_code == error_code
@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+from archiver import TaskArchiver
+from conftest import assert_queue_error, claim_and_complete, enqueue
+from database import TaskQueue, TaskQueueArchive, TaskStatus
+from queue_engine import PostgresQueueEngine
+from utils import ErrorCode
+
+
+def test_archived_tasks_keep_their_status_and_release_new_dependents(
+    postgres_session,
+):
+    queue = PostgresQueueEngine(postgres_session)
+    completed = enqueue(queue, "fetch", "completed")
+    failed = enqueue(queue, "fetch", "failed")
+    live = enqueue(queue, "fetch", "live")
+    claim_and_complete(queue, "fetch")
+    queue.complete(failed, False)
+
+    archiver = TaskArchiver()
+    archiver.archive_after = timedelta(0)
+    assert archiver.archive_batch(postgres_session) == 2
+
+    archived = dict(
+        postgres_session.query(TaskQueueArchive.id, TaskStatus.name)
+        .join(TaskStatus, TaskStatus.id == TaskQueueArchive.task_status_id)
+        .all()
+    )
+    assert archived == {completed: "completed", failed: "failed"}
+    assert [task.id for task in postgres_session.query(TaskQueue)] == [live]
+    assert_queue_error(ErrorCode.NOT_FOUND, "Task not found", queue.complete, failed, True)
+
+    # Archived parents are final: completed ones count as done, failed ones
+    # are refused
+    child = enqueue(queue, "index", "child", [completed])
+    assert queue.claim("index", "agent")["id"] == child
+    assert_queue_error(
+        ErrorCode.GENERAL,
+        f"Parent task {failed} has failed",
+        enqueue,
+        queue,
+        "index",
+        "orphan",
+        [failed],
+    )
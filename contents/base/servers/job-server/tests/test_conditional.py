@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+from starlette.requests import Request
+
+from conditional import get_task_validator, get_task_version, is_not_modified
+from conftest import enqueue
+from database import TaskQueue
+from queue_engine import PostgresQueueEngine
+
+
+def request_with(headers: dict) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [
+                (name.lower().encode(), value.encode()) for name, value in headers.items()
+            ],
+        }
+    )
+
+
+def test_etag_changes_with_every_update_even_with_an_older_updated_at(db_session):
+    queue = PostgresQueueEngine(db_session)
+    task_id = enqueue(queue, "fetch", "query")
+    task_filter = {"task_type_id": 1}
+
+    def etag() -> str:
+        return get_task_validator([get_task_version(db_session, task_filter, False)])
+
+    first = etag()
+    assert etag() == first
+
+    # An update committed late, with the start time of its transaction
+    task = db_session.get(TaskQueue, task_id)
+    task.version += 1
+    task.updated_at = task.updated_at - timedelta(seconds=1)
+    db_session.commit()
+    assert etag() != first
+
+
+def test_shard_versions_add_up():
+    updated_at = datetime(2024, 1, 1)
+    assert get_task_validator(
+        [(2, 5, updated_at), (1, 1, updated_at + timedelta(seconds=1))]
+    ) == get_task_validator([(3, 6, updated_at + timedelta(seconds=1))])
+    assert get_task_validator([(0, 0, None)]) == '"0-0-0"'
+
+
+def test_only_if_none_match_is_honoured():
+    etag = '"3-6-1704067201.0"'
+
+    assert is_not_modified(request_with({"If-None-Match": etag}), etag)
+    assert is_not_modified(request_with({"If-None-Match": f'"other", W/{etag}'}), etag)
+    assert is_not_modified(request_with({"If-None-Match": "*"}), etag)
+    assert not is_not_modified(request_with({"If-None-Match": '"other"'}), etag)
+    assert not is_not_modified(
+        request_with({"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}), etag
+    )
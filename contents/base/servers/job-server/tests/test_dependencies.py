@@ -0,0 +1,77 @@
+from conftest import assert_queue_error, claim_and_complete, enqueue, task_state
+from utils import ErrorCode
+
+
+def test_dependents_are_claimable_once_all_parents_completed(queue):
+    first_parent = enqueue(queue, "fetch", "first parent")
+    second_parent = enqueue(queue, "fetch", "second parent")
+    dependent = enqueue(queue, "index", "dependent", [first_parent, second_parent])
+    independent = enqueue(queue, "index", "independent")
+
+    # The dependent is older, but only the independent task is ready
+    assert queue.claim("index", "agent")["id"] == independent
+    assert_queue_error(
+        ErrorCode.NOT_FOUND, "No unclaimed task found", queue.claim, "index", "agent"
+    )
+
+    claim_and_complete(queue, "fetch")
+    assert task_state(queue, dependent) == ("unclaimed", 2, None)
+    assert_queue_error(
+        ErrorCode.NOT_FOUND, "No unclaimed task found", queue.claim, "index", "agent"
+    )
+
+    claim_and_complete(queue, "fetch")
+    claimed = queue.claim("index", "agent")
+    assert (claimed["id"], claimed["version"]) == (dependent, 4)
+
+    # A task whose parents have all completed is ready straight away
+    child = enqueue(queue, "index", "child", [first_parent, second_parent])
+    assert queue.claim("index", "agent")["id"] == child
+
+
+def test_failed_parent_fails_its_dependents_transitively(queue):
+    parent = enqueue(queue, "fetch", "parent")
+    child = enqueue(queue, "index", "child", [parent])
+    grandchild = enqueue(queue, "index", "grandchild", [child])
+
+    claim_and_complete(queue, "fetch", success=False)
+
+    message = f"Upstream task {parent} failed"
+    assert task_state(queue, child) == ("failed", 2, message)
+    assert task_state(queue, grandchild) == ("failed", 2, message)
+    assert_queue_error(
+        ErrorCode.NOT_FOUND, "No unclaimed task found", queue.claim, "index", "agent"
+    )
+    assert_queue_error(
+        ErrorCode.GENERAL,
+        f"Parent task {parent} has failed",
+        enqueue,
+        queue,
+        "index",
+        "late child",
+        [parent],
+    )
+    assert_queue_error(
+        ErrorCode.GENERAL,
+        "Invalid parent task id: 999",
+        enqueue,
+        queue,
+        "index",
+        "orphan",
+        [parent, 999],
+    )
+
+
+def test_completed_parent_leaves_dependents_failed_by_another_parent(queue):
+    completing_parent = enqueue(queue, "fetch", "completing parent")
+    failing_parent = enqueue(queue, "index", "failing parent")
+    dependent = enqueue(queue, "index", "dependent", [completing_parent, failing_parent])
+
+    queue.complete(failing_parent, False)
+    assert task_state(queue, dependent)[:2] == ("failed", 2)
+
+    claim_and_complete(queue, "fetch")
+    assert task_state(queue, dependent)[:2] == ("failed", 2)
+    assert_queue_error(
+        ErrorCode.NOT_FOUND, "No unclaimed task found", queue.claim, "index", "agent"
+    )
@@ -0,0 +1,22 @@
+from queue_engine import get_parameter_checksum
+
+
+def test_parameter_checksum_ignores_field_order_case_and_spaces():
+    checksum = get_parameter_checksum('{"url": "https://example.com", "depth": 2}')
+
+    assert get_parameter_checksum('{"depth": 2, "url": "HTTPS://example.com"}') == checksum
+    assert get_parameter_checksum('{"url": "https://example.com", "depth": 3}') != checksum
+    # Date ranges do not make a query different
+    assert (
+        get_parameter_checksum(
+            '{"url": "https://example.com", "depth": 2, "dateStart": "2024-01-01"}'
+        )
+        == checksum
+    )
+    # Anything but a JSON object is hashed as a single query field
+    assert get_parameter_checksum("plain text") == get_parameter_checksum(
+        '{"query": "plain text"}'
+    )
+    assert get_parameter_checksum("[1, 2]") == get_parameter_checksum(
+        '{"query": "[1, 2]"}'
+    )
@@ -0,0 +1,30 @@
+from conftest import assert_queue_error, enqueue, task_state
+from utils import ErrorCode
+
+
+def test_enqueue_keeps_duplicate_queries_as_separate_tasks(queue):
+    first = enqueue(queue, "fetch", '{"url": "https://example.com"}')
+    second = enqueue(queue, "fetch", '{"url": "https://example.com"}')
+
+    assert second == first + 1
+    assert task_state(queue, first) == ("unclaimed", 1, None)
+    assert task_state(queue, second) == ("unclaimed", 1, None)
+    assert_queue_error(
+        ErrorCode.GENERAL, "Invalid task type", enqueue, queue, "unknown", "query"
+    )
+
+
+def test_claims_take_the_oldest_task_of_their_type(queue):
+    fetch_ids = [enqueue(queue, "fetch", f"fetch {index}") for index in range(3)]
+    index_id = enqueue(queue, "index", "index")
+
+    claimed = queue.claim("fetch", "agent-1")
+    assert (claimed["id"], claimed["claimed_by_agent"]) == (fetch_ids[0], "agent-1")
+    assert claimed["version"] == 2
+    assert task_state(queue, fetch_ids[0]) == ("claimed", 2, None)
+
+    assert [queue.claim("fetch", "agent-2")["id"] for _ in range(2)] == fetch_ids[1:]
+    assert_queue_error(
+        ErrorCode.NOT_FOUND, "No unclaimed task found", queue.claim, "fetch", "agent"
+    )
+    assert queue.claim("index", "agent-1")["id"] == index_id
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+from starlette.requests import Request
+
+import main
+from conftest import SQLiteDatabase, create_lookups, enqueue
+from database import Base, ShardRouter
+from queue_engine import PostgresQueueEngine
+
+
+@pytest.fixture
+def shard(monkeypatch):
+    database = SQLiteDatabase("test", "shard0", "test", "test")
+    Base.metadata.create_all(database.engine)
+    create_lookups(database.engine)
+    monkeypatch.setattr(main, "get_shards", lambda: ShardRouter([database], {}))
+    return database
+
+
+def list_tasks(**params) -> list:
+    query = dict(
+        task_type=None,
+        task_status=None,
+        task_id=None,
+        include_archive=False,
+        search=None,
+        limit=None,
+        after_id=None,
+    )
+    query.update(params)
+    response = main.get_tasks(Request({"type": "http", "headers": []}), **query)
+    return [task["id"] for task in json.loads(response.body)]
+
+
+def test_searches_are_paged_by_default(shard, monkeypatch):
+    with shard.SessionLocal() as session:
+        queue = PostgresQueueEngine(session)
+        task_ids = [
+            enqueue(queue, "fetch", f"https://example.com/{index}") for index in range(5)
+        ]
+    monkeypatch.setattr(main, "search_page_size", 2)
+
+    assert list_tasks(search="example") == task_ids[:2]
+    assert list_tasks(search="example", after_id=task_ids[1]) == task_ids[2:4]
+    assert list_tasks(search="example", limit=4) == task_ids[:4]
+    assert list_tasks() == task_ids
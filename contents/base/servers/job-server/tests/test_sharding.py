@@ -0,0 +1,182 @@
+import threading
+import zlib
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from conftest import TEST_DATABASE_URL, SQLiteDatabase, create_lookups
+from database import (
+    Base,
+    Database,
+    ShardRouter,
+    TaskDetail,
+    TaskQueue,
+    TaskQueueArchive,
+    interleave_task_ids,
+)
+from main import merge_task_stats
+from queue_engine import PostgresQueueEngine, QueueError
+
+
+@pytest.fixture
+def shards():
+    databases = [
+        SQLiteDatabase("test", f"shard{index}", "test", "test", index, 2)
+        for index in range(2)
+    ]
+    for database in databases:
+        Base.metadata.create_all(database.engine)
+        create_lookups(database.engine)
+    return ShardRouter(databases, {"fetch": 0, "index": 1})
+
+
+def add_task(database: Database, task_id: int, archived: bool = False):
+    with database.SessionLocal() as session:
+        if archived:
+            session.add(TaskQueueArchive(id=task_id, task_type_id=1, task_status_id=3))
+        else:
+            session.add(
+                TaskQueue(
+                    id=task_id,
+                    task_type_id=1,
+                    task_status_id=3,
+                    detail=TaskDetail(query=f"task {task_id}"),
+                )
+            )
+        session.commit()
+
+
+def test_task_types_map_to_configured_or_hashed_shards(shards):
+    assert shards.shard_for_task_type("fetch") == 0
+    assert shards.shard_for_task_type("index") == 1
+    assert shards.shard_for_task_type("extract") == zlib.crc32(b"extract") % 2
+    assert shards.for_task_type("index") is shards.databases[1]
+    assert shards.for_task_type(None) is shards.databases[0]
+    assert [shards.shard_for_task_id(task_id) for task_id in range(1, 5)] == [0, 1, 0, 1]
+
+
+def test_find_task_looks_beyond_the_home_shard(shards):
+    first, second = shards.databases
+    add_task(first, 1)
+    add_task(second, 2, archived=True)
+    # Numbered before sharding, on a shard its id does not map to
+    add_task(first, 4)
+
+    assert shards.find_task(1) is first
+    assert shards.find_task(2) is second
+    assert shards.find_task(4) is first
+    assert shards.find_task(6) is None
+    assert shards.locate_task(6) is second
+
+    single = ShardRouter([first], {})
+    assert single.locate_task(2) is first
+
+
+def test_parents_must_be_on_the_shard_of_their_dependents(shards):
+    first, second = shards.databases
+    add_task(first, 1)
+    add_task(second, 2)
+    add_task(first, 3)
+
+    with first.SessionLocal() as session:
+        queue = PostgresQueueEngine(session, shards=shards)
+        queue.enqueue("fetch", "child", "tests@example.com", parent_task_ids=[1])
+        with pytest.raises(QueueError, match="Invalid parent task id: 7"):
+            queue.enqueue("fetch", "orphan", "tests@example.com", parent_task_ids=[7])
+
+    # The shard of the task type is searched by the enqueue itself, with the
+    # connection of the request, and not again by the parent shard check
+    statements = []
+    event.listen(
+        second.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    with second.SessionLocal() as session:
+        queue = PostgresQueueEngine(session, shards=shards)
+        with pytest.raises(
+            QueueError, match="Parent task 3 is on shard 0 and task type index on shard 1"
+        ):
+            queue.enqueue("index", "child", "tests@example.com", parent_task_ids=[3, 2])
+    assert not any("UNION ALL" in statement for statement in statements)
+
+
+@pytest.fixture
+def postgres_shard(postgres_session):
+    """
+    The second of two shards, on the test database.
+    """
+    url = make_url(TEST_DATABASE_URL)
+    host = f"{url.host}:{url.port}" if url.port else url.host
+    database = Database(host, url.database, url.username, url.password, 1, 2)
+    yield database
+    database.engine.dispose()
+
+
+def enqueue_tasks(database: Database, count: int) -> list:
+    with database.SessionLocal() as session:
+        queue = PostgresQueueEngine(session)
+        return [
+            queue.enqueue("fetch", f"task {index}", "tests@example.com")
+            for index in range(count)
+        ]
+
+
+def test_interleaved_task_ids_map_to_their_shard(postgres_shard):
+    assert enqueue_tasks(postgres_shard, 3) == [1, 2, 3]
+
+    interleave_task_ids([postgres_shard])
+    # Already interleaved: numbering goes on where it was
+    interleave_task_ids([postgres_shard])
+
+    assert enqueue_tasks(postgres_shard, 3) == [4, 6, 8]
+
+
+def test_interleaving_waits_for_tasks_being_inserted(postgres_shard):
+    enqueue_tasks(postgres_shard, 3)
+    with postgres_shard.SessionLocal() as session:
+        session.add(TaskQueue(task_type_id=1, task_status_id=1))
+        session.flush()
+        interleaving = threading.Thread(
+            target=interleave_task_ids, args=([postgres_shard],)
+        )
+        interleaving.start()
+        interleaving.join(0.2)
+        assert interleaving.is_alive()
+        session.commit()
+    interleaving.join()
+
+    # Numbering restarted after the task inserted meanwhile, not after 3
+    assert enqueue_tasks(postgres_shard, 2) == [6, 8]
+
+
+def test_merge_task_stats_adds_up_the_shards():
+    shard_stats = [
+        {
+            "counts": [
+                {"task_type": "fetch", "task_status": "unclaimed", "count": 2},
+                {"task_type": "fetch", "task_status": "claimed", "count": 1},
+            ],
+            "oldest_unclaimed_age_seconds": {"fetch": 30.0, "index": None},
+            "active_claims_by_agent": {"agent-1": 1},
+            "generated_at": "2024-01-01T00:00:02",
+        },
+        {
+            "counts": [{"task_type": "fetch", "task_status": "unclaimed", "count": 3}],
+            "oldest_unclaimed_age_seconds": {"fetch": 10.0, "index": 5.0},
+            "active_claims_by_agent": {"agent-1": 2, "agent-2": 1},
+            "generated_at": "2024-01-01T00:00:01",
+        },
+    ]
+
+    assert merge_task_stats(shard_stats[:1]) is shard_stats[0]
+    assert merge_task_stats(shard_stats) == {
+        "counts": [
+            {"task_type": "fetch", "task_status": "unclaimed", "count": 5},
+            {"task_type": "fetch", "task_status": "claimed", "count": 1},
+        ],
+        "oldest_unclaimed_age_seconds": {"fetch": 30.0, "index": 5.0},
+        "active_claims_by_agent": {"agent-1": 3, "agent-2": 1},
+        "generated_at": "2024-01-01T00:00:01",
+    }
@@ -0,0 +1,44 @@
+from conftest import assert_queue_error, enqueue, task_state
+from utils import ErrorCode
+
+
+def test_complete_and_fail_check_status_and_version(queue):
+    claimed_id = enqueue(queue, "fetch", "claimed")
+    unclaimed_id = enqueue(queue, "fetch", "unclaimed")
+    claimed = queue.claim("fetch", "agent")
+
+    version = queue.update_metrics(claimed_id, {"documents": 1}, claimed["version"])
+    assert version == claimed["version"] + 1
+    assert_queue_error(
+        ErrorCode.CONFLICT,
+        "at version",
+        queue.complete,
+        claimed_id,
+        True,
+        "results",
+        None,
+        claimed["version"],
+    )
+
+    completed = queue.complete(claimed_id, True, "results", "done", version)
+    assert completed["version"] == version + 1
+    assert task_state(queue, claimed_id) == ("completed", version + 1, "done")
+    assert_queue_error(
+        ErrorCode.CONFLICT, "Task is completed", queue.complete, claimed_id, False
+    )
+
+    # Unclaimed tasks can be failed but not completed
+    assert_queue_error(
+        ErrorCode.CONFLICT, "Task is unclaimed", queue.complete, unclaimed_id, True
+    )
+    assert_queue_error(
+        ErrorCode.CONFLICT,
+        "Task is unclaimed",
+        queue.update_metrics,
+        unclaimed_id,
+        {"documents": 1},
+    )
+    queue.complete(unclaimed_id, False, message="cancelled")
+    assert task_state(queue, unclaimed_id) == ("failed", 2, "cancelled")
+
+    assert_queue_error(ErrorCode.NOT_FOUND, "Task not found", queue.complete, 999, True)
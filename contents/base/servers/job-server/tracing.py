@@ -0,0 +1,213 @@
+import contextlib
+
+import requests
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from utils import get_env_var
+from Logger import Logger, LogLevel
+
+TRACING_EXPORTERS = ("console", "file", "otlp")
+DEFAULT_TRACING_SERVICE_NAME = "job-server"
+DEFAULT_TRACING_FILE = "traces.jsonl"
+
+# Characters of SQL kept on statement spans
+MAX_SPAN_STATEMENT_LENGTH = 2048
+
+logger = Logger()
+
+# Set by setup_tracing; tracing is off while it is None
+_tracer = None
+_provider = None
+
+
+def setup_tracing():
+    """
+    Sets up OpenTelemetry tracing with the exporter named by TRACING_EXPORTER:
+    "console" (stdout), "file" (TRACING_FILE, one JSON span per line) or "otlp"
+    (a collector, configured with the standard OTEL_EXPORTER_OTLP_* variables).
+    Tracing stays off when TRACING_EXPORTER is unset or the OpenTelemetry SDK is
+    not installed.
+    """
+    global _tracer, _provider
+    exporter_name = get_env_var("TRACING_EXPORTER", "").lower()
+    if not exporter_name:
+        return
+    if exporter_name not in TRACING_EXPORTERS:
+        logger.log(LogLevel.ERROR, f"Tracing disabled, unknown exporter: {exporter_name}")
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import (
+            BatchSpanProcessor,
+            ConsoleSpanExporter,
+        )
+
+        if exporter_name == "otlp":
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+    except ImportError as e:
+        logger.log(
+            LogLevel.WARNING,
+            f"Tracing disabled, OpenTelemetry is not installed: {str(e)}",
+        )
+        return
+
+    if exporter_name == "otlp":
+        exporter = OTLPSpanExporter()
+    elif exporter_name == "file":
+        # Line buffered, so that the spans of several workers do not interleave
+        trace_file = open(
+            get_env_var("TRACING_FILE", DEFAULT_TRACING_FILE), "a", buffering=1
+        )
+        exporter = ConsoleSpanExporter(
+            out=trace_file, formatter=lambda span: span.to_json(indent=None) + "\n"
+        )
+    else:
+        exporter = ConsoleSpanExporter()
+
+    _provider = TracerProvider(
+        resource=Resource.create(
+            {
+                "service.name": get_env_var(
+                    "TRACING_SERVICE_NAME", DEFAULT_TRACING_SERVICE_NAME
+                )
+            }
+        )
+    )
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    # Not registered as the global provider, so that frameworks with their own
+    # instrumentation do not add a second server span per request
+    _tracer = _provider.get_tracer("job-server")
+    logger.log(LogLevel.INFO, "Tracing enabled", exporter=exporter_name)
+
+
+def shutdown_tracing():
+    """
+    Exports the spans still buffered.
+    """
+    global _tracer
+    if _provider is not None:
+        _tracer = None
+        _provider.shutdown()
+
+
+@contextlib.contextmanager
+def traced_span(name: str, **attributes):
+    """
+    Runs the enclosed code in a span of the current trace, to attribute the time
+    of a step of a request. Does nothing while tracing is off.
+    """
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=attributes) as span:
+        yield span
+
+
+def traced_get(url: str, **kwargs) -> requests.Response:
+    """
+    Performs requests.get in a client span, passing the trace context on to the
+    called service in the traceparent header.
+    """
+    if _tracer is None:
+        return requests.get(url, **kwargs)
+
+    from opentelemetry import trace
+    from opentelemetry.propagate import inject
+
+    with _tracer.start_as_current_span(
+        "GET",
+        kind=trace.SpanKind.CLIENT,
+        attributes={"http.request.method": "GET", "url.full": url},
+    ) as span:
+        headers = dict(kwargs.pop("headers", None) or {})
+        inject(headers)
+        response = requests.get(url, headers=headers, **kwargs)
+        span.set_attribute("http.response.status_code", response.status_code)
+        if response.status_code >= 400:
+            span.set_status(trace.StatusCode.ERROR)
+        return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement_span(conn, cursor, statement, parameters, context, executemany):
+    if _tracer is None:
+        return
+
+    from opentelemetry import trace
+
+    # Statements are only traced as part of a traced request
+    if not trace.get_current_span().is_recording():
+        return
+    url = conn.engine.url
+    operation = statement.split(None, 1)[0].upper() if statement else "SQL"
+    span = _tracer.start_span(
+        f"{operation} {url.database}",
+        kind=trace.SpanKind.CLIENT,
+        attributes={
+            "db.system": conn.dialect.name,
+            "db.namespace": url.database,
+            "db.operation.name": operation,
+            "db.query.text": statement[:MAX_SPAN_STATEMENT_LENGTH],
+            "server.address": url.host or "",
+        },
+    )
+    conn.info.setdefault("trace_spans", []).append(span)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement_span(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.get("trace_spans"):
+        conn.info["trace_spans"].pop().end()
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_statement_span(exception_context):
+    conn = exception_context.connection
+    if conn is None or not conn.info.get("trace_spans"):
+        return
+
+    from opentelemetry import trace
+
+    span = conn.info["trace_spans"].pop()
+    span.record_exception(exception_context.original_exception)
+    span.set_status(trace.StatusCode.ERROR)
+    span.end()
+
+
+class TracingMiddleware(BaseHTTPMiddleware):
+    """
+    Traces each request in a server span named after its route, continuing the
+    trace of the caller when the request carries a traceparent header. The SQL
+    statements and document service calls made for the request are child spans.
+    """
+
+    async def dispatch(self, request, call_next):
+        if _tracer is None:
+            return await call_next(request)
+
+        from opentelemetry import trace
+        from opentelemetry.propagate import extract
+
+        with _tracer.start_as_current_span(
+            f"{request.method} {request.url.path}",
+            context=extract(request.headers),
+            kind=trace.SpanKind.SERVER,
+            attributes={
+                "http.request.method": request.method,
+                "url.path": request.url.path,
+            },
+        ) as span:
+            response = await call_next(request)
+            route = request.scope.get("route")
+            if route is not None:
+                span.update_name(f"{request.method} {route.path}")
+                span.set_attribute("http.route", route.path)
+            span.set_attribute("http.response.status_code", response.status_code)
+            if response.status_code >= 500:
+                span.set_status(trace.StatusCode.ERROR)
+            return response
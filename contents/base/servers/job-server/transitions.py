@@ -0,0 +1,107 @@
+from typing import Optional
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from database import TASK_DETAIL_FIELDS, TaskDetail, TaskQueue, TaskStatus
+from lookups import get_task_status_id
+
+# The statuses a task may move to, each with the statuses it may move from
+TASK_TRANSITIONS = {
+    "claimed": ("unclaimed",),
+    "completed": ("claimed",),
+    "failed": ("unclaimed", "claimed"),
+}
+
+
+def update_task(
+    db: Session,
+    task_id: int,
+    from_statuses: tuple,
+    expected_version: Optional[int] = None,
+    **values,
+) -> Optional[TaskQueue]:
+    """
+    Updates a task with a single conditional UPDATE that also increments its
+    version. The update only applies while the task is in one of from_statuses
+    and, when expected_version is given, still at that version, so concurrent
+    writers never overwrite each other. A writer still waits for the row lock of
+    a concurrent update of the same task until that transaction ends, then
+    re-checks the condition against the committed row. Values of detail columns
+    are then written to the task's TaskDetail, in the same transaction.
+
+    Args:
+    - db (Session): The SQLAlchemy database session.
+    - task_id (int): The ID of the task to update, or a scalar subquery selecting it.
+    - from_statuses (tuple): The names of the statuses the task may be in.
+    - expected_version (int, optional): The version the task must be at.
+    - values: The new column values.
+
+    Returns:
+    TaskQueue: The updated task, or None when the task did not meet the condition.
+    """
+    conditions = [
+        TaskQueue.id == task_id,
+        TaskQueue.task_status_id.in_(
+            [get_task_status_id(db, status) for status in from_statuses]
+        ),
+    ]
+    if expected_version is not None:
+        conditions.append(TaskQueue.version == expected_version)
+    detail_values = {
+        name: values.pop(name) for name in list(values) if name in TASK_DETAIL_FIELDS
+    }
+    task = db.scalars(
+        update(TaskQueue)
+        .where(*conditions)
+        .values(version=TaskQueue.version + 1, **values)
+        .returning(TaskQueue),
+        execution_options={"synchronize_session": False, "populate_existing": True},
+    ).one_or_none()
+    if task is not None and detail_values:
+        db.execute(
+            update(TaskDetail)
+            .where(TaskDetail.task_id == task.id)
+            .values(**detail_values),
+            execution_options={"synchronize_session": False},
+        )
+    return task
+
+
+def transition_task(
+    db: Session,
+    task_id: int,
+    to_status: str,
+    expected_version: Optional[int] = None,
+    **values,
+) -> Optional[TaskQueue]:
+    """
+    Moves a task to to_status, from one of the statuses allowed by
+    TASK_TRANSITIONS, with update_task.
+    """
+    return update_task(
+        db,
+        task_id,
+        TASK_TRANSITIONS[to_status],
+        expected_version,
+        task_status_id=get_task_status_id(db, to_status),
+        **values,
+    )
+
+
+def describe_conflict(db: Session, task_id: int) -> Optional[str]:
+    """
+    Explains why a conditional update of a task did not apply.
+
+    Returns:
+    str: The task's current status and version, or None if the task does not exist.
+    """
+    task = (
+        db.query(TaskStatus.name, TaskQueue.version)
+        .join(TaskStatus, TaskStatus.id == TaskQueue.task_status_id)
+        .filter(TaskQueue.id == task_id)
+        .first()
+    )
+    if task is None:
+        return None
+    return f"Task is {task.name} at version {task.version}"
@@ -4,13 +4,25 @@ from Logger import Logger, LogLevel
 from enum import Enum, auto
 from dotenv import load_dotenv
 
-load_dotenv()
-
 # Create an instance of the Logger class
 logger = Logger()
 
+_settings_loaded = False
+
+
+def load_settings():
+    """
+    Loads the .env file into the environment, once, on first use rather than on
+    import.
+    """
+    global _settings_loaded
+    if not _settings_loaded:
+        load_dotenv()
+        _settings_loaded = True
+
 
 def get_env_var(key: str, default=None):
+    load_settings()
     value = os.getenv(key, default)
     if value is None:
         logger.log(
@@ -24,3 +36,6 @@ def get_env_var(key: str, default=None):
 class ErrorCode(Enum):
     GENERAL = {"code": 500, "description": "General error"}
     NOT_FOUND = {"code": 404, "description": "Not found"}
+    CONFLICT = {"code": 409, "description": "Conflict"}
+    TOO_MANY_REQUESTS = {"code": 429, "description": "Too many requests"}
+    UNAVAILABLE = {"code": 503, "description": "Service unavailable"}